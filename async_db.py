@@ -0,0 +1,92 @@
+"""Асинхронный доступ к базе данных для обработчиков бота.
+
+Функции из database.py синхронные и блокируют event loop на время запроса.
+Здесь они выполняются в отдельном пуле потоков, а обработчики их ожидают (await),
+поэтому медленный запрос одного пользователя не задерживает обновления остальных.
+"""
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import database
+from database import DB_WORKERS
+
+# Пул потоков для запросов к базе данных
+_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix='db')
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Выполнение синхронной функции в пуле потоков базы данных"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+
+def _to_async_cached(func):
+    """Асинхронная обертка для чтения каталога
+
+    Если кэш каталога актуален, функция выполняется сразу в event loop:
+    она читает только память, и переход в пул потоков не нужен.
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        if database.catalog_cache.is_warm():
+            return func(*args, **kwargs)
+        return await run_blocking(func, *args, **kwargs)
+    return wrapper
+
+
+def _to_async_admins(func):
+    """Асинхронная обертка для списка администраторов, который хранится в памяти"""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        if database.admin_ids_cached():
+            return func(*args, **kwargs)
+        return await run_blocking(func, *args, **kwargs)
+    return wrapper
+
+
+def _to_async(func):
+    """Создание асинхронной обертки для синхронной функции"""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run_blocking(func, *args, **kwargs)
+    return wrapper
+
+
+add_user = _to_async(database.add_user)
+is_admin = _to_async_admins(database.is_admin)
+get_categories = _to_async_cached(database.get_categories)
+get_category_list = _to_async_cached(database.get_category_list)
+get_category = _to_async_cached(database.get_category)
+get_category_id = _to_async_cached(database.get_category_id)
+get_products = _to_async_cached(database.get_products)
+get_products_page = _to_async_cached(database.get_products_page)
+add_product = _to_async(database.add_product)
+get_product_by_id = _to_async_cached(database.get_product_by_id)
+add_to_cart_db = _to_async(database.add_to_cart_db)
+get_cart_items = _to_async(database.get_cart_items)
+clear_cart = _to_async(database.clear_cart)
+create_order = _to_async(database.create_order)
+checkout = _to_async(database.checkout)
+get_order_details = _to_async(database.get_order_details)
+get_admin_ids = _to_async_admins(database.get_admin_ids)
+export_products = _to_async(database.export_products)
+import_products = _to_async(database.import_products)
+delete_product = _to_async(database.delete_product)
+update_product = _to_async(database.update_product)
+release_upload = _to_async(database.release_upload)
+update_admin_status = _to_async(database.update_admin_status)
+get_all_users = _to_async(database.get_all_users)
+get_statistics = _to_async(database.get_statistics)
+get_file_id = _to_async(database.get_file_id)
+save_file_id = _to_async(database.save_file_id)
+forget_file_id = _to_async(database.forget_file_id)
+create_broadcast = _to_async(database.create_broadcast)
+get_active_broadcasts = _to_async(database.get_active_broadcasts)
+get_broadcast_recipients = _to_async(database.get_broadcast_recipients)
+save_broadcast_progress = _to_async(database.save_broadcast_progress)
+
+
+def shutdown():
+    """Остановка пула потоков"""
+    _executor.shutdown(wait=True)
@@ -0,0 +1,547 @@
+"""Бенчмарки слоя данных бота.
+
+Запуск:
+    python benchmark.py async [--updates 300]
+    python benchmark.py storage [--seconds 3]
+    python benchmark.py plans
+    python benchmark.py queries
+    python benchmark.py pagination [--products 5000]
+    python benchmark.py import [--products 50000]
+    python benchmark.py export [--products 50000]
+    python benchmark.py dispatch [--callbacks 2000]
+
+Все замеры выполняются на временной базе данных, shop.db не изменяется.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+# Временная база данных должна быть задана до импорта database
+_tmp_dir = tempfile.mkdtemp(prefix='shop_bench_')
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(_tmp_dir, 'bench.db')}"
+
+import database  # noqa: E402
+import async_db  # noqa: E402
+import migrations  # noqa: E402
+from database import Base, Category, Product, session_scope  # noqa: E402
+from sqlalchemy import event, text  # noqa: E402
+from sqlalchemy.exc import IntegrityError, OperationalError  # noqa: E402
+
+# Задержка, имитирующая запрос к Telegram Bot API из обработчика
+API_LATENCY = 0.005
+
+
+def seed(products_per_category=200):
+    """Заполнение временной базы тестовыми данными"""
+    Base.metadata.create_all(database.engine)
+    with session_scope() as session:
+        for i in range(5):
+            category = Category(name=f"Категория {i}")
+            session.add(category)
+            session.flush()
+            session.add_all(
+                Product(
+                    name=f"Товар {i}-{j}",
+                    description="Описание",
+                    price=100 + j,
+                    category_id=category.id,
+                    image_path=None
+                )
+                for j in range(products_per_category)
+            )
+
+
+def report(title, durations, total):
+    durations = sorted(durations)
+    p95 = durations[int(len(durations) * 0.95) - 1]
+    print(
+        f"{title:<20} {len(durations) / total:>9.1f} upd/s"
+        f"   p50 {statistics.median(durations) * 1000:>7.1f} ms"
+        f"   p95 {p95 * 1000:>7.1f} ms"
+    )
+
+
+async def _light_update():
+    # Обработчик без обращения к базе ("ℹ️ О нас", "📞 Контакты")
+    await asyncio.sleep(API_LATENCY)
+
+
+async def _sync_update(user_id, product_id):
+    # Так обработчики работали раньше: запрос блокирует event loop
+    database.get_products("Категория 0")
+    database.add_to_cart_db(user_id, product_id)
+    await asyncio.sleep(API_LATENCY)
+
+
+async def _async_update(user_id, product_id):
+    await async_db.get_products("Категория 0")
+    await async_db.add_to_cart_db(user_id, product_id)
+    await asyncio.sleep(API_LATENCY)
+
+
+async def _run_updates(db_handler, updates):
+    """Смешанная нагрузка: каждое пятое обновление обращается к базе"""
+    durations = {'db': [], 'light': []}
+
+    async def timed(i):
+        start = time.perf_counter()
+        if i % 5 == 0:
+            await db_handler(1000 + i % 50, 1 + i % 200)
+            durations['db'].append(time.perf_counter() - start)
+        else:
+            await _light_update()
+            durations['light'].append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(timed(i) for i in range(updates)))
+    return durations, time.perf_counter() - start
+
+
+def bench_async(args):
+    """Пропускная способность конкурентных обновлений: блокирующие вызовы и пул потоков"""
+    seed()
+    for title, handler in (("sync (blocking loop)", _sync_update), ("async (thread pool)", _async_update)):
+        durations, total = asyncio.run(_run_updates(handler, args.updates))
+        print(f"{title}: {args.updates / total:.1f} upd/s in total")
+        report("  db updates", durations['db'], total)
+        report("  light updates", durations['light'], total)
+
+
+def _storage_worker(db_engine, statement, params, deadline, counters, key):
+    while time.perf_counter() < deadline:
+        try:
+            with db_engine.begin() as connection:
+                connection.execute(statement, params())
+            counters[key] += 1
+        except OperationalError:
+            counters['locked'] += 1
+        except IntegrityError:
+            # Запись нарушила ограничение схемы; считаем, а не роняем поток
+            counters['integrity'] += 1
+
+
+def bench_storage(args):
+    """Пропускная способность чтения и записи для каждого профиля хранилища"""
+    read = text(
+        "SELECT p.id, p.name, p.price FROM products p "
+        "JOIN categories c ON c.id = p.category_id WHERE c.name = :name"
+    )
+    # Та же запись строки корзины, что в add_to_cart_db: одна строка на товар
+    write = text(
+        "INSERT INTO cart_items (cart_id, product_id, quantity) VALUES (:cart_id, :product_id, 1) "
+        "ON CONFLICT (cart_id, product_id) DO UPDATE SET quantity = quantity + 1"
+    )
+    for profile in database.STORAGE_PROFILES:
+        url = f"sqlite:///{os.path.join(_tmp_dir, f'storage_{profile}.db')}"
+        db_engine = database.create_db_engine(url, profile)
+        Base.metadata.create_all(db_engine)
+        with db_engine.begin() as connection:
+            connection.execute(text("INSERT INTO categories (id, name) VALUES (1, 'Категория 0')"))
+            connection.execute(
+                text("INSERT INTO products (name, price, category_id) VALUES (:name, 100, 1)"),
+                [{'name': f"Товар {i}"} for i in range(200)]
+            )
+        
+        counters = {'reads': 0, 'writes': 0, 'locked': 0, 'integrity': 0}
+        deadline = time.perf_counter() + args.seconds
+        threads = [
+            threading.Thread(target=_storage_worker, args=(
+                db_engine, read, lambda: {'name': "Категория 0"}, deadline, counters, 'reads'))
+            for _ in range(args.readers)
+        ] + [
+            threading.Thread(target=_storage_worker, args=(
+                db_engine, write, lambda: {'cart_id': 1, 'product_id': 1}, deadline, counters, 'writes'))
+            for _ in range(args.writers)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        db_engine.dispose()
+        
+        print(
+            f"{profile:<12} reads {counters['reads'] / args.seconds:>9.1f}/s"
+            f"   writes {counters['writes'] / args.seconds:>8.1f}/s"
+            f"   locked errors {counters['locked']}"
+            f"   integrity errors {counters['integrity']}"
+        )
+
+
+@contextmanager
+def capture_statements(db_engine=None):
+    """Сбор SQL-запросов, выполненных движком внутри блока"""
+    db_engine = db_engine or database.engine
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    event.listen(db_engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db_engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def bench_plans(args):
+    """Проверка через EXPLAIN QUERY PLAN, что горячие запросы используют индексы"""
+    seed()
+    # Имитируем старую базу без индексов и обновляем ее миграциями
+    with database.engine.begin() as connection:
+        for index in ('ux_cart_items_cart_product', 'ix_carts_user_id', 'ix_products_category_id',
+                      'ix_order_items_order_id', 'ix_categories_name'):
+            connection.execute(text(f"DROP INDEX {index}"))
+        # Повторная корзина пользователя, которую должна объединить миграция
+        connection.execute(text("INSERT INTO users (id, telegram_id) VALUES (1, 1001)"))
+        connection.execute(text("INSERT INTO carts (user_id) VALUES (1), (1)"))
+        connection.execute(text("INSERT INTO cart_items (cart_id, product_id, quantity) VALUES (1, 5, 1), (2, 5, 2)"))
+        migrations.set_schema_version(connection, 0)
+    migrations.run_migrations(database.engine)
+
+    hot_calls = [
+        ("products page (db)", lambda: database._query_products_page("Категория 0", after_id=50)),
+        ("add_to_cart_db (new user)", lambda: database.add_to_cart_db(1002, 5)),
+        ("add_to_cart_db", lambda: database.add_to_cart_db(1001, 5)),
+        ("get_cart_items", lambda: database.get_cart_items(1001)),
+        ("checkout", lambda: database.checkout(1001)),
+        ("get_order_details", lambda: database.get_order_details(1)),
+    ]
+    failures = 0
+    with database.engine.connect() as connection:
+        for title, call in hot_calls:
+            with capture_statements() as statements:
+                call()
+            print(title)
+            for statement, parameters in statements:
+                if not statement.lstrip().upper().startswith(('SELECT', 'INSERT', 'UPDATE', 'DELETE')):
+                    continue
+                plan = connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {statement}", parameters).all()
+                for row in plan:
+                    detail = row[-1]
+                    full_scan = detail.startswith('SCAN') and 'CONSTANT ROW' not in detail
+                    failures += full_scan
+                    print(f"  {'FAIL' if full_scan else 'ok  '} {detail}")
+    if failures:
+        print(f"{failures} full table scans in hot queries")
+        sys.exit(1)
+
+
+# Максимальное число SQL-запросов для каждой функции. Не зависит от размера
+# каталога, поэтому N+1 ленивых загрузок сразу превышает бюджет.
+QUERY_BUDGETS = {
+    "catalog cache rebuild": 2,
+    "get_categories": 0,
+    "get_products()": 0,
+    "get_products(category)": 0,
+    "get_product_by_id": 0,
+    "add_to_cart_db": 1,
+    "add_to_cart_db (new user)": 4,
+    "get_cart_items": 1,
+    "checkout": 5,
+    "get_order_details": 1,
+    "export_products": 1,
+}
+
+
+def measure_queries():
+    """Число SQL-запросов каждой функции из QUERY_BUDGETS на заполненной базе
+
+    Используется командой queries и тестом tests/test_query_budgets.py.
+    """
+    seed()
+    for product_id in range(1, 21):
+        database.add_to_cart_db(1001, product_id)
+    order_id = database.create_order(1001)
+    for product_id in range(1, 21):
+        database.add_to_cart_db(1001, product_id)
+
+    def rebuild_catalog():
+        database.catalog_cache.invalidate()
+        database.catalog_cache.snapshot()
+
+    calls = {
+        "catalog cache rebuild": rebuild_catalog,
+        "get_categories": lambda: database.get_categories(),
+        "get_products()": lambda: database.get_products(),
+        "get_products(category)": lambda: database.get_products("Категория 0"),
+        "get_product_by_id": lambda: database.get_product_by_id(5),
+        "add_to_cart_db": lambda: database.add_to_cart_db(1001, 5),
+        "add_to_cart_db (new user)": lambda: database.add_to_cart_db(1002, 5),
+        "get_cart_items": lambda: database.get_cart_items(1001),
+        "checkout": lambda: database.checkout(1001),
+        "get_order_details": lambda: database.get_order_details(order_id),
+        "export_products": lambda: database.export_products(os.path.join(_tmp_dir, 'export.json')),
+    }
+    counts = {}
+    for title, call in calls.items():
+        with capture_statements() as statements:
+            call()
+        counts[title] = len(statements)
+    return counts
+
+
+def bench_queries(args):
+    """Проверка числа SQL-запросов, которые выполняет каждая функция
+
+    Та же проверка входит в тесты (tests/test_query_budgets.py).
+    При превышении бюджета команда завершается с кодом 1.
+    """
+    failures = 0
+    for title, count in measure_queries().items():
+        budget = QUERY_BUDGETS[title]
+        over_budget = count > budget
+        failures += over_budget
+        print(f"{'FAIL' if over_budget else 'ok  '} {title:<26} {count:>4} queries (budget {budget})")
+    if failures:
+        sys.exit(1)
+
+
+def _legacy_page(category, page):
+    # Прежний способ: загрузить всю категорию и вырезать страницу в Python
+    with session_scope() as session:
+        products = database._product_query(session).filter(Category.name == category).all()
+        products = [database._product_to_dict(row) for row in products]
+    per_page = database.PRODUCTS_PER_PAGE
+    return products[page * per_page:(page + 1) * per_page]
+
+
+def bench_pagination(args):
+    """Стоимость перелистывания страницы в начале и в конце большой категории"""
+    seed(products_per_category=args.products)
+    category = "Категория 0"
+    product_ids = [product['id'] for product in database.get_products(category)]
+    per_page = database.PRODUCTS_PER_PAGE
+    pages = len(product_ids) // per_page
+
+    for page in (1, pages // 2, pages - 1):
+        anchor_id = product_ids[page * per_page - 1]
+        variants = (
+            ("full load + slice", lambda: _legacy_page(category, page)),
+            ("keyset (db)", lambda: database._query_products_page(category, after_id=anchor_id)),
+            ("keyset (cache)", lambda: database.get_products_page(category, after_id=anchor_id)),
+        )
+        for title, call in variants:
+            repeats = 20 if title == "full load + slice" else 200
+            start = time.perf_counter()
+            for _ in range(repeats):
+                call()
+            elapsed = (time.perf_counter() - start) / repeats
+            print(f"page {page + 1:>5}  {title:<18} {elapsed * 1000:>8.3f} ms per flip")
+
+
+def _legacy_import(backup_file):
+    # Прежний импорт: json.load и два SELECT на каждый товар
+    with open(backup_file, 'r', encoding='utf-8') as f:
+        products_data = json.load(f)
+    with session_scope() as session:
+        for product_data in products_data:
+            category = session.query(Category).filter_by(name=product_data['category']).first()
+            existing_product = session.query(Product).filter_by(
+                name=product_data['name'], category_id=category.id
+            ).first()
+            if not existing_product:
+                session.add(Product(
+                    name=product_data['name'],
+                    description=product_data['description'],
+                    price=product_data['price'],
+                    category_id=category.id,
+                    image_path=product_data['image_path']
+                ))
+
+
+def _write_supplier_file(path, count):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump([
+            {
+                'id': i,
+                'name': f"Поставщик {i}",
+                'description': "Описание товара поставщика",
+                'price': 100.0 + i % 1000,
+                'category': f"Категория {i % 5}",
+                'image_path': f"images/product_{i}.jpg"
+            }
+            for i in range(count)
+        ], f, ensure_ascii=False, indent=4)
+
+
+def bench_import(args):
+    """Импорт файла поставщика: прежний построчный и пакетный потоковый"""
+    seed(products_per_category=0)
+    for title, count, run in (
+        ("legacy (json.load + 2 SELECT/row)", args.legacy_products, _legacy_import),
+        ("bulk streaming", args.products, database.import_products),
+    ):
+        path = os.path.join(_tmp_dir, f'supplier_{count}.json')
+        _write_supplier_file(path, count)
+        with session_scope() as session:
+            session.query(Product).delete()
+        start = time.perf_counter()
+        result = run(path)
+        elapsed = time.perf_counter() - start
+        print(f"{title:<34} {count:>7} products  {elapsed:>7.2f} s  {count / elapsed:>9.0f} rows/s")
+        if isinstance(result, dict):
+            print(f"{'':<34} {result}")
+    # Повторный импорт того же файла только пропускает существующие товары
+    start = time.perf_counter()
+    result = database.import_products(path)
+    print(f"{'bulk streaming (re-import)':<34} {args.products:>7} products  {time.perf_counter() - start:>7.2f} s  {result}")
+
+
+def _legacy_export(backup_file):
+    """Прежний экспорт: весь каталог в памяти и запись json.dump в целевой файл"""
+    with session_scope() as session:
+        data = [database._product_to_dict(row) for row in database._product_query(session).order_by(Product.id)]
+    with open(backup_file, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=4)
+    return {'rows': len(data), 'bytes': os.path.getsize(backup_file)}
+
+
+def bench_export(args):
+    """Экспорт каталога: пиковая память, размер файла и скорость по форматам"""
+    seed(products_per_category=args.products // 5)
+    for title, extension, run in (
+        ("legacy json.dump", 'json', _legacy_export),
+        ("streaming json", 'json', database.export_products),
+        ("streaming ndjson", 'ndjson', lambda path: database.export_products(path, fmt='ndjson')),
+        ("streaming ndjson.gz", 'ndjson.gz',
+         lambda path: database.export_products(path, fmt='ndjson', compress=True)),
+    ):
+        path = os.path.join(_tmp_dir, f'export.{extension}')
+        tracemalloc.start()
+        start = time.perf_counter()
+        result = run(path)
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{title:<22} {result['rows']:>7} rows  {result['bytes'] / 1024:>9.0f} KB  "
+              f"{elapsed:>6.2f} s  {result['rows'] / elapsed:>9.0f} rows/s  peak {peak / 1024 / 1024:>6.1f} MB")
+
+
+def _callback_update(update_id, data):
+    from aiogram.types import Update
+    return Update.model_validate({
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'chat_instance': '1',
+            'data': data,
+            'from': {'id': 1, 'is_bot': False, 'first_name': 'Bench'},
+        },
+    })
+
+
+async def _feed_callbacks(dp, bot, updates):
+    start = time.perf_counter()
+    for update in updates:
+        await dp.feed_update(bot, update)
+    return time.perf_counter() - start
+
+
+def bench_dispatch(args):
+    """Выбор обработчика callback: фильтры aiogram и таблица CallbackRouter"""
+    from aiogram import Bot, Dispatcher, F
+    from callback_router import CallbackRouter, pack
+
+    # Запись в лог о каждом обновлении заняла бы большую часть замера
+    logging.getLogger('aiogram.event').setLevel(logging.WARNING)
+
+    async def noop(*_args, **_kwargs):
+        pass
+
+    async def run():
+        bot = Bot(token='42:TEST')
+        try:
+            for routes in (10, 50, 200):
+                # Нажатия равномерно распределены по всем обработчикам
+                legacy_updates = [_callback_update(i, f"h{i % routes}_{i}") for i in range(args.callbacks)]
+                packed_updates = [_callback_update(i, pack(f"h{i % routes}", i)) for i in range(args.callbacks)]
+
+                filters_dp = Dispatcher()
+                for i in range(routes):
+                    filters_dp.callback_query(F.data.startswith(f"h{i}_"))(noop)
+
+                router = CallbackRouter()
+                for i in range(routes):
+                    router.route(f"h{i}", arity=1)(noop)
+                    router.legacy(f"h{i}_")(lambda args, action=f"h{i}": pack(action, int(args)))
+                router_dp = Dispatcher()
+
+                @router_dp.callback_query()
+                async def route_callback(callback):
+                    await router.dispatch(callback)
+
+                for title, dp, updates in (
+                    ("aiogram filters", filters_dp, legacy_updates),
+                    ("router", router_dp, packed_updates),
+                    ("router, old format", router_dp, legacy_updates),
+                ):
+                    elapsed = await _feed_callbacks(dp, bot, updates)
+                    print(f"{routes:>4} routes  {title:<20} {elapsed / len(updates) * 1e6:>8.1f} us/callback")
+
+                data = [update.callback_query.data for update in packed_updates]
+                start = time.perf_counter()
+                for value in data:
+                    router.resolve(value)
+                elapsed = time.perf_counter() - start
+                print(f"{routes:>4} routes  {'resolve() only':<20} {elapsed / len(data) * 1e6:>8.2f} us/callback")
+        finally:
+            await bot.session.close()
+
+    asyncio.run(run())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parser_async = subparsers.add_parser('async', help=bench_async.__doc__)
+    parser_async.add_argument('--updates', type=int, default=300)
+    parser_async.set_defaults(func=bench_async)
+
+    parser_storage = subparsers.add_parser('storage', help=bench_storage.__doc__)
+    parser_storage.add_argument('--seconds', type=float, default=3)
+    parser_storage.add_argument('--readers', type=int, default=4)
+    parser_storage.add_argument('--writers', type=int, default=2)
+    parser_storage.set_defaults(func=bench_storage)
+
+    parser_plans = subparsers.add_parser('plans', help=bench_plans.__doc__)
+    parser_plans.set_defaults(func=bench_plans)
+
+    parser_queries = subparsers.add_parser('queries', help=bench_queries.__doc__)
+    parser_queries.set_defaults(func=bench_queries)
+
+    parser_pagination = subparsers.add_parser('pagination', help=bench_pagination.__doc__)
+    parser_pagination.add_argument('--products', type=int, default=5000)
+    parser_pagination.set_defaults(func=bench_pagination)
+
+    parser_import = subparsers.add_parser('import', help=bench_import.__doc__)
+    parser_import.add_argument('--products', type=int, default=50000)
+    parser_import.add_argument('--legacy-products', type=int, default=5000)
+    parser_import.set_defaults(func=bench_import)
+
+    parser_export = subparsers.add_parser('export', help=bench_export.__doc__)
+    parser_export.add_argument('--products', type=int, default=50000)
+    parser_export.set_defaults(func=bench_export)
+
+    parser_dispatch = subparsers.add_parser('dispatch', help=bench_dispatch.__doc__)
+    parser_dispatch.add_argument('--callbacks', type=int, default=2000)
+    parser_dispatch.set_defaults(func=bench_dispatch)
+
+    args = parser.parse_args()
+    try:
+        args.func(args)
+    finally:
+        async_db.shutdown()
+
+
+if __name__ == "__main__":
+    main()
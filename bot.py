@@ -1,25 +1,33 @@
+import asyncio
 import os
-from aiogram import Bot, Dispatcher, types, F
+from aiogram import Bot, Dispatcher, Router, types, F
 from aiogram.filters import Command, StateFilter
-from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, FSInputFile
+from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, FSInputFile, InputMediaPhoto
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from dotenv import load_dotenv
-from database import (
-    init_db, add_user, get_categories, get_products, is_admin,
+from database import init_db, backup_database_file, role_registry
+from async_db import (
+    get_category_list, get_category, get_category_id, get_products, get_products_page,
     add_product, get_product_by_id, add_to_cart_db, get_cart_items,
-    clear_cart, create_order, get_order_details, export_products,
-    delete_product, update_product, session_scope, Product, Category,
-    User, Order, CartItem, OrderItem, update_admin_status, get_admin_ids,
-    get_all_users
+    clear_cart, checkout, export_products,
+    delete_product, update_product, release_upload, update_admin_status, get_admin_ids,
+    get_statistics, run_blocking,
+    get_file_id, save_file_id, forget_file_id
 )
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest
+from broadcast import start_broadcast, resume_broadcasts
+from send_queue import SendScheduler
+from webhook import run_webhook, check_config as check_webhook_config, DROP_PENDING_UPDATES
+from image_pipeline import save_photo, DEFAULT_IMAGE, IMAGE_DIR
+from callback_router import CallbackRouter, pack
+from catalog_screens import CatalogScreens, categories_keyboard, page_keyboard, page_text
+from roles import AdminMiddleware
+from user_registry import UserRegistry
+from fsm_storage import SQLiteStorage
 import logging
-import shutil
 from datetime import datetime
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine
-from sqlalchemy.sql import func
 import time
 import glob
 
@@ -86,81 +94,130 @@ class BroadcastStates(StatesGroup):
 # Загрузка переменных окружения
 load_dotenv()
 TOKEN = os.getenv('BOT_TOKEN')
-ADMIN_IDS = [int(id) for id in os.getenv('ADMIN_IDS', '').split(',') if id]
+# Способ получения обновлений: polling или webhook
+RUN_MODE = os.getenv('RUN_MODE', 'polling')
 
 # Инициализация бота и диспетчера
 bot = Bot(token=TOKEN)
-dp = Dispatcher()
+# Состояния пошаговых диалогов сохраняются в базе и переживают перезапуск
+fsm_storage = SQLiteStorage()
+dp = Dispatcher(storage=fsm_storage)
+
+# Все исходящие запросы проходят через общий планировщик с лимитами Telegram
+send_scheduler = SendScheduler()
+bot.session.middleware(send_scheduler)
+
+# Обработчики команд администратора; права проверяются по реестру ролей в памяти
+admin_router = Router(name='admin')
+admin_router.message.middleware(AdminMiddleware(role_registry))
+dp.include_router(admin_router)
+
+# Обработчики inline-кнопок по действию из callback_data
+callbacks = CallbackRouter(is_admin=role_registry.is_admin)
+# Готовые экраны каталога, пересобираются после изменений каталога
+catalog_screens = CatalogScreens()
+# Известные пользователи; /start пишет в базу только новых и изменившихся
+user_registry = UserRegistry()
+
+@dp.callback_query()
+async def route_callback(callback: types.CallbackQuery, state: FSMContext):
+    """Единая точка входа для всех inline-кнопок"""
+    await callbacks.dispatch(callback, state=state)
 
 # Инициализация базы данных
 init_db()
 
 # Создание необходимых директорий
 os.makedirs("products", exist_ok=True)
-os.makedirs("images", exist_ok=True)
-
-# Путь к стандартной картинке
-DEFAULT_IMAGE = "images/default_product.jpg"
-
-# Создание клавиатуры главного меню
-def get_main_keyboard():
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="🛍 Каталог")],
-            [KeyboardButton(text="🛒 Корзина"), KeyboardButton(text="💳 Оплата")],
-            [KeyboardButton(text="ℹ️ О нас"), KeyboardButton(text="📞 Контакты")]
-        ],
-        resize_keyboard=True
-    )
-    return keyboard
-
-# Создание клавиатуры администратора
-def get_admin_keyboard():
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="➕ Добавить товар"), KeyboardButton(text="📝 Редактировать товар")],
-            [KeyboardButton(text="🗑 Удалить товар"), KeyboardButton(text="📊 Статистика")],
-            [KeyboardButton(text="📢 Рассылка")],
-            [KeyboardButton(text="🔙 В главное меню")]
-        ],
-        resize_keyboard=True
-    )
-    return keyboard
+os.makedirs(IMAGE_DIR, exist_ok=True)
+
+# Клавиатуры меню не меняются, поэтому создаются один раз при запуске
+MAIN_KEYBOARD = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="🛍 Каталог")],
+        [KeyboardButton(text="🛒 Корзина"), KeyboardButton(text="💳 Оплата")],
+        [KeyboardButton(text="ℹ️ О нас"), KeyboardButton(text="📞 Контакты")]
+    ],
+    resize_keyboard=True
+)
+
+ADMIN_KEYBOARD = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="➕ Добавить товар"), KeyboardButton(text="📝 Редактировать товар")],
+        [KeyboardButton(text="🗑 Удалить товар"), KeyboardButton(text="📊 Статистика")],
+        [KeyboardButton(text="📢 Рассылка")],
+        [KeyboardButton(text="🔙 В главное меню")]
+    ],
+    resize_keyboard=True
+)
+
+# Текст приветствия для /start собирается один раз
+WELCOME_TEXT = (
+    "🌟 Добро пожаловать в наш магазин!\n\n"
+    "🛍 Здесь вы найдете лучшие товары для вейпинга\n"
+    "🚚 Быстрая доставка\n"
+    "💯 Гарантия качества\n"
+    "👨‍💼 Профессиональная консультация\n\n"
+    "Выберите нужный раздел в меню ниже 👇"
+)
+
+LOGO_PATH = "logo.jpg"
+# Как часто проверять, не изменился ли файл логотипа (секунды)
+LOGO_CHECK_INTERVAL = 60
+
+# Состояние логотипа: есть ли файл и его file_id в Telegram
+_logo = {'exists': False, 'file_id': None, 'checked_at': None}
+
+async def refresh_logo():
+    """Проверка файла логотипа не чаще раза в LOGO_CHECK_INTERVAL секунд
+
+    file_id берется из кэша по хешу файла, поэтому измененный логотип
+    будет загружен заново, а неизмененный не загружается даже после перезапуска.
+    """
+    now = time.monotonic()
+    if _logo['checked_at'] is not None and now - _logo['checked_at'] < LOGO_CHECK_INTERVAL:
+        return
+    _logo['checked_at'] = now
+    exists = await run_blocking(os.path.exists, LOGO_PATH)
+    if not exists and _logo['exists'] is not False:
+        logger.warning(f"Logo file not found: {LOGO_PATH}")
+    _logo['exists'] = exists
+    _logo['file_id'] = await get_file_id(LOGO_PATH) if exists else None
+
+async def send_welcome(message: types.Message):
+    """Отправка приветствия с логотипом по сохраненному file_id"""
+    await refresh_logo()
+    if not _logo['exists']:
+        await message.answer(WELCOME_TEXT, reply_markup=MAIN_KEYBOARD)
+        return
+    
+    if _logo['file_id']:
+        try:
+            await message.answer_photo(_logo['file_id'], caption=WELCOME_TEXT, reply_markup=MAIN_KEYBOARD)
+            return
+        except TelegramBadRequest as e:
+            logger.warning(f"Cached logo file_id rejected: {e}")
+            _logo['file_id'] = None
+            await forget_file_id(LOGO_PATH)
+    
+    sent = await message.answer_photo(FSInputFile(LOGO_PATH), caption=WELCOME_TEXT, reply_markup=MAIN_KEYBOARD)
+    if sent.photo:
+        _logo['file_id'] = sent.photo[-1].file_id
+        await save_file_id(LOGO_PATH, _logo['file_id'])
 
 # Обработчик команды /start
 @dp.message(Command("start"))
 async def cmd_start(message: types.Message):
     try:
-        is_user_admin = message.from_user.id in ADMIN_IDS
-        add_user(message.from_user.id, is_user_admin, message.from_user.username)
-        
-        # Формируем текст приветствия
-        welcome_text = (
-            "🌟 Добро пожаловать в наш магазин!\n\n"
-            "🛍 Здесь вы найдете лучшие товары для вейпинга\n"
-            "🚚 Быстрая доставка\n"
-            "💯 Гарантия качества\n"
-            "👨‍💼 Профессиональная консультация\n\n"
-            "Выберите нужный раздел в меню ниже 👇"
-        )
+        user_registry.register(message.from_user.id, message.from_user.username)
         
         # Отправляем логотип с текстом, если он существует
-        if os.path.exists("logo.jpg"):
-            try:
-                photo = FSInputFile("logo.jpg")
-                await message.answer_photo(
-                    photo,
-                    caption=welcome_text,
-                    reply_markup=get_main_keyboard()
-                )
-            except Exception as e:
-                logger.error(f"Error sending logo: {e}")
-                # Если не удалось отправить фото, отправляем только текст
-                await message.answer(welcome_text, reply_markup=get_main_keyboard())
-        else:
-            logger.warning("Logo file not found: logo.jpg")
-            # Если логотип не найден, отправляем только текст
-            await message.answer(welcome_text, reply_markup=get_main_keyboard())
+        try:
+            await send_welcome(message)
+        except Exception as e:
+            logger.error(f"Error sending logo: {e}")
+            # Если не удалось отправить фото, отправляем только текст
+            await message.answer(WELCOME_TEXT, reply_markup=MAIN_KEYBOARD)
             
     except Exception as e:
         logger.error(f"Error in cmd_start: {e}", exc_info=True)
@@ -170,12 +227,12 @@ async def cmd_start(message: types.Message):
 @dp.message(lambda message: message.text == "🛍 Каталог")
 async def show_catalog(message: types.Message):
     try:
-        categories = get_categories()
-        keyboard = InlineKeyboardMarkup(
-            inline_keyboard=[
-                [InlineKeyboardButton(text=cat, callback_data=f"cat_{cat}")] for cat in categories
-            ]
-        )
+        keyboard = catalog_screens.categories() or categories_keyboard(await get_category_list())
+        # С логотипом каталог листается правкой одного фото-сообщения
+        await refresh_logo()
+        if _logo['exists']:
+            await answer_photo_cached(message, LOGO_PATH, caption="🛍 Выберите категорию:", reply_markup=keyboard)
+            return
         await message.answer(
             "🛍 Выберите категорию:",
             reply_markup=keyboard
@@ -184,80 +241,90 @@ async def show_catalog(message: types.Message):
         logger.error(f"Error in show_catalog: {e}")
         await message.answer("Произошла ошибка. Пожалуйста, попробуйте позже.")
 
+async def _legacy_category(name, action='cat'):
+    """Кнопка старого формата с названием категории -> кнопка с id категории"""
+    category_id = await get_category_id(name)
+    return pack(action, category_id) if category_id is not None else None
+
+callbacks.legacy('cat_', 'cat:')(_legacy_category)
+
 # Обработчик выбора категории
-@dp.callback_query(lambda c: c.data.startswith('cat_'))
-async def show_category_products(callback: types.CallbackQuery):
+@callbacks.route('cat', arity=1)
+async def show_category_products(callback: types.CallbackQuery, args: tuple):
     try:
-        category = callback.data[4:]  # Убираем префикс 'cat_'
-        products = get_products(category)
-        if not products:
-            await callback.message.answer("В этой категории пока нет товаров.")
+        screen = catalog_screens.page(args[0])
+        if screen is not None:
+            await show_text_screen(callback.message, screen.text, reply_markup=screen.keyboard)
+            await callback.answer()
             return
         
-        # Разбиваем товары на страницы по 5 штук
-        products_per_page = 5
-        pages = [products[i:i + products_per_page] for i in range(0, len(products), products_per_page)]
-        
-        # Создаем клавиатуру для первой страницы
-        keyboard_buttons = []
-        for product in pages[0]:
-            keyboard_buttons.append([InlineKeyboardButton(
-                text=f"{product['name']} - {product['price']} ₽",
-                callback_data=f"product_{product['id']}"
-            )])
-        
-        # Добавляем кнопки навигации, если есть больше одной страницы
-        if len(pages) > 1:
-            keyboard_buttons.append([
-                InlineKeyboardButton(text="➡️", callback_data=f"page_{category}_1")
-            ])
-        
-        keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
+        category = await get_category(args[0])
+        if category is None:
+            await callback.answer("Категория не найдена")
+            return
+        result = await get_products_page(category['name'])
+        if not result['items']:
+            await callback.answer("В этой категории пока нет товаров.")
+            return
         
-        await callback.message.answer(
-            f"🛍 Товары в категории {category}:\n\n"
-            f"Страница 1 из {len(pages)}",
-            reply_markup=keyboard
+        await show_text_screen(
+            callback.message,
+            page_text(category, 0, result),
+            reply_markup=page_keyboard(category, 0, result)
         )
         await callback.answer()
     except Exception as e:
         logger.error(f"Error in show_category_products: {e}")
         await callback.message.answer("Произошла ошибка. Пожалуйста, попробуйте позже.")
 
-# Обработчик пагинации
-@dp.callback_query(lambda c: c.data.startswith('page_'))
-async def handle_pagination(callback: types.CallbackQuery):
+@callbacks.legacy('page_', 'page:')
+async def _legacy_page(args):
+    """Кнопка старого формата page_{категория}_{страница}_{n|p}{id}"""
+    separator = ':' if args.count(':') >= 2 else '_'
+    parts = args.rsplit(separator, 2)
+    if len(parts) == 3 and parts[2][:1] in ('n', 'p'):
+        category, page, anchor = parts
+        category_id = await get_category_id(category)
+        if category_id is None:
+            return None
+        return pack('next' if anchor[0] == 'n' else 'prev', category_id, int(page), int(anchor[1:]))
+    # Кнопки без ключа открывают первую страницу
+    return await _legacy_category(args.rsplit('_', 1)[0])
+
+# Обработчик пагинации: {id категории}:{страница}:{id крайнего товара}
+@callbacks.route('next', arity=3)
+@callbacks.route('prev', arity=3)
+async def handle_pagination(callback: types.CallbackQuery, args: tuple, action: str):
     try:
-        _, category, page = callback.data.split('_')
-        page = int(page)
-        products = get_products(category)
-        products_per_page = 5
-        pages = [products[i:i + products_per_page] for i in range(0, len(products), products_per_page)]
+        category_id, page, anchor_id = args
+        if action == 'next':
+            screen = catalog_screens.page(category_id, page, after_id=anchor_id)
+        else:
+            screen = catalog_screens.page(category_id, page, before_id=anchor_id)
+        if screen is not None:
+            await show_text_screen(callback.message, screen.text, reply_markup=screen.keyboard)
+            await callback.answer()
+            return
         
-        if page < 0 or page >= len(pages):
+        category = await get_category(category_id)
+        if category is None:
+            await callback.answer("Категория не найдена")
+            return
+        if action == 'next':
+            result = await get_products_page(category['name'], after_id=anchor_id)
+        else:
+            result = await get_products_page(category['name'], before_id=anchor_id)
+        
+        if not result['items']:
             await callback.answer("Это последняя страница")
             return
+        if not result['has_prev']:
+            page = 0
         
-        keyboard = InlineKeyboardMarkup(row_width=2)
-        for product in pages[page]:
-            keyboard.add(InlineKeyboardButton(
-                text=f"{product['name']} - {product['price']} ₽",
-                callback_data=f"product_{product['id']}"
-            ))
-        
-        # Добавляем кнопки навигации
-        nav_buttons = []
-        if page > 0:
-            nav_buttons.append(InlineKeyboardButton(text="⬅️", callback_data=f"page_{category}_{page-1}"))
-        if page < len(pages) - 1:
-            nav_buttons.append(InlineKeyboardButton(text="➡️", callback_data=f"page_{category}_{page+1}"))
-        if nav_buttons:
-            keyboard.add(*nav_buttons)
-        
-        await callback.message.edit_text(
-            f"🛍 Товары в категории {category}:\n\n"
-            f"Страница {page + 1} из {len(pages)}",
-            reply_markup=keyboard
+        await show_text_screen(
+            callback.message,
+            page_text(category, page, result),
+            reply_markup=page_keyboard(category, page, result)
         )
         await callback.answer()
     except Exception as e:
@@ -265,82 +332,189 @@ async def handle_pagination(callback: types.CallbackQuery):
         await callback.answer("Произошла ошибка. Пожалуйста, попробуйте позже.")
 
 # Обработчик кнопки "Назад в категории"
-@dp.callback_query(F.data.startswith("back_to_cat_"))
+@callbacks.legacy('back_to_cat_', 'back_to_cat:')
+def _legacy_back_to_category(args):
+    return pack('back_to_cat')
+
+@callbacks.route('back_to_cat')
 async def handle_back_to_category(callback_query: types.CallbackQuery):
     """Обработчик кнопки 'Назад в категории'"""
     try:
         # Получаем список категорий
-        categories = get_categories()
-        if not categories:
+        keyboard = catalog_screens.categories() or categories_keyboard(await get_category_list())
+        if not keyboard.inline_keyboard:
             await callback_query.message.answer("❌ Нет доступных категорий")
             return
         
-        # Создаем клавиатуру с категориями
-        keyboard_buttons = []
-        for category in categories:
-            keyboard_buttons.append([types.InlineKeyboardButton(
-                text=category,
-                callback_data=f"cat_{category}"
-            )])
-        
-        keyboard = types.InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
-        
-        # Проверяем, есть ли текст в сообщении
-        if callback_query.message.text:
-            await callback_query.message.edit_text(
-                "🛍 Выберите категорию:",
-                reply_markup=keyboard
-            )
-        else:
-            # Если сообщение не содержит текста, отправляем новое
-            await callback_query.message.answer(
-                "🛍 Выберите категорию:",
-                reply_markup=keyboard
-            )
+        await show_text_screen(callback_query.message, "🛍 Выберите категорию:", reply_markup=keyboard)
+        await callback_query.answer()
         
     except Exception as e:
         logger.error(f"Error in handle_back_to_category: {e}", exc_info=True)
         await callback_query.answer("❌ Произошла ошибка при возврате к категориям")
 
+async def answer_photo_cached(message: types.Message, image_path, **kwargs):
+    """Отправка картинки по сохраненному file_id с загрузкой файла при промахе
+
+    Если Telegram не принимает сохраненный file_id, он удаляется из кэша,
+    а файл загружается заново.
+    """
+    file_id = await get_file_id(image_path)
+    if file_id:
+        try:
+            return await message.answer_photo(file_id, **kwargs)
+        except TelegramBadRequest as e:
+            logger.warning(f"Cached file_id for {image_path} rejected: {e}")
+            await forget_file_id(image_path)
+    
+    sent = await message.answer_photo(FSInputFile(image_path), **kwargs)
+    if sent.photo:
+        await save_file_id(image_path, sent.photo[-1].file_id)
+    return sent
+
+# Навигация по каталогу идет в одном сообщении: экраны заменяются
+# редактированием. Если есть логотип, сообщение каталога — это фото:
+# списки показываются подписью к логотипу, карточка товара — фото товара,
+# и любой переход делается одним edit_message_media. Telegram не превращает
+# текстовое сообщение в фото и обратно, поэтому в этих случаях отправляется
+# новое сообщение, а старое удаляется.
+async def _replace_message(message: types.Message, send):
+    """Отправка нового сообщения вместо того, которое нельзя отредактировать"""
+    sent = await send()
+    try:
+        await message.delete()
+    except TelegramAPIError as e:
+        # Например, сообщение старше 48 часов
+        logger.info(f"Cannot delete message {message.message_id}: {e}")
+    return sent
+
+def _not_modified(error):
+    return 'message is not modified' in str(error)
+
+# Ошибки, при которых сообщение нельзя отредактировать и его заменяют новым.
+# Остальные ошибки (например, Telegram не принял файл) повторятся и при
+# отправке нового сообщения, поэтому передаются вызывающему
+_CANNOT_EDIT_ERRORS = (
+    "message can't be edited",
+    'message to edit not found',
+    'there is no media in the message to edit',
+    'there is no text in the message to edit',
+)
+
+def _cannot_edit(error):
+    text = str(error).lower()
+    return any(reason in text for reason in _CANNOT_EDIT_ERRORS)
+
+def _file_id_rejected(error):
+    # "wrong file identifier/HTTP URL specified", "wrong remote file identifier specified"
+    return 'file identifier' in str(error).lower()
+
+# Наибольшая длина подписи к фото в Telegram; длинный текст показывается
+# отдельным текстовым сообщением
+CAPTION_LIMIT = 1024
+
+def fits_caption(text):
+    return len(text) <= CAPTION_LIMIT
+
+def has_image(image_path):
+    """Есть ли у товара собственная картинка
+
+    Товары без фото ссылаются на DEFAULT_IMAGE; это пустой файл, и Telegram
+    его не принимает, поэтому такие товары показываются текстом.
+    """
+    return bool(image_path) and image_path != DEFAULT_IMAGE and \
+        os.path.isfile(image_path) and os.path.getsize(image_path) > 0
+
+async def show_text_screen(message: types.Message, text, reply_markup=None, **kwargs):
+    """Показ текстового экрана вместо содержимого сообщения"""
+    if message.photo and fits_caption(text):
+        await refresh_logo()
+        if _logo['exists']:
+            return await show_photo_screen(message, LOGO_PATH, text, reply_markup=reply_markup, **kwargs)
+    if message.text:
+        try:
+            return await message.edit_text(text, reply_markup=reply_markup, **kwargs)
+        except TelegramBadRequest as e:
+            if _not_modified(e):
+                return message
+            if not _cannot_edit(e):
+                raise
+            logger.info(f"Cannot edit message {message.message_id}, sending a new one: {e}")
+    return await _replace_message(message, lambda: message.answer(text, reply_markup=reply_markup, **kwargs))
+
+async def show_photo_screen(message: types.Message, image_path, caption, reply_markup=None, **kwargs):
+    """Показ карточки с фото вместо содержимого сообщения
+
+    Фото меняется через edit_message_media по сохраненному file_id;
+    при промахе кэша файл загружается, а новый file_id сохраняется.
+    Если Telegram не принял сохраненный file_id, файл загружается заново.
+    """
+    if message.photo:
+        file_id = await get_file_id(image_path)
+        while True:
+            media = InputMediaPhoto(media=file_id or FSInputFile(image_path), caption=caption, **kwargs)
+            try:
+                edited = await message.edit_media(media, reply_markup=reply_markup)
+            except TelegramBadRequest as e:
+                if _not_modified(e):
+                    return message
+                if _cannot_edit(e):
+                    logger.info(f"Cannot edit media of message {message.message_id}, sending a new one: {e}")
+                    break
+                if not (file_id and _file_id_rejected(e)):
+                    raise
+                logger.warning(f"Cached file_id for {image_path} rejected: {e}")
+                await forget_file_id(image_path)
+                file_id = None
+                continue
+            if not file_id and isinstance(edited, types.Message) and edited.photo:
+                await save_file_id(image_path, edited.photo[-1].file_id)
+            return edited
+    return await _replace_message(
+        message,
+        lambda: answer_photo_cached(message, image_path, caption=caption, reply_markup=reply_markup, **kwargs)
+    )
+
+def _legacy_id(action):
+    """Перевод кнопки старого формата {действие}_{id} в новый формат"""
+    return lambda args: pack(action, int(args))
+
+for _action in ('product', 'add', 'edit', 'edit_name', 'edit_desc', 'edit_price', 'edit_image',
+                'delete', 'confirm_delete'):
+    callbacks.legacy(f'{_action}_', f'{_action}:')(_legacy_id(_action))
+
 # Обработчик просмотра товара
-@dp.callback_query(lambda c: c.data.startswith('product_'))
-async def show_product(callback: types.CallbackQuery):
+@callbacks.route('product', arity=1)
+async def show_product(callback: types.CallbackQuery, args: tuple):
     try:
-        product_id = int(callback.data[8:])
-        product = get_product_by_id(product_id)
+        product_id = args[0]
+        product = await get_product_by_id(product_id)
         if not product:
             await callback.answer("Товар не найден")
             return
         
         keyboard = InlineKeyboardMarkup(
             inline_keyboard=[
-                [InlineKeyboardButton(text="🛒 Добавить в корзину", callback_data=f"add_{product['id']}")],
-                [InlineKeyboardButton(text="⬅️ Назад в категорию", callback_data=f"back_to_cat_{product['category']}")]
+                [InlineKeyboardButton(text="🛒 Добавить в корзину", callback_data=pack("add", product['id']))],
+                [InlineKeyboardButton(text="⬅️ Назад в категорию", callback_data=pack("back_to_cat"))]
             ]
         )
         
-        if product['image_path'] and os.path.exists(product['image_path']):
+        caption = f"*{product['name']}*\n\n{product['description']}\n\nЦена: {product['price']} ₽"
+        if has_image(product['image_path']) and fits_caption(caption):
             try:
-                photo = FSInputFile(product['image_path'])
-                await callback.message.answer_photo(
-                    photo,
-                    caption=f"*{product['name']}*\n\n{product['description']}\n\nЦена: {product['price']} ₽",
+                await show_photo_screen(
+                    callback.message,
+                    product['image_path'],
+                    caption,
                     parse_mode="Markdown",
                     reply_markup=keyboard
                 )
             except Exception as e:
                 logger.error(f"Error sending photo: {e}")
-                await callback.message.answer(
-                    f"*{product['name']}*\n\n{product['description']}\n\nЦена: {product['price']} ₽",
-                    parse_mode="Markdown",
-                    reply_markup=keyboard
-                )
+                await show_text_screen(callback.message, caption, parse_mode="Markdown", reply_markup=keyboard)
         else:
-            await callback.message.answer(
-                f"*{product['name']}*\n\n{product['description']}\n\nЦена: {product['price']} ₽",
-                parse_mode="Markdown",
-                reply_markup=keyboard
-            )
+            await show_text_screen(callback.message, caption, parse_mode="Markdown", reply_markup=keyboard)
         await callback.answer()
     except Exception as e:
         logger.error(f"Error in show_product: {e}")
@@ -350,7 +524,7 @@ async def show_product(callback: types.CallbackQuery):
 @dp.message(lambda message: message.text == "🛒 Корзина")
 async def show_cart(message: types.Message):
     try:
-        cart_items = get_cart_items(message.from_user.id)
+        cart_items = await get_cart_items(message.from_user.id)
         if not cart_items:
             await message.answer("Ваша корзина пуста")
             return
@@ -363,8 +537,8 @@ async def show_cart(message: types.Message):
         
         keyboard = InlineKeyboardMarkup(
             inline_keyboard=[
-                [InlineKeyboardButton(text="✅ Оформить заказ", callback_data="checkout")],
-                [InlineKeyboardButton(text="🗑 Очистить корзину", callback_data="clear_cart")]
+                [InlineKeyboardButton(text="✅ Оформить заказ", callback_data=pack("checkout"))],
+                [InlineKeyboardButton(text="🗑 Очистить корзину", callback_data=pack("clear_cart"))]
             ]
         )
         
@@ -373,66 +547,49 @@ async def show_cart(message: types.Message):
         logger.error(f"Error in show_cart: {e}")
         await message.answer("Произошла ошибка. Пожалуйста, попробуйте позже.")
 
+# Оформление заказа из корзины и уведомление администраторов
+async def place_order(callback: types.CallbackQuery):
+    # Заказ создается одной транзакцией и сразу возвращает сводку
+    order_details = await checkout(callback.from_user.id)
+    if not order_details:
+        await callback.message.answer("❌ Произошла ошибка при создании заказа")
+        return
+    
+    # Формируем сообщение о заказе
+    order_message = (
+        "🛒 Новый заказ!\n\n"
+        f"👤 Пользователь: {order_details['username']}\n"
+        f"🆔 ID: {order_details['user_id']}\n\n"
+        "📦 Товары:\n"
+    )
+    
+    for item in order_details['items']:
+        order_message += f"• {item['name']} x{item['quantity']} - {item['price']}₽\n"
+    
+    order_message += f"\n💰 Итого: {order_details['total']}₽"
+    
+    # Отправляем сообщение пользователю сразу, администраторов уведомляем в фоне
+    await callback.message.answer(
+        "✅ Заказ успешно оформлен!\n"
+        "Администратор свяжется с вами в ближайшее время."
+    )
+    run_in_background(notify_admins(order_message, bot))
+
 # Обработчик оформления заказа
-@dp.callback_query(F.data == "checkout")
+@callbacks.route('checkout')
 async def handle_checkout(callback: types.CallbackQuery):
     """Обработчик оформления заказа"""
     try:
-        # Создаем заказ
-        order_id = create_order(callback.from_user.id)
-        if not order_id:
-            await callback.message.answer("❌ Произошла ошибка при создании заказа")
-            return
-        
-        # Получаем детали заказа
-        order_details = get_order_details(order_id)
-        if not order_details:
-            await callback.message.answer("❌ Произошла ошибка при получении деталей заказа")
-            return
-        
-        # Формируем сообщение о заказе
-        order_message = (
-            "🛒 Новый заказ!\n\n"
-            f"👤 Пользователь: {order_details['username']}\n"
-            f"🆔 ID: {order_details['user_id']}\n\n"
-            "📦 Товары:\n"
-        )
-        
-        for item in order_details['items']:
-            order_message += f"• {item['name']} x{item['quantity']} - {item['price']}₽\n"
-        
-        order_message += f"\n💰 Итого: {order_details['total']}₽"
-        
-        # Получаем список ID администраторов
-        admin_ids = get_admin_ids()
-        logger.info(f"Sending order notification to admins: {admin_ids}")
-        
-        # Отправляем сообщение всем администраторам
-        for admin_id in admin_ids:
-            try:
-                await bot.send_message(admin_id, order_message)
-                logger.info(f"Order notification sent to admin {admin_id}")
-            except Exception as e:
-                logger.error(f"Error sending order notification to admin {admin_id}: {e}")
-        
-        # Отправляем сообщение пользователю
-        await callback.message.answer(
-            "✅ Заказ успешно оформлен!\n"
-            "Администратор свяжется с вами в ближайшее время."
-        )
-        
-        # Очищаем корзину
-        clear_cart(callback.from_user.id)
-        
+        await place_order(callback)
     except Exception as e:
         logger.error(f"Error in handle_checkout: {e}", exc_info=True)
         await callback.message.answer("❌ Произошла ошибка при оформлении заказа")
 
 # Обработчик очистки корзины
-@dp.callback_query(lambda c: c.data == "clear_cart")
+@callbacks.route('clear_cart')
 async def handle_clear_cart(callback: types.CallbackQuery):
     try:
-        if clear_cart(callback.from_user.id):
+        if await clear_cart(callback.from_user.id):
             await callback.message.answer("Корзина очищена")
         else:
             await callback.message.answer("Ваша корзина уже пуста")
@@ -452,7 +609,7 @@ async def show_payment(message: types.Message):
             "3️⃣ Наличными при встрече с менеджером\n\n"
             "📸 После оплаты отправьте скриншот чека менеджеру @Jmih_maneger\n\n"
             "⏳ Обработка заказа происходит в течение 15 минут",
-            reply_markup=get_main_keyboard()
+            reply_markup=MAIN_KEYBOARD
         )
     except Exception as e:
         logger.error(f"Error in show_payment: {e}")
@@ -474,7 +631,7 @@ async def show_about(message: types.Message):
             "• Профессиональная консультация\n\n"
             "💯 *Мы работаем для вас!*",
             parse_mode="Markdown",
-            reply_markup=get_main_keyboard()
+            reply_markup=MAIN_KEYBOARD
         )
     except Exception as e:
         logger.error(f"Error in show_about: {e}")
@@ -493,7 +650,7 @@ async def show_contacts(message: types.Message):
             "💬 *По всем вопросам обращайтесь к менеджеру*\n"
             "⏰ *Работаем круглосуточно*",
             parse_mode="Markdown",
-            reply_markup=get_main_keyboard()
+            reply_markup=MAIN_KEYBOARD
         )
     except Exception as e:
         logger.error(f"Error in show_contacts: {e}")
@@ -503,53 +660,46 @@ async def show_contacts(message: types.Message):
 @dp.message(lambda message: message.text == "🔙 В главное меню")
 async def back_to_main(message: types.Message):
     try:
-        await message.answer("Главное меню", reply_markup=get_main_keyboard())
+        await message.answer("Главное меню", reply_markup=MAIN_KEYBOARD)
     except Exception as e:
         logger.error(f"Error in back_to_main: {e}")
         await message.answer("Произошла ошибка. Пожалуйста, попробуйте позже.")
 
 # Обработчик команды /admin
-@dp.message(Command("admin"))
+@admin_router.message(Command("admin"))
 async def cmd_admin(message: types.Message):
     try:
-        if is_admin(message.from_user.id):
-            await message.answer(
-                "👨‍💼 Панель администратора\n\n"
-                "Выберите действие:",
-                reply_markup=get_admin_keyboard()
-            )
-        else:
-            await message.answer("У вас нет доступа к этой команде.")
+        await message.answer(
+            "👨‍💼 Панель администратора\n\n"
+            "Выберите действие:",
+            reply_markup=ADMIN_KEYBOARD
+        )
     except Exception as e:
         logger.error(f"Error in cmd_admin: {e}")
         await message.answer("Произошла ошибка. Пожалуйста, попробуйте позже.")
 
 # Обработчик кнопки "Добавить товар"
-@dp.message(F.text == "➕ Добавить товар")
+@admin_router.message(F.text == "➕ Добавить товар")
 async def add_product_start(message: types.Message, state: FSMContext):
-    if not is_admin(message.from_user.id):
-        await message.answer("❌ У вас нет доступа к этой команде")
-        return
-    
     await message.answer("Введите название товара:")
     await state.set_state(AddProduct.waiting_for_name)
 
 # Обработчик ввода названия товара
-@dp.message(AddProduct.waiting_for_name)
+@admin_router.message(AddProduct.waiting_for_name)
 async def process_product_name(message: types.Message, state: FSMContext):
     await state.update_data(name=message.text)
     await message.answer("Введите описание товара:")
     await state.set_state(AddProduct.waiting_for_description)
 
 # Обработчик ввода описания товара
-@dp.message(AddProduct.waiting_for_description)
+@admin_router.message(AddProduct.waiting_for_description)
 async def process_product_description(message: types.Message, state: FSMContext):
     await state.update_data(description=message.text)
     await message.answer("Введите цену товара (только число):")
     await state.set_state(AddProduct.waiting_for_price)
 
 # Обработчик ввода цены товара
-@dp.message(AddProduct.waiting_for_price)
+@admin_router.message(AddProduct.waiting_for_price)
 async def process_product_price(message: types.Message, state: FSMContext):
     try:
         # Удаляем все пробелы и заменяем запятую на точку
@@ -579,7 +729,7 @@ async def process_product_price(message: types.Message, state: FSMContext):
         await state.update_data(price=price)
         
         # Получаем список категорий
-        categories = get_categories()
+        categories = await get_category_list()
         if not categories:
             logger.error("No categories found")
             await message.answer("❌ Нет доступных категорий. Пожалуйста, добавьте категории через админ-панель.")
@@ -590,8 +740,8 @@ async def process_product_price(message: types.Message, state: FSMContext):
         keyboard_buttons = []
         for category in categories:
             keyboard_buttons.append([InlineKeyboardButton(
-                text=category,
-                callback_data=f"select_category_{category}"
+                text=category['name'],
+                callback_data=pack("select_category", category['id'])
             )])
         
         # Создаем клавиатуру
@@ -612,17 +762,24 @@ async def process_product_price(message: types.Message, state: FSMContext):
         await message.answer("❌ Произошла ошибка при обработке цены. Пожалуйста, попробуйте еще раз.")
 
 # Обработчик выбора категории
-@dp.callback_query(F.data.startswith('select_category_'))
-async def process_category_selection(callback_query: types.CallbackQuery, state: FSMContext):
+callbacks.legacy('select_category_', 'select_category:')(
+    lambda name: _legacy_category(name, action='select_category')
+)
+
+@callbacks.route('select_category', arity=1, admin=True)
+async def process_category_selection(callback_query: types.CallbackQuery, args: tuple, state: FSMContext):
     """Обработчик выбора категории товара"""
     try:
-        category = callback_query.data.replace('select_category_', '')
-        await state.update_data(category=category)
+        category = await get_category(args[0])
+        if category is None:
+            await callback_query.answer("Категория не найдена")
+            return
+        await state.update_data(category=category['name'])
         
         # Создаем клавиатуру с кнопками
         keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
-            [types.InlineKeyboardButton(text="📷 Добавить фото", callback_data="add_photo")],
-            [types.InlineKeyboardButton(text="⏩ Пропустить", callback_data="skip_photo")]
+            [types.InlineKeyboardButton(text="📷 Добавить фото", callback_data=pack("add_photo"))],
+            [types.InlineKeyboardButton(text="⏩ Пропустить", callback_data=pack("skip_photo"))]
         ])
         
         await callback_query.message.edit_text(
@@ -637,7 +794,7 @@ async def process_category_selection(callback_query: types.CallbackQuery, state:
         await callback_query.message.edit_text("❌ Произошла ошибка при выборе категории")
         await state.clear()
 
-@dp.callback_query(F.data == 'add_photo')
+@callbacks.route('add_photo', admin=True)
 async def add_photo(callback_query: types.CallbackQuery):
     """Обработчик добавления фото товара"""
     try:
@@ -647,7 +804,7 @@ async def add_photo(callback_query: types.CallbackQuery):
         logger.error(f"Error in add_photo handler: {e}")
         await callback_query.message.answer("❌ Произошла ошибка. Пожалуйста, попробуйте позже.")
 
-@dp.callback_query(F.data == 'skip_photo')
+@callbacks.route('skip_photo', admin=True)
 async def skip_photo(callback_query: types.CallbackQuery, state: FSMContext):
     """Обработчик пропуска добавления фото"""
     try:
@@ -657,13 +814,13 @@ async def skip_photo(callback_query: types.CallbackQuery, state: FSMContext):
         # Проверяем существование стандартной фотографии
         if not os.path.exists(DEFAULT_IMAGE):
             # Создаем директорию для изображений, если её нет
-            os.makedirs('images', exist_ok=True)
+            os.makedirs(IMAGE_DIR, exist_ok=True)
             # Создаем пустой файл для стандартной фотографии
             with open(DEFAULT_IMAGE, 'wb') as f:
                 f.write(b'')
         
         # Добавляем товар со стандартной фотографией
-        success = add_product(
+        success = await add_product(
             name=data['name'],
             description=data['description'],
             price=data['price'],
@@ -681,33 +838,20 @@ async def skip_photo(callback_query: types.CallbackQuery, state: FSMContext):
         logger.error(f"Error in skip_photo handler: {e}")
         await callback_query.message.answer("❌ Произошла ошибка. Пожалуйста, попробуйте позже.")
 
-@dp.message(F.photo, AddProduct.waiting_for_image)
+@admin_router.message(F.photo, AddProduct.waiting_for_image)
 async def process_product_image(message: types.Message, state: FSMContext):
     """Обработчик получения фото товара"""
+    file_path = None
     try:
-        # Создаем директорию для изображений, если её нет
-        if not os.path.exists('images'):
-            os.makedirs('images')
-            
-        # Получаем файл фото
-        photo = message.photo[-1]
-        file_info = await bot.get_file(photo.file_id)
-        downloaded_file = await bot.download_file(file_info.file_path)
-        
-        # Генерируем уникальное имя файла
-        file_extension = file_info.file_path.split('.')[-1]
-        file_name = f"product_{int(time.time())}.{file_extension}"
-        file_path = f"images/{file_name}"
-        
-        # Сохраняем фото
-        with open(file_path, 'wb') as new_file:
-            new_file.write(downloaded_file.getvalue())
+        # Скачиваем фото на диск, обрабатываем вне event loop и сохраняем по хешу
+        stored = await save_photo(bot, message.photo[-1])
+        file_path = stored['path']
             
         # Получаем данные о товаре из состояния
         data = await state.get_data()
         
         # Добавляем товар с фото
-        success = add_product(
+        success = await add_product(
             name=data['name'],
             description=data['description'],
             price=data['price'],
@@ -725,6 +869,10 @@ async def process_product_image(message: types.Message, state: FSMContext):
         logger.error(f"Error in process_product_image handler: {e}")
         await message.answer("❌ Произошла ошибка при сохранении фото. Пожалуйста, попробуйте позже.")
         await state.clear()
+    finally:
+        # Фото, которое не попало в товар, удаляется
+        if file_path:
+            await release_upload(file_path)
 
 # Обработчик отмены добавления товара
 @dp.message(Command("cancel"))
@@ -737,25 +885,17 @@ async def cmd_cancel(message: types.Message, state: FSMContext):
     await message.answer("❌ Добавление товара отменено")
 
 # Обработчик добавления товара в корзину
-@dp.callback_query(lambda c: c.data.startswith('add_'))
-async def add_to_cart(callback: types.CallbackQuery):
+@callbacks.route('add', arity=1)
+async def add_to_cart(callback: types.CallbackQuery, args: tuple):
     try:
-        product_id = int(callback.data[4:])  # Убираем префикс 'add_'
-        logger.info(f"Attempting to add product {product_id} to cart for user {callback.from_user.id}")
-        
-        product = get_product_by_id(product_id)
-        if not product:
-            logger.error(f"Product {product_id} not found")
-            await callback.answer("❌ Товар не найден", show_alert=True)
-            return
-            
+        product_id = args[0]
         user_id = callback.from_user.id
         logger.info(f"Adding product {product_id} to cart for user {user_id}")
         
         try:
-            add_to_cart_db(user_id, product_id)
+            quantity = await add_to_cart_db(user_id, product_id)
             logger.info(f"Successfully added product {product_id} to cart")
-            await callback.answer("✅ Товар добавлен в корзину")
+            await callback.answer(f"✅ Товар добавлен в корзину (в корзине: {quantity} шт.)")
         except ValueError as e:
             logger.error(f"Error adding to cart: {str(e)}")
             await callback.answer(str(e), show_alert=True)
@@ -768,22 +908,29 @@ async def add_to_cart(callback: types.CallbackQuery):
         await callback.answer("❌ Произошла ошибка. Пожалуйста, попробуйте позже.", show_alert=True)
 
 # Обработчик команды /backup
-@dp.message(Command("backup"))
+@admin_router.message(Command("backup"))
 async def cmd_backup(message: types.Message):
-    if not is_admin(message.from_user.id):
-        await message.answer("❌ У вас нет доступа к этой команде")
-        return
-    
     try:
         # Создаем директорию для бэкапов, если её нет
         os.makedirs("backups", exist_ok=True)
         
+        # Формат задается аргументами: /backup [ndjson] [gz]
+        args = (message.text or '').split()[1:]
+        fmt = 'ndjson' if 'ndjson' in args else 'json'
+        compress = 'gz' in args
+        
         # Используем фиксированное имя файла
-        backup_file = "backups/products_backup.json"
+        backup_file = f"backups/products_backup.{fmt}" + (".gz" if compress else "")
         
         # Экспортируем товары
-        if export_products(backup_file):
-            await message.answer(f"✅ Резервная копия успешно создана: {backup_file}")
+        stats = await export_products(backup_file, fmt=fmt, compress=compress)
+        if stats:
+            rate = stats['rows'] / stats['seconds'] if stats['seconds'] else stats['rows']
+            await message.answer(
+                f"✅ Резервная копия успешно создана: {backup_file}\n"
+                f"📦 Товаров: {stats['rows']}, размер: {stats['bytes']} байт\n"
+                f"⚡ Скорость: {rate:.0f} товаров/с"
+            )
         else:
             await message.answer("❌ Не удалось создать резервную копию")
             
@@ -792,98 +939,129 @@ async def cmd_backup(message: types.Message):
         await message.answer("❌ Произошла ошибка при создании резервной копии")
 
 # Обработчик кнопки "Статистика"
-@dp.message(F.text == "📊 Статистика")
+@admin_router.message(F.text == "📊 Статистика")
 async def show_statistics(message: types.Message):
     """Обработчик кнопки статистики"""
-    if not is_admin(message.from_user.id):
-        await message.answer("❌ У вас нет доступа к этой команде")
-        return
-    
     try:
         # Получаем статистику из базы данных
-        with session_scope() as session:
-            # Количество товаров
-            total_products = session.query(Product).count()
-            
-            # Количество категорий
-            total_categories = session.query(Category).count()
-            
-            # Количество пользователей
-            total_users = session.query(User).count()
-            
-            # Количество заказов
-            total_orders = session.query(Order).count()
-            
-            # Популярные категории
-            popular_categories = session.query(
-                Category.name,
-                func.count(Product.id).label('product_count')
-            ).join(Product).group_by(Category.name).order_by(func.count(Product.id).desc()).limit(5).all()
-            
-            # Формируем сообщение
-            stats_message = (
-                "📊 Статистика магазина:\n\n"
-                f"📦 Всего товаров: {total_products}\n"
-                f"📁 Категорий: {total_categories}\n"
-                f"👥 Пользователей: {total_users}\n"
-                f"🛒 Заказов: {total_orders}\n\n"
-                "🔥 Популярные категории:\n"
-            )
-            
-            for category, count in popular_categories:
-                stats_message += f"• {category}: {count} товаров\n"
-            
-            await message.answer(stats_message)
+        stats = await get_statistics()
+        
+        # Формируем сообщение
+        stats_message = (
+            "📊 Статистика магазина:\n\n"
+            f"📦 Всего товаров: {stats['total_products']}\n"
+            f"📁 Категорий: {stats['total_categories']}\n"
+            f"👥 Пользователей: {stats['total_users']}\n"
+            f"🛒 Заказов: {stats['total_orders']}\n\n"
+            "🔥 Популярные категории:\n"
+        )
+        
+        for category, count in stats['popular_categories']:
+            stats_message += f"• {category}: {count} товаров\n"
+        
+        cache = stats['catalog_cache']
+        stats_message += (
+            f"\n⚡ Кэш каталога: версия {cache['version']}, "
+            f"попаданий {cache['hits']}, промахов {cache['misses']}, "
+            f"перестроений {cache['rebuilds']}"
+        )
+        screens = catalog_screens.metrics()
+        stats_message += (
+            f"\n🧩 Экраны каталога: версия {screens['version']}, страниц {screens['pages']}, "
+            f"попаданий {screens['hits']}, промахов {screens['misses']}, пересборок {screens['rebuilds']}"
+        )
+        users = user_registry.metrics()
+        stats_message += (
+            f"\n👥 Реестр пользователей: известно {users['known']}, в очереди {users['pending']}, "
+            f"повторных входов без записи {users['skipped']}, записано {users['flushed_rows']} "
+            f"за {users['flushed_batches']} пакетов"
+        )
+        fsm = fsm_storage.metrics()
+        stats_message += (
+            f"\n💾 Состояния диалогов: в памяти {fsm['cached']}, сохранено {fsm['saved']}, "
+            f"попаданий {fsm['hits']}, загрузок {fsm['loads']}, устарело {fsm['expired']}, "
+            f"записано {fsm['flushed_records']} за {fsm['flushed_batches']} пакетов"
+        )
+        media = stats['media_cache']
+        stats_message += (
+            f"\n🖼 Кэш file_id: файлов {media['files']}, "
+            f"попаданий {media['hits']}, загрузок {media['misses']}"
+        )
+        queue = send_scheduler.metrics()
+        stats_message += (
+            f"\n📤 Очередь отправки: в очереди {queue['queued']}, ждут лимита чата {queue['chat_waiting']}, "
+            f"отправлено {queue['sent']}, повторов {queue['retries']}, ошибок {queue['failed']}\n"
+            f"⏱ Ожидание: ответы {queue['waits']['interactive']['avg_wait'] * 1000:.0f} мс "
+            f"(макс. {queue['waits']['interactive']['max_wait'] * 1000:.0f}), "
+            f"рассылки {queue['waits']['bulk']['avg_wait'] * 1000:.0f} мс "
+            f"(макс. {queue['waits']['bulk']['max_wait'] * 1000:.0f})"
+        )
+        
+        await message.answer(stats_message)
             
     except Exception as e:
         logger.error(f"Error in show_statistics: {e}", exc_info=True)
         await message.answer("❌ Произошла ошибка при получении статистики")
 
 # Обработчик кнопки "Редактировать товар"
-@dp.message(F.text == "📝 Редактировать товар")
+@admin_router.message(F.text == "📝 Редактировать товар")
 async def edit_product_start(message: types.Message):
     """Обработчик кнопки редактирования товара"""
-    if not is_admin(message.from_user.id):
-        await message.answer("❌ У вас нет доступа к этой команде")
-        return
-    
     try:
         # Получаем список всех товаров
-        products = get_products()
+        products = await get_products()
         if not products:
             await message.answer("❌ В базе нет товаров для редактирования")
             return
         
-        # Создаем клавиатуру с товарами
-        keyboard_buttons = []
-        for product in products:
-            keyboard_buttons.append([InlineKeyboardButton(
-                text=f"{product['name']} - {product['price']} руб.",
-                callback_data=f"edit_{product['id']}"
-            )])
-        
-        keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
-        await message.answer("Выберите товар для редактирования:", reply_markup=keyboard)
+        await message.answer("Выберите товар для редактирования:", reply_markup=get_edit_products_keyboard(products))
         
     except Exception as e:
         logger.error(f"Error in edit_product_start: {e}", exc_info=True)
         await message.answer("❌ Произошла ошибка при получении списка товаров")
 
-@dp.callback_query(F.data.startswith("edit_"))
-async def edit_product(callback_query: types.CallbackQuery, state: FSMContext):
+# Клавиатура выбора товара для редактирования
+def get_edit_products_keyboard(products):
+    keyboard_buttons = []
+    for product in products:
+        keyboard_buttons.append([InlineKeyboardButton(
+            text=f"{product['name']} - {product['price']} руб.",
+            callback_data=pack("edit", product['id'])
+        )])
+    return InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
+
+@callbacks.route('back_to_products', admin=True)
+async def back_to_products(callback_query: types.CallbackQuery, state: FSMContext):
+    """Обработчик кнопки возврата к списку товаров для редактирования"""
+    try:
+        await state.clear()
+        products = await get_products()
+        if not products:
+            await callback_query.message.edit_text("❌ В базе нет товаров для редактирования")
+            return
+        await callback_query.message.edit_text(
+            "Выберите товар для редактирования:",
+            reply_markup=get_edit_products_keyboard(products)
+        )
+        await callback_query.answer()
+    except Exception as e:
+        logger.error(f"Error in back_to_products: {e}", exc_info=True)
+        await callback_query.answer("❌ Произошла ошибка при получении списка товаров")
+
+@callbacks.route('edit', arity=1, admin=True)
+@callbacks.route('edit_name', arity=1, admin=True)
+@callbacks.route('edit_desc', arity=1, admin=True)
+@callbacks.route('edit_price', arity=1, admin=True)
+@callbacks.route('edit_image', arity=1, admin=True)
+async def edit_product(callback_query: types.CallbackQuery, args: tuple, action: str, state: FSMContext):
     """Обработчик редактирования товара"""
     try:
-        # Получаем ID товара и тип редактирования из callback_data
-        data = callback_query.data.replace('edit_', '')
-        if '_' in data:
-            product_id = int(data.split('_')[1])
-            edit_type = data.split('_')[0]
-        else:
-            product_id = int(data)
-            edit_type = None
+        # Поле для редактирования задается действием: edit_name, edit_desc и т.д.
+        product_id = args[0]
+        edit_type = action[len('edit_'):] or None
             
         # Получаем информацию о товаре
-        product = get_product_by_id(product_id)
+        product = await get_product_by_id(product_id)
         if not product:
             await callback_query.answer("❌ Товар не найден")
             return
@@ -918,14 +1096,14 @@ async def edit_product(callback_query: types.CallbackQuery, state: FSMContext):
             # Если тип редактирования не указан, показываем меню выбора
             keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
                 [
-                    types.InlineKeyboardButton(text="✏️ Название", callback_data=f"edit_name_{product_id}"),
-                    types.InlineKeyboardButton(text="📝 Описание", callback_data=f"edit_desc_{product_id}")
+                    types.InlineKeyboardButton(text="✏️ Название", callback_data=pack("edit_name", product_id)),
+                    types.InlineKeyboardButton(text="📝 Описание", callback_data=pack("edit_desc", product_id))
                 ],
                 [
-                    types.InlineKeyboardButton(text="💰 Цена", callback_data=f"edit_price_{product_id}"),
-                    types.InlineKeyboardButton(text="📷 Изображение", callback_data=f"edit_image_{product_id}")
+                    types.InlineKeyboardButton(text="💰 Цена", callback_data=pack("edit_price", product_id)),
+                    types.InlineKeyboardButton(text="📷 Изображение", callback_data=pack("edit_image", product_id))
                 ],
-                [types.InlineKeyboardButton(text="◀️ Назад", callback_data="back_to_products")]
+                [types.InlineKeyboardButton(text="◀️ Назад", callback_data=pack("back_to_products"))]
             ])
             await callback_query.message.edit_text(
                 f"✏️ Редактирование товара: {product['name']}\n"
@@ -937,78 +1115,14 @@ async def edit_product(callback_query: types.CallbackQuery, state: FSMContext):
         logger.error(f"Error in edit_product: {e}", exc_info=True)
         await callback_query.answer("❌ Произошла ошибка при редактировании товара")
 
-@dp.callback_query(F.data.startswith('edit_name_'))
-async def edit_product_name(callback_query: types.CallbackQuery, state: FSMContext):
-    """Обработчик редактирования названия товара"""
-    try:
-        product_id = int(callback_query.data.replace('edit_name_', ''))
-        await state.set_state(EditProduct.waiting_for_name)
-        await state.update_data(product_id=product_id)
-        
-        await callback_query.message.edit_text(
-            "✏️ Введите новое название товара:"
-        )
-        
-    except Exception as e:
-        logger.error(f"Error in edit_product_name: {e}", exc_info=True)
-        await callback_query.answer("❌ Произошла ошибка при редактировании")
-
-@dp.callback_query(F.data.startswith('edit_desc_'))
-async def edit_product_description(callback_query: types.CallbackQuery, state: FSMContext):
-    """Обработчик редактирования описания товара"""
-    try:
-        product_id = int(callback_query.data.replace('edit_desc_', ''))
-        await state.set_state(EditProduct.waiting_for_description)
-        await state.update_data(product_id=product_id)
-        
-        await callback_query.message.edit_text(
-            "📝 Введите новое описание товара:"
-        )
-        
-    except Exception as e:
-        logger.error(f"Error in edit_product_description: {e}", exc_info=True)
-        await callback_query.answer("❌ Произошла ошибка при редактировании")
-
-@dp.callback_query(F.data.startswith('edit_price_'))
-async def edit_product_price(callback_query: types.CallbackQuery, state: FSMContext):
-    """Обработчик редактирования цены товара"""
-    try:
-        product_id = int(callback_query.data.replace('edit_price_', ''))
-        await state.set_state(EditProduct.waiting_for_price)
-        await state.update_data(product_id=product_id)
-        
-        await callback_query.message.edit_text(
-            "💰 Введите новую цену товара (только число):"
-        )
-        
-    except Exception as e:
-        logger.error(f"Error in edit_product_price: {e}", exc_info=True)
-        await callback_query.answer("❌ Произошла ошибка при редактировании")
-
-@dp.callback_query(F.data.startswith('edit_image_'))
-async def edit_product_image(callback_query: types.CallbackQuery, state: FSMContext):
-    """Обработчик редактирования изображения товара"""
-    try:
-        product_id = int(callback_query.data.replace('edit_image_', ''))
-        await state.set_state(EditProduct.waiting_for_image)
-        await state.update_data(product_id=product_id)
-        
-        await callback_query.message.edit_text(
-            "📷 Отправьте новое изображение товара:"
-        )
-        
-    except Exception as e:
-        logger.error(f"Error in edit_product_image: {e}", exc_info=True)
-        await callback_query.answer("❌ Произошла ошибка при редактировании")
-
-@dp.message(EditProduct.waiting_for_name)
+@admin_router.message(EditProduct.waiting_for_name)
 async def process_edit_name(message: types.Message, state: FSMContext):
     """Обработчик ввода нового названия товара"""
     try:
         data = await state.get_data()
         product_id = data['product_id']
         
-        if update_product(product_id, name=message.text):
+        if await update_product(product_id, name=message.text):
             await message.answer("✅ Название товара успешно обновлено")
         else:
             await message.answer("❌ Не удалось обновить название товара")
@@ -1020,14 +1134,14 @@ async def process_edit_name(message: types.Message, state: FSMContext):
         await message.answer("❌ Произошла ошибка при обновлении названия")
         await state.clear()
 
-@dp.message(EditProduct.waiting_for_description)
+@admin_router.message(EditProduct.waiting_for_description)
 async def process_edit_description(message: types.Message, state: FSMContext):
     """Обработчик ввода нового описания товара"""
     try:
         data = await state.get_data()
         product_id = data['product_id']
         
-        if update_product(product_id, description=message.text):
+        if await update_product(product_id, description=message.text):
             await message.answer("✅ Описание товара успешно обновлено")
         else:
             await message.answer("❌ Не удалось обновить описание товара")
@@ -1039,7 +1153,7 @@ async def process_edit_description(message: types.Message, state: FSMContext):
         await message.answer("❌ Произошла ошибка при обновлении описания")
         await state.clear()
 
-@dp.message(EditProduct.waiting_for_price)
+@admin_router.message(EditProduct.waiting_for_price)
 async def process_edit_price(message: types.Message, state: FSMContext):
     """Обработчик ввода новой цены товара"""
     try:
@@ -1053,7 +1167,7 @@ async def process_edit_price(message: types.Message, state: FSMContext):
             await message.answer("❌ Пожалуйста, введите число")
             return
             
-        if update_product(product_id, price=price):
+        if await update_product(product_id, price=price):
             await message.answer("✅ Цена товара успешно обновлена")
         else:
             await message.answer("❌ Не удалось обновить цену товара")
@@ -1065,35 +1179,20 @@ async def process_edit_price(message: types.Message, state: FSMContext):
         await message.answer("❌ Произошла ошибка при обновлении цены")
         await state.clear()
 
-@dp.message(EditProduct.waiting_for_image, F.photo)
+@admin_router.message(EditProduct.waiting_for_image, F.photo)
 async def process_edit_image(message: types.Message, state: FSMContext):
     """Обработчик загрузки нового изображения товара"""
+    filepath = None
     try:
         data = await state.get_data()
         product_id = data['product_id']
         
-        # Создаем директорию для изображений, если её нет
-        os.makedirs('product_images', exist_ok=True)
-        
-        # Получаем файл изображения
-        photo = message.photo[-1]
-        file_id = photo.file_id
-        file = await message.bot.get_file(file_id)
-        file_path = file.file_path
-        
-        # Скачиваем изображение
-        downloaded_file = await message.bot.download_file(file_path)
-        
-        # Генерируем уникальное имя файла
-        filename = f"product_{product_id}_{int(time.time())}.jpg"
-        filepath = os.path.join('product_images', filename)
-        
-        # Сохраняем изображение
-        with open(filepath, 'wb') as new_file:
-            new_file.write(downloaded_file.getvalue())
+        # Скачиваем изображение на диск, обрабатываем вне event loop и сохраняем по хешу
+        stored = await save_photo(message.bot, message.photo[-1])
+        filepath = stored['path']
             
         # Обновляем путь к изображению в базе данных
-        if update_product(product_id, image_path=filepath):
+        if await update_product(product_id, image_path=filepath):
             await message.answer("✅ Изображение товара успешно обновлено")
         else:
             await message.answer("❌ Не удалось обновить изображение товара")
@@ -1104,50 +1203,29 @@ async def process_edit_image(message: types.Message, state: FSMContext):
         logger.error(f"Error in process_edit_image: {e}", exc_info=True)
         await message.answer("❌ Произошла ошибка при обновлении изображения")
         await state.clear()
+    finally:
+        # Фото, которое не попало в товар, удаляется
+        if filepath:
+            await release_upload(filepath)
 
 async def delete_product_from_db(product_id: int) -> bool:
     """Удаление товара из базы данных"""
     try:
-        with session_scope() as session:
-            # Получаем товар
-            product = session.query(Product).filter_by(id=product_id).first()
-            if not product:
-                logger.error(f"Product {product_id} not found")
-                return False
-                
-            # Удаляем связанные записи в корзинах
-            session.query(CartItem).filter_by(product_id=product_id).delete()
-            
-            # Удаляем связанные записи в заказах
-            session.query(OrderItem).filter_by(product_id=product_id).delete()
-            
-            # Удаляем изображение товара, если оно существует
-            if product.image_path and os.path.exists(product.image_path):
-                try:
-                    os.remove(product.image_path)
-                    logger.info(f"Deleted image file: {product.image_path}")
-                except Exception as e:
-                    logger.error(f"Error deleting image file: {e}")
-            
-            # Удаляем товар из базы данных
-            session.delete(product)
-            logger.info(f"Product {product_id} deleted successfully")
-            return True
-            
+        return await delete_product(product_id)
     except Exception as e:
         logger.error(f"Error deleting product: {e}", exc_info=True)
         return False
 
-@dp.callback_query(F.data.startswith('delete_'))
-async def handle_delete_product(callback_query: types.CallbackQuery):
+@callbacks.route('delete', arity=1, admin=True)
+async def handle_delete_product(callback_query: types.CallbackQuery, args: tuple):
     """Обработчик кнопки удаления товара"""
     try:
-        product_id = int(callback_query.data.replace('delete_', ''))
+        product_id = args[0]
         
         # Создаем клавиатуру с подтверждением удаления
         keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="✅ Да, удалить", callback_data=f"confirm_delete_{product_id}")],
-            [InlineKeyboardButton(text="❌ Отмена", callback_data="cancel_delete")]
+            [InlineKeyboardButton(text="✅ Да, удалить", callback_data=pack("confirm_delete", product_id))],
+            [InlineKeyboardButton(text="❌ Отмена", callback_data=pack("cancel_delete"))]
         ])
         
         await callback_query.message.edit_text(
@@ -1159,11 +1237,11 @@ async def handle_delete_product(callback_query: types.CallbackQuery):
         logger.error(f"Error in handle_delete_product: {e}", exc_info=True)
         await callback_query.answer("❌ Произошла ошибка при удалении")
 
-@dp.callback_query(F.data.startswith('confirm_delete_'))
-async def confirm_delete(callback_query: types.CallbackQuery):
+@callbacks.route('confirm_delete', arity=1, admin=True)
+async def confirm_delete(callback_query: types.CallbackQuery, args: tuple):
     """Обработчик подтверждения удаления товара"""
     try:
-        product_id = int(callback_query.data.replace('confirm_delete_', ''))
+        product_id = args[0]
         
         # Удаляем товар из базы данных
         success = await delete_product_from_db(product_id)
@@ -1176,7 +1254,7 @@ async def confirm_delete(callback_query: types.CallbackQuery):
         logger.error(f"Error in confirm_delete: {e}", exc_info=True)
         await callback_query.answer("❌ Произошла ошибка при удалении")
 
-@dp.callback_query(F.data == "cancel_delete")
+@callbacks.route('cancel_delete', admin=True)
 async def cancel_delete(callback_query: types.CallbackQuery):
     """Обработчик отмены удаления товара"""
     try:
@@ -1185,7 +1263,7 @@ async def cancel_delete(callback_query: types.CallbackQuery):
         logger.error(f"Error in cancel_delete: {e}", exc_info=True)
         await callback_query.answer("❌ Произошла ошибка при отмене удаления")
 
-@dp.message(AddProduct.waiting_for_category)
+@admin_router.message(AddProduct.waiting_for_category)
 async def process_product_category(message: types.Message, state: FSMContext):
     """Обработчик выбора категории товара"""
     try:
@@ -1194,8 +1272,8 @@ async def process_product_category(message: types.Message, state: FSMContext):
         
         # Создаем клавиатуру с кнопками
         keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
-            [types.InlineKeyboardButton(text="📷 Добавить фото", callback_data="add_photo")],
-            [types.InlineKeyboardButton(text="⏩ Пропустить", callback_data="skip_photo")]
+            [types.InlineKeyboardButton(text="📷 Добавить фото", callback_data=pack("add_photo"))],
+            [types.InlineKeyboardButton(text="⏩ Пропустить", callback_data=pack("skip_photo"))]
         ])
         
         await message.answer(
@@ -1210,16 +1288,12 @@ async def process_product_category(message: types.Message, state: FSMContext):
         await state.clear()
 
 # Обработчик кнопки удаления товара
-@dp.message(F.text == "🗑 Удалить товар")
+@admin_router.message(F.text == "🗑 Удалить товар")
 async def delete_product_start(message: types.Message):
     """Обработчик кнопки удаления товара"""
-    if not is_admin(message.from_user.id):
-        await message.answer("❌ У вас нет доступа к этой команде")
-        return
-    
     try:
         # Получаем список всех товаров
-        products = get_products()
+        products = await get_products()
         if not products:
             await message.answer("❌ В базе нет товаров для удаления")
             return
@@ -1229,7 +1303,7 @@ async def delete_product_start(message: types.Message):
         for product in products:
             keyboard_buttons.append([InlineKeyboardButton(
                 text=f"{product['name']} - {product['price']} руб.",
-                callback_data=f"delete_{product['id']}"
+                callback_data=pack("delete", product['id'])
             )])
         
         keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
@@ -1244,7 +1318,7 @@ async def delete_product_start(message: types.Message):
 async def cmd_update_admin(message: types.Message):
     """Обновление статуса администратора"""
     try:
-        if update_admin_status(message.from_user.id):
+        if await update_admin_status(message.from_user.id):
             await message.answer("✅ Статус администратора обновлен")
         else:
             await message.answer("❌ Пользователь не найден в базе данных")
@@ -1252,70 +1326,47 @@ async def cmd_update_admin(message: types.Message):
         logger.error(f"Error in update_admin command: {e}")
         await message.answer("❌ Произошла ошибка при обновлении статуса")
 
-@dp.callback_query(F.data == "confirm_order")
+@callbacks.route('confirm_order')
 async def confirm_order(callback: types.CallbackQuery):
     """Подтверждение заказа"""
     try:
-        # Создаем заказ
-        order_id = create_order(callback.from_user.id)
-        if not order_id:
-            await callback.message.answer("❌ Произошла ошибка при создании заказа")
-            return
-        
-        # Получаем детали заказа
-        order_details = get_order_details(order_id)
-        if not order_details:
-            await callback.message.answer("❌ Произошла ошибка при получении деталей заказа")
-            return
-        
-        # Формируем сообщение о заказе
-        order_message = (
-            "🛒 Новый заказ!\n\n"
-            f"👤 Пользователь: {order_details['username']}\n"
-            f"🆔 ID: {order_details['user_id']}\n\n"
-            "📦 Товары:\n"
-        )
-        
-        for item in order_details['items']:
-            order_message += f"• {item['name']} x{item['quantity']} - {item['price']}₽\n"
-        
-        order_message += f"\n💰 Итого: {order_details['total']}₽"
-        
-        # Получаем список ID администраторов
-        admin_ids = get_admin_ids()
-        logger.info(f"Sending order notification to admins: {admin_ids}")
-        
-        # Отправляем сообщение всем администраторам
-        for admin_id in admin_ids:
-            try:
-                await bot.send_message(admin_id, order_message)
-                logger.info(f"Order notification sent to admin {admin_id}")
-            except Exception as e:
-                logger.error(f"Error sending order notification to admin {admin_id}: {e}")
-        
-        # Отправляем сообщение пользователю
-        await callback.message.answer(
-            "✅ Заказ успешно оформлен!\n"
-            "Администратор свяжется с вами в ближайшее время."
-        )
-        
-        # Очищаем корзину
-        clear_cart(callback.from_user.id)
-        
+        await place_order(callback)
     except Exception as e:
         logger.error(f"Error in confirm_order: {e}", exc_info=True)
         await callback.message.answer("❌ Произошла ошибка при оформлении заказа")
 
+# Сколько уведомлений администраторам отправлять одновременно
+ADMIN_NOTIFY_CONCURRENCY = 5
+
+# Ссылки на фоновые задачи, чтобы их не собрал сборщик мусора
+background_tasks = set()
+
+def run_in_background(coro):
+    """Запуск корутины фоновой задачей, не задерживая обработчик"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
 async def notify_admins(message: str, bot: Bot):
-    """Отправка уведомления всем администраторам"""
+    """Отправка уведомления всем администраторам
+
+    Уведомления отправляются параллельно, не больше ADMIN_NOTIFY_CONCURRENCY
+    одновременно; список администраторов берется из памяти.
+    """
     try:
-        admin_ids = get_admin_ids()
-        for admin_id in admin_ids:
-            try:
-                await bot.send_message(admin_id, message)
-                logger.info(f"Notification sent to admin {admin_id}")
-            except Exception as e:
-                logger.error(f"Error sending notification to admin {admin_id}: {e}")
+        admin_ids = await get_admin_ids()
+        semaphore = asyncio.Semaphore(ADMIN_NOTIFY_CONCURRENCY)
+        
+        async def send(admin_id):
+            async with semaphore:
+                try:
+                    await bot.send_message(admin_id, message)
+                    logger.info(f"Notification sent to admin {admin_id}")
+                except Exception as e:
+                    logger.error(f"Error sending notification to admin {admin_id}: {e}")
+        
+        await asyncio.gather(*(send(admin_id) for admin_id in admin_ids))
     except Exception as e:
         logger.error(f"Error in notify_admins: {e}")
 
@@ -1328,8 +1379,8 @@ async def backup_database():
         # Создаем имя файла с текущей датой и временем
         backup_filename = f"backups/shop_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db"
         
-        # Копируем файл базы данных
-        shutil.copy2("shop.db", backup_filename)
+        # Копируем базу данных (с учетом журнала WAL)
+        await run_blocking(backup_database_file, backup_filename)
         
         # Удаляем старые бэкапы (оставляем только последние 5)
         backup_files = sorted(glob.glob("backups/shop_*.db"))
@@ -1344,13 +1395,9 @@ async def backup_database():
         return False
 
 # Обработчик кнопки "📢 Рассылка"
-@dp.message(F.text == "📢 Рассылка")
+@admin_router.message(F.text == "📢 Рассылка")
 async def broadcast_start(message: types.Message, state: FSMContext):
     """Начало процесса массовой рассылки"""
-    if not is_admin(message.from_user.id):
-        await message.answer("❌ У вас нет доступа к этой команде")
-        return
-    
     await message.answer(
         "📢 Отправьте сообщение для рассылки всем пользователям.\n\n"
         "⚠️ Поддерживаются все типы сообщений (текст, фото, видео и т.д.)\n"
@@ -1359,59 +1406,19 @@ async def broadcast_start(message: types.Message, state: FSMContext):
     await state.set_state(BroadcastStates.waiting_for_message)
 
 # Обработчик сообщения для рассылки
-@dp.message(BroadcastStates.waiting_for_message)
+@admin_router.message(BroadcastStates.waiting_for_message)
 async def process_broadcast_message(message: types.Message, state: FSMContext):
-    """Обработка сообщения для массовой рассылки"""
+    """Обработка сообщения для массовой рассылки
+
+    Рассылка выполняется в фоне (см. broadcast.py), прогресс администратор
+    видит в отдельном сообщении.
+    """
     try:
-        # Получаем список всех пользователей
-        user_ids = get_all_users()
-        total_users = len(user_ids)
-        successful_sends = 0
-        failed_sends = 0
+        if not (message.text or message.photo or message.video or message.document):
+            await message.answer("❌ Этот тип сообщения не поддерживается для рассылки")
+            return
         
-        # Отправляем сообщение о начале рассылки
-        await message.answer(f"📢 Начинаю рассылку для {total_users} пользователей...")
-        
-        # Отправляем сообщение каждому пользователю
-        for user_id in user_ids:
-            try:
-                # Копируем сообщение с сохранением всех атрибутов
-                if message.photo:
-                    await bot.send_photo(
-                        user_id,
-                        message.photo[-1].file_id,
-                        caption=message.caption if message.caption else None
-                    )
-                elif message.video:
-                    await bot.send_video(
-                        user_id,
-                        message.video.file_id,
-                        caption=message.caption if message.caption else None
-                    )
-                elif message.document:
-                    await bot.send_document(
-                        user_id,
-                        message.document.file_id,
-                        caption=message.caption if message.caption else None
-                    )
-                else:
-                    await bot.send_message(
-                        user_id,
-                        message.text
-                    )
-                successful_sends += 1
-            except Exception as e:
-                logger.error(f"Error sending broadcast to user {user_id}: {e}")
-                failed_sends += 1
-        
-        # Отправляем отчет о результатах рассылки
-        report_message = (
-            "📊 Отчет о рассылке:\n\n"
-            f"👥 Всего пользователей: {total_users}\n"
-            f"✅ Успешно отправлено: {successful_sends}\n"
-            f"❌ Не удалось отправить: {failed_sends}"
-        )
-        await message.answer(report_message)
+        await start_broadcast(bot, message)
         
     except Exception as e:
         logger.error(f"Error in broadcast process: {e}")
@@ -1422,6 +1429,16 @@ async def process_broadcast_message(message: types.Message, state: FSMContext):
 
 # Запуск бота
 async def main():
+    # Без общего секрета webhook не запускаем
+    if RUN_MODE == 'webhook':
+        check_webhook_config()
+    
+    # Собираем экраны каталога и подписываемся на его изменения
+    catalog_screens.start()
+    # Загружаем известных пользователей и сохраненные состояния диалогов
+    await user_registry.start()
+    await fsm_storage.start()
+    
     # Создаем резервную копию базы данных
     if await backup_database():
         logger.info("Database backup created successfully")
@@ -1431,9 +1448,21 @@ async def main():
     # Отправляем уведомление администраторам о запуске бота
     await notify_admins("🤖 Бот запущен и готов к работе!", bot)
     
-    # Запускаем бота
-    await dp.start_polling(bot)
+    # Продолжаем рассылки, прерванные перезапуском
+    await resume_broadcasts(bot)
+    
+    # Запускаем бота: webhook или long polling
+    try:
+        if RUN_MODE == 'webhook':
+            await run_webhook(dp, bot)
+        else:
+            # Снимаем webhook, иначе Telegram не отдаст обновления через getUpdates
+            await bot.delete_webhook(drop_pending_updates=DROP_PENDING_UPDATES)
+            await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+    finally:
+        # Записываем пользователей и состояния диалогов, которые еще в очереди
+        await user_registry.close()
+        await fsm_storage.close()
 
 if __name__ == "__main__":
-    import asyncio
     asyncio.run(main()) 
\ No newline at end of file
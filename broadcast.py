@@ -0,0 +1,180 @@
+"""Массовая рассылка сообщений пользователям.
+
+Задание рассылки и позиция (users.id последнего обработанного получателя)
+хранятся в таблице broadcasts, поэтому после перезапуска бота рассылка
+продолжается с сохраненного места. Получатели обрабатываются порциями:
+сообщения внутри порции отправляются параллельно, общая частота ограничена
+ведром токенов, а ответ RetryAfter приостанавливает все отправки.
+Администратор видит прогресс в одном сообщении, которое редактируется.
+"""
+import asyncio
+import logging
+import os
+import time
+
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+
+from async_db import create_broadcast, get_active_broadcasts, get_broadcast_recipients, save_broadcast_progress
+from ratelimit import TokenBucket
+from send_queue import bulk_sends
+
+logger = logging.getLogger(__name__)
+
+# Сообщений в секунду (Telegram допускает около 30)
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', '25'))
+# Получателей в одной порции; позиция сохраняется после каждой порции
+BROADCAST_CHUNK_SIZE = 100
+# Попыток отправки одному получателю при сетевых ошибках
+BROADCAST_ATTEMPTS = 3
+# Как часто обновлять сообщение с прогрессом (секунды)
+PROGRESS_INTERVAL = 3
+
+# Общее ведро токенов для всех рассылок
+_bucket = TokenBucket(BROADCAST_RATE)
+# Ссылки на запущенные задачи, чтобы их не собрал сборщик мусора
+_tasks = set()
+
+
+async def _send(bot, broadcast, chat_id):
+    """Отправка сообщения рассылки одному получателю"""
+    caption = broadcast['text'] or None
+    if broadcast['content_type'] == 'photo':
+        await bot.send_photo(chat_id, broadcast['file_id'], caption=caption)
+    elif broadcast['content_type'] == 'video':
+        await bot.send_video(chat_id, broadcast['file_id'], caption=caption)
+    elif broadcast['content_type'] == 'document':
+        await bot.send_document(chat_id, broadcast['file_id'], caption=caption)
+    else:
+        await bot.send_message(chat_id, broadcast['text'])
+
+
+async def _deliver(bot, broadcast, chat_id):
+    """Отправка с учетом лимитов; возвращает True при успехе"""
+    attempt = 0
+    while True:
+        await _bucket.acquire()
+        try:
+            await _send(bot, broadcast, chat_id)
+            return True
+        except TelegramRetryAfter as e:
+            # Превышен лимит: останавливаем все отправки на указанное время
+            logger.warning(f"Broadcast {broadcast['id']} hit flood limit, retry after {e.retry_after}s")
+            _bucket.pause(e.retry_after)
+        except (TelegramForbiddenError, TelegramBadRequest) as e:
+            # Пользователь заблокировал бота или чат недоступен
+            logger.info(f"Broadcast {broadcast['id']} skipped user {chat_id}: {e}")
+            return False
+        except (TelegramAPIError, OSError, asyncio.TimeoutError) as e:
+            attempt += 1
+            if attempt >= BROADCAST_ATTEMPTS:
+                logger.error(f"Error sending broadcast to user {chat_id}: {e}")
+                return False
+            await asyncio.sleep(2 ** attempt)
+
+
+def _progress_text(broadcast, done=False):
+    processed = broadcast['sent'] + broadcast['failed']
+    if done:
+        return (
+            "📊 Отчет о рассылке:\n\n"
+            f"👥 Всего пользователей: {broadcast['total']}\n"
+            f"✅ Успешно отправлено: {broadcast['sent']}\n"
+            f"❌ Не удалось отправить: {broadcast['failed']}"
+        )
+    return (
+        f"📢 Рассылка #{broadcast['id']}: {processed} из {broadcast['total']}\n"
+        f"✅ Отправлено: {broadcast['sent']}\n"
+        f"❌ Ошибок: {broadcast['failed']}"
+    )
+
+
+async def _show_progress(bot, broadcast, done=False):
+    """Обновление сообщения с прогрессом у администратора"""
+    text = _progress_text(broadcast, done)
+    try:
+        if broadcast['status_message_id']:
+            await bot.edit_message_text(text, chat_id=broadcast['admin_chat_id'],
+                                        message_id=broadcast['status_message_id'])
+            return
+    except TelegramBadRequest as e:
+        if 'message is not modified' in str(e):
+            return
+        logger.warning(f"Cannot edit broadcast progress message: {e}")
+    except TelegramAPIError as e:
+        logger.warning(f"Cannot edit broadcast progress message: {e}")
+        return
+    try:
+        sent = await bot.send_message(broadcast['admin_chat_id'], text)
+        broadcast['status_message_id'] = sent.message_id
+    except TelegramAPIError as e:
+        logger.warning(f"Cannot send broadcast progress message: {e}")
+
+
+async def run_broadcast(bot, broadcast):
+    """Выполнение рассылки с сохраненной позиции до конца"""
+    logger.info(f"Broadcast {broadcast['id']} running from user id {broadcast['cursor']}")
+    last_progress = time.monotonic()
+    while True:
+        recipients = await get_broadcast_recipients(broadcast['cursor'], BROADCAST_CHUNK_SIZE)
+        if not recipients:
+            break
+        results = await asyncio.gather(*(
+            _deliver(bot, broadcast, telegram_id) for _, telegram_id in recipients
+        ))
+        broadcast['sent'] += sum(results)
+        broadcast['failed'] += len(results) - sum(results)
+        broadcast['cursor'] = recipients[-1][0]
+        await save_broadcast_progress(
+            broadcast['id'], broadcast['cursor'], broadcast['sent'], broadcast['failed'],
+            status_message_id=broadcast['status_message_id']
+        )
+        if time.monotonic() - last_progress >= PROGRESS_INTERVAL:
+            await _show_progress(bot, broadcast)
+            last_progress = time.monotonic()
+
+    # Пользователи, зарегистрированные во время рассылки, тоже ее получают
+    broadcast['total'] = max(broadcast['total'], broadcast['sent'] + broadcast['failed'])
+    await save_broadcast_progress(
+        broadcast['id'], broadcast['cursor'], broadcast['sent'], broadcast['failed'], done=True
+    )
+    await _show_progress(bot, broadcast, done=True)
+    logger.info(f"Broadcast {broadcast['id']} finished: {broadcast['sent']} sent, {broadcast['failed']} failed")
+
+
+def _spawn(bot, broadcast):
+    async def runner():
+        try:
+            # Рассылка уступает очередь ответам пользователям
+            with bulk_sends():
+                await run_broadcast(bot, broadcast)
+        except Exception as e:
+            logger.error(f"Error in broadcast {broadcast['id']}: {e}", exc_info=True)
+
+    task = asyncio.create_task(runner())
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return task
+
+
+async def start_broadcast(bot, message):
+    """Создание рассылки из сообщения администратора и запуск в фоне"""
+    if message.photo:
+        content_type, file_id = 'photo', message.photo[-1].file_id
+    elif message.video:
+        content_type, file_id = 'video', message.video.file_id
+    elif message.document:
+        content_type, file_id = 'document', message.document.file_id
+    else:
+        content_type, file_id = 'text', None
+    text = message.caption if file_id else message.text
+
+    broadcast = await create_broadcast(message.chat.id, content_type, text, file_id)
+    await _show_progress(bot, broadcast)
+    return _spawn(bot, broadcast)
+
+
+async def resume_broadcasts(bot):
+    """Продолжение рассылок, прерванных перезапуском бота"""
+    for broadcast in await get_active_broadcasts():
+        logger.info(f"Resuming broadcast {broadcast['id']}")
+        _spawn(bot, broadcast)
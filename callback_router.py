@@ -0,0 +1,166 @@
+"""Маршрутизация callback-запросов inline-кнопок.
+
+Все callback-запросы бота принимает один обработчик aiogram, а дальше
+CallbackRouter выбирает функцию по словарю за один разбор callback_data,
+вместо того чтобы aiogram проверял фильтры всех обработчиков по очереди.
+
+Формат callback_data: символ версии, действие и целочисленные аргументы
+(id категорий и товаров, номера страниц) в base36 через двоеточие,
+например "1product:c" для товара 12. Так callback_data не зависит от
+названий категорий и всегда укладывается в лимит Telegram в 64 байта,
+а обработчик получает готовые id.
+
+Кнопки старых форматов ("product_12", "cat:Жижа") в уже отправленных
+сообщениях обрабатываются функциями, зарегистрированными через legacy():
+они переводят данные в новый формат. Если перевести не удалось (например,
+категория удалена), пользователь получает подсказку открыть меню заново.
+"""
+import inspect
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+SEPARATOR = ':'
+# Версия формата; при несовместимом изменении формата увеличивается
+VERSION = '1'
+# Ответ на нажатие кнопки, которую не удалось разобрать
+STALE_TEXT = "Кнопка устарела. Откройте меню заново."
+# Ответ на нажатие админской кнопки без прав администратора
+DENIED_TEXT = "❌ У вас нет доступа к этой команде"
+
+# Наибольшее число, которое кодируется в одно поле
+MAX_VALUE = 36 ** 12 - 1
+_DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+_PACKED = re.compile(r'([a-z_][a-z0-9_]*)((?::[0-9a-z]{1,12})*)')
+
+# Параметры, которые обработчик может получить помимо callback
+_HANDLER_PARAMS = ('args', 'action', 'state')
+
+
+def encode_int(value):
+    """Неотрицательное целое в base36"""
+    if not isinstance(value, int) or isinstance(value, bool) or not 0 <= value <= MAX_VALUE:
+        raise ValueError(f"Callback argument must be an integer in 0..{MAX_VALUE}, got {value!r}")
+    digits = []
+    while True:
+        value, digit = divmod(value, 36)
+        digits.append(_DIGITS[digit])
+        if not value:
+            return ''.join(reversed(digits))
+
+
+def pack(action, *args):
+    """Сборка callback_data из действия и целочисленных аргументов"""
+    return VERSION + SEPARATOR.join((action, *map(encode_int, args)))
+
+
+def unpack(data):
+    """Разбор callback_data нового формата: (действие, аргументы) или None"""
+    if not data.startswith(VERSION):
+        return None
+    match = _PACKED.fullmatch(data, 1)
+    if match is None:
+        return None
+    fields = match.group(2)
+    args = tuple(int(field, 36) for field in fields[1:].split(SEPARATOR)) if fields else ()
+    return match.group(1), args
+
+
+class CallbackRouter:
+    """Таблица действий callback-кнопок"""
+
+    def __init__(self, is_admin=None):
+        # is_admin(user_id) проверяет права для действий с admin=True
+        self._is_admin = is_admin
+        # Действие -> (обработчик, параметры обработчика, число аргументов, только для админов)
+        self._routes = {}
+        # Префикс или точное значение старого формата -> функция перевода
+        self._legacy = {}
+
+    def route(self, action, arity=0, admin=False):
+        """Регистрация обработчика действия с arity целочисленными аргументами
+
+        admin=True — действие доступно только администраторам.
+        """
+        def decorator(handler):
+            if action in self._routes:
+                raise ValueError(f"Callback action {action!r} is already registered")
+            params = tuple(name for name in inspect.signature(handler).parameters if name in _HANDLER_PARAMS)
+            self._routes[action] = (handler, params, arity, admin)
+            return handler
+        return decorator
+
+    def legacy(self, *prefixes):
+        """Регистрация перевода кнопок старого формата
+
+        Функция получает остаток callback_data после префикса и возвращает
+        callback_data нового формата или None, если кнопка больше не
+        действительна. Функция может быть асинхронной.
+        """
+        def decorator(convert):
+            for prefix in prefixes:
+                self._legacy[prefix] = convert
+            return convert
+        return decorator
+
+    def resolve(self, data):
+        """Поиск обработчика: (обработчик, параметры, действие, аргументы) или None"""
+        unpacked = unpack(data)
+        if unpacked is None:
+            return None
+        action, args = unpacked
+        route = self._routes.get(action)
+        if route is None or len(args) != route[2]:
+            return None
+        return route[0], route[1], action, args
+
+    def _find_legacy(self, data):
+        """Функция перевода старого формата и ее аргумент: самый длинный префикс"""
+        convert = self._legacy.get(data)
+        if convert is not None:
+            return convert, ''
+        for end in range(len(data) - 1, 0, -1):
+            if data[end] in '_' + SEPARATOR:
+                convert = self._legacy.get(data[:end + 1])
+                if convert is not None:
+                    return convert, data[end + 1:]
+        return None, None
+
+    async def _upgrade(self, data):
+        """Перевод callback_data старого формата в новый"""
+        if data.startswith(VERSION):
+            return None
+        convert, args = self._find_legacy(data)
+        if convert is None:
+            # Действие без аргументов, например "checkout"
+            return pack(data) if data in self._routes else None
+        try:
+            upgraded = convert(args)
+            if inspect.isawaitable(upgraded):
+                upgraded = await upgraded
+            return upgraded
+        except ValueError:
+            return None
+
+    async def dispatch(self, callback, state=None):
+        """Вызов обработчика для callback-запроса"""
+        data = callback.data or ''
+        resolved = self.resolve(data)
+        if resolved is None:
+            upgraded = await self._upgrade(data)
+            resolved = self.resolve(upgraded) if upgraded else None
+        if resolved is None:
+            logger.warning(f"Unknown callback data: {data!r}")
+            await callback.answer(STALE_TEXT)
+            return
+        handler, params, action, args = resolved
+        if self._routes[action][3] and not (self._is_admin and self._is_admin(callback.from_user.id)):
+            logger.warning(f"Admin callback {action!r} denied for user {callback.from_user.id}")
+            await callback.answer(DENIED_TEXT)
+            return
+        values = {'args': args, 'action': action, 'state': state}
+        return await handler(callback, **{name: values[name] for name in params})
+
+    def __len__(self):
+        return len(self._routes)
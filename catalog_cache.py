@@ -0,0 +1,103 @@
+"""Кэш каталога в памяти процесса.
+
+Каталог меняется только через админские функции database.py, поэтому
+категории и товары держатся в памяти и отдаются без запросов к базе.
+Каждая запись в каталог увеличивает версию и сбрасывает снимок; новый снимок
+загружается при следующем чтении.
+"""
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class CatalogSnapshot:
+    """Неизменяемый снимок каталога одной версии"""
+
+    def __init__(self, version, categories, products):
+        self.version = version
+        # Список категорий: [{'id': ..., 'name': ...}]
+        self.categories = categories
+        self.category_names = [category['name'] for category in categories]
+        self.categories_by_id = {category['id']: category for category in categories}
+        self.category_ids_by_name = {category['name']: category['id'] for category in categories}
+        self.products = products
+        self.products_by_id = {product['id']: product for product in products}
+        self.products_by_category = {name: [] for name in self.category_names}
+        for product in products:
+            self.products_by_category.setdefault(product['category'], []).append(product)
+        # Отсортированные id товаров категории для постраничного вывода по ключу
+        self.product_ids_by_category = {
+            name: [product['id'] for product in category_products]
+            for name, category_products in self.products_by_category.items()
+        }
+
+
+class CatalogCache:
+    """Кэш каталога с версией и счетчиками попаданий"""
+
+    def __init__(self, loader):
+        # loader() возвращает (categories, products) из базы данных
+        self._loader = loader
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self.rebuilds = 0
+        # Функции, вызываемые после каждого изменения каталога
+        self._listeners = []
+
+    def add_listener(self, listener):
+        """Подписка на изменения каталога; listener(version) вызывается в потоке записи"""
+        self._listeners.append(listener)
+
+    def is_warm(self):
+        """Есть ли актуальный снимок (чтение не обратится к базе)"""
+        return self._snapshot is not None
+
+    def snapshot(self):
+        """Получение актуального снимка каталога"""
+        snapshot = self._snapshot
+        if snapshot is not None:
+            self.hits += 1
+            return snapshot
+
+        with self._lock:
+            if self._snapshot is not None:
+                self.hits += 1
+                return self._snapshot
+            self.misses += 1
+            version = self.version
+
+        categories, products = self._loader()
+        snapshot = CatalogSnapshot(version, categories, products)
+
+        with self._lock:
+            # Если во время загрузки каталог изменился, снимок уже устарел
+            if self.version == version:
+                self._snapshot = snapshot
+                self.rebuilds += 1
+                logger.info(f"Catalog cache rebuilt: version {version}, {len(products)} products")
+        return snapshot
+
+    def invalidate(self):
+        """Сброс кэша после изменения каталога"""
+        with self._lock:
+            self.version += 1
+            self._snapshot = None
+            version = self.version
+        for listener in self._listeners:
+            try:
+                listener(version)
+            except Exception as e:
+                logger.error(f"Error in catalog change listener: {e}", exc_info=True)
+
+    def metrics(self):
+        """Метрики кэша"""
+        return {
+            'version': self.version,
+            'hits': self.hits,
+            'misses': self.misses,
+            'rebuilds': self.rebuilds,
+        }
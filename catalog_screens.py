@@ -0,0 +1,191 @@
+"""Готовые экраны каталога для покупателей.
+
+Список категорий и каждая страница каждой категории (текст и клавиатура)
+собираются заранее из снимка каталога и хранятся вместе с его версией.
+Нажатие кнопки в каталоге сводится к поиску в словаре и одному запросу
+к Telegram. Когда администратор меняет каталог, кэш каталога сообщает об
+этом, и экраны пересобираются в фоне. Пока пересборка не закончилась,
+обработчики собирают экран обычным способом, поэтому устаревшие товары
+покупателю не показываются.
+"""
+import asyncio
+import logging
+from collections import namedtuple
+
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+import database
+from async_db import run_blocking
+from callback_router import pack
+from database import PRODUCTS_PER_PAGE
+
+logger = logging.getLogger(__name__)
+
+# Страница категории; after_id и before_id — id товаров на соседних
+# страницах, по ним проверяется, что кнопка навигации ведет на эту страницу
+Screen = namedtuple('Screen', ('text', 'keyboard', 'after_id', 'before_id'))
+
+
+def categories_keyboard(categories):
+    """Клавиатура списка категорий"""
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=category['name'], callback_data=pack("cat", category['id']))]
+        for category in categories
+    ])
+
+
+def page_keyboard(category, page, result):
+    """Клавиатура страницы товаров категории"""
+    keyboard_buttons = []
+    for product in result['items']:
+        keyboard_buttons.append([InlineKeyboardButton(
+            text=f"{product['name']} - {product['price']} ₽",
+            callback_data=pack("product", product['id'])
+        )])
+
+    # Кнопки навигации хранят id крайнего товара страницы для выборки по ключу
+    nav_buttons = []
+    if result['has_prev']:
+        nav_buttons.append(InlineKeyboardButton(
+            text="⬅️", callback_data=pack("prev", category['id'], page - 1, result['items'][0]['id'])
+        ))
+    if result['has_next']:
+        nav_buttons.append(InlineKeyboardButton(
+            text="➡️", callback_data=pack("next", category['id'], page + 1, result['items'][-1]['id'])
+        ))
+    if nav_buttons:
+        keyboard_buttons.append(nav_buttons)
+
+    return InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
+
+
+def page_text(category, page, result):
+    """Заголовок страницы товаров категории"""
+    pages_count = max(1, -(-result['total'] // PRODUCTS_PER_PAGE))
+    return (
+        f"🛍 Товары в категории {category['name']}:\n\n"
+        f"Страница {page + 1} из {pages_count}"
+    )
+
+
+class RenderedCatalog:
+    """Экраны каталога одной версии"""
+
+    def __init__(self, snapshot):
+        self.version = snapshot.version
+        self.categories_keyboard = categories_keyboard(snapshot.categories)
+        # id категории -> список страниц (Screen)
+        self.pages = {}
+        for category in snapshot.categories:
+            products = snapshot.products_by_category.get(category['name'], [])
+            pages = []
+            for start in range(0, len(products), PRODUCTS_PER_PAGE):
+                end = start + PRODUCTS_PER_PAGE
+                result = {
+                    'items': products[start:end],
+                    'total': len(products),
+                    'has_prev': start > 0,
+                    'has_next': end < len(products),
+                }
+                page = len(pages)
+                pages.append(Screen(
+                    page_text(category, page, result),
+                    page_keyboard(category, page, result),
+                    products[start - 1]['id'] if start else 0,
+                    products[end]['id'] if end < len(products) else None,
+                ))
+            self.pages[category['id']] = pages
+
+    def pages_count(self):
+        return sum(len(pages) for pages in self.pages.values())
+
+
+class CatalogScreens:
+    """Кэш готовых экранов каталога с пересборкой в фоне"""
+
+    def __init__(self):
+        self._rendered = None
+        self._loop = None
+        self._task = None
+        self._dirty = False
+        self.hits = 0
+        self.misses = 0
+        self.rebuilds = 0
+
+    def start(self):
+        """Подписка на изменения каталога и первая сборка; вызывается из event loop"""
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+            database.catalog_cache.add_listener(self._on_change)
+        self._schedule()
+
+    def _on_change(self, version):
+        # Вызывается в потоке, который изменил каталог
+        loop = self._loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self._schedule)
+
+    def _schedule(self):
+        self._dirty = True
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._rebuild())
+
+    async def _rebuild(self):
+        # Изменения во время сборки приводят к еще одной сборке
+        while self._dirty:
+            self._dirty = False
+            try:
+                rendered = await run_blocking(lambda: RenderedCatalog(database.catalog_cache.snapshot()))
+            except Exception as e:
+                logger.error(f"Error rendering catalog screens: {e}", exc_info=True)
+                return
+            self._rendered = rendered
+            self.rebuilds += 1
+            logger.info(f"Catalog screens rendered: version {rendered.version}, {rendered.pages_count()} pages")
+
+    def _current(self):
+        rendered = self._rendered
+        if rendered is not None and rendered.version == database.catalog_cache.version:
+            return rendered
+        self.misses += 1
+        return None
+
+    def categories(self):
+        """Клавиатура списка категорий или None, если экраны устарели"""
+        rendered = self._current()
+        if rendered is None:
+            return None
+        self.hits += 1
+        return rendered.categories_keyboard
+
+    def page(self, category_id, page=0, after_id=None, before_id=None):
+        """Страница категории (Screen) или None, если ее нужно собрать заново
+
+        after_id/before_id из кнопки навигации должны совпадать с соседями
+        страницы; иначе кнопка была отправлена до изменения каталога.
+        """
+        rendered = self._current()
+        if rendered is None:
+            return None
+        pages = rendered.pages.get(category_id)
+        if not pages or not 0 <= page < len(pages):
+            self.misses += 1
+            return None
+        screen = pages[page]
+        if (after_id is not None and screen.after_id != after_id) or \
+                (before_id is not None and screen.before_id != before_id):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return screen
+
+    def metrics(self):
+        """Метрики кэша экранов"""
+        rendered = self._rendered
+        return {
+            'version': rendered.version if rendered else None,
+            'pages': rendered.pages_count() if rendered else 0,
+            'hits': self.hits,
+            'misses': self.misses,
+            'rebuilds': self.rebuilds,
+        }
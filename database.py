@@ -1,12 +1,26 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, ForeignKey, Boolean, DateTime
+from sqlalchemy import create_engine, event, inspect, Column, Integer, String, Float, ForeignKey, Boolean, DateTime, Index, func, insert, update, select, delete, exists, literal
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship, scoped_session
 from contextlib import contextmanager
 import sqlite3
+import bisect
+import gzip
+import io
+import tempfile
+import time
 import logging
 from datetime import datetime
 import os
 import json
+from dotenv import load_dotenv
+from migrations import run_migrations, stamp_latest
+from catalog_cache import CatalogCache
+from media_cache import MediaCache
+from image_pipeline import DEFAULT_IMAGE, adopt_file, collect_orphans, is_stored, release_image, unpin
+from roles import RoleRegistry, CONFIGURED_ADMIN_IDS
+
+load_dotenv()
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
@@ -26,7 +40,7 @@ class User(Base):
 class Category(Base):
     __tablename__ = 'categories'
     id = Column(Integer, primary_key=True)
-    name = Column(String)
+    name = Column(String, index=True)
     products = relationship("Product", back_populates="category")
 
 class Product(Base):
@@ -36,7 +50,7 @@ class Product(Base):
     description = Column(String)
     price = Column(Float)
     image_path = Column(String)  # Путь к изображению товара
-    category_id = Column(Integer, ForeignKey('categories.id'))
+    category_id = Column(Integer, ForeignKey('categories.id'), index=True)
     category = relationship("Category", back_populates="products")
     cart_items = relationship("CartItem", back_populates="product")
     order_items = relationship("OrderItem", back_populates="product")
@@ -44,12 +58,16 @@ class Product(Base):
 class Cart(Base):
     __tablename__ = 'carts'
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, ForeignKey('users.id'))
+    user_id = Column(Integer, ForeignKey('users.id'), index=True, unique=True)
     user = relationship("User", back_populates="cart")
     items = relationship("CartItem", back_populates="cart")
 
 class CartItem(Base):
     __tablename__ = 'cart_items'
+    __table_args__ = (
+        # Одна строка корзины на товар; индекс также покрывает поиск по cart_id
+        Index('ux_cart_items_cart_product', 'cart_id', 'product_id', unique=True),
+    )
     id = Column(Integer, primary_key=True)
     cart_id = Column(Integer, ForeignKey('carts.id'))
     product_id = Column(Integer, ForeignKey('products.id'))
@@ -62,21 +80,119 @@ class Order(Base):
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'))
     created_at = Column(DateTime, default=datetime.now)
+    # Итоги заказа на момент оформления
+    total = Column(Float)
+    item_count = Column(Integer)
     user = relationship("User", back_populates="orders")
     items = relationship("OrderItem", back_populates="order")
 
 class OrderItem(Base):
     __tablename__ = 'order_items'
     id = Column(Integer, primary_key=True)
-    order_id = Column(Integer, ForeignKey('orders.id'))
+    order_id = Column(Integer, ForeignKey('orders.id'), index=True)
     product_id = Column(Integer, ForeignKey('products.id'))
     quantity = Column(Integer)
     price = Column(Float)
     order = relationship("Order", back_populates="items")
     product = relationship("Product", back_populates="order_items")
 
+# Профили хранилища SQLite (выбираются через DB_PROFILE в .env)
+STORAGE_PROFILES = {
+    # Настройки SQLite по умолчанию: журнал отката, synchronous=FULL
+    'default': {},
+    # WAL: чтение не блокируется записью, fsync только при checkpoint
+    'wal': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'mmap_size': 64 * 1024 * 1024,
+        'cache_size': -16000,  # отрицательное значение задается в КБ
+        'busy_timeout': 5000,
+        'temp_store': 'MEMORY',
+    },
+    # WAL с увеличенными кэшем и mmap для больших каталогов
+    'performance': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -64000,
+        'busy_timeout': 10000,
+        'temp_store': 'MEMORY',
+    },
+}
+
+DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:///shop.db')
+DB_PROFILE = os.getenv('DB_PROFILE', 'wal')
+DB_WORKERS = int(os.getenv('DB_WORKERS', '4'))
+
+def create_db_engine(url=DATABASE_URL, profile=DB_PROFILE):
+    """Создание движка SQLAlchemy с настройками выбранного профиля"""
+    if profile not in STORAGE_PROFILES:
+        logger.warning(f"Unknown storage profile {profile}, using 'default'")
+        profile = 'default'
+    pragmas = STORAGE_PROFILES[profile]
+    
+    options = {}
+    if ':memory:' not in url:
+        # По одному соединению на поток пула и одно для event loop
+        options = {
+            'pool_size': DB_WORKERS + 1,
+            'max_overflow': 2,
+            'pool_timeout': 30,
+            'connect_args': {
+                'timeout': pragmas.get('busy_timeout', 5000) / 1000,
+                'check_same_thread': False
+            }
+        }
+    db_engine = create_engine(url, **options)
+    
+    @event.listens_for(db_engine, "connect")
+    def apply_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+    
+    logger.info(f"Database engine created with storage profile: {profile}")
+    return db_engine
+
+class Setting(Base):
+    __tablename__ = 'settings'
+    key = Column(String, primary_key=True)
+    value = Column(String)
+
+class TelegramFile(Base):
+    __tablename__ = 'telegram_files'
+    sha256 = Column(String, primary_key=True)
+    file_id = Column(String, nullable=False)
+
+class FsmRecord(Base):
+    __tablename__ = 'fsm_states'
+    # Ключ StorageKey aiogram: bot_id:chat_id:user_id:thread_id:destiny
+    key = Column(String, primary_key=True)
+    state = Column(String, nullable=True)
+    data = Column(String, nullable=True)  # JSON
+    # time.time() последнего изменения; по нему удаляются устаревшие состояния
+    updated_at = Column(Float, nullable=False, index=True)
+
+class Broadcast(Base):
+    __tablename__ = 'broadcasts'
+    id = Column(Integer, primary_key=True)
+    admin_chat_id = Column(Integer)
+    status_message_id = Column(Integer, nullable=True)
+    content_type = Column(String)  # text, photo, video или document
+    text = Column(String, nullable=True)  # Текст сообщения или подпись
+    file_id = Column(String, nullable=True)
+    status = Column(String, default='running', index=True)  # running или done
+    # users.id последнего обработанного получателя
+    cursor = Column(Integer, default=0)
+    total = Column(Integer, default=0)
+    sent = Column(Integer, default=0)
+    failed = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.now)
+    finished_at = Column(DateTime, nullable=True)
+
 # Инициализация базы данных
-engine = create_engine('sqlite:///shop.db')
+engine = create_db_engine()
 session_factory = sessionmaker(bind=engine)
 Session = scoped_session(session_factory)
 
@@ -92,9 +208,38 @@ def session_scope():
     finally:
         session.close()
 
+def get_setting(key, default=None):
+    """Получение служебной настройки"""
+    with session_scope() as session:
+        value = session.query(Setting.value).filter_by(key=key).scalar()
+        return default if value is None else value
+
+def set_setting(key, value):
+    """Сохранение служебной настройки"""
+    with session_scope() as session:
+        session.execute(
+            sqlite_insert(Setting).values(key=key, value=value)
+            .on_conflict_do_update(index_elements=['key'], set_={'value': value})
+        )
+
+# Минимальная версия SQLite: корзина и оформление заказа используют RETURNING
+MIN_SQLITE_VERSION = (3, 35, 0)
+
+def check_sqlite_version():
+    """Проверка, что версия SQLite поддерживает RETURNING"""
+    if sqlite3.sqlite_version_info < MIN_SQLITE_VERSION:
+        required = '.'.join(map(str, MIN_SQLITE_VERSION))
+        raise RuntimeError(f"SQLite {required} or newer is required, found {sqlite3.sqlite_version}")
+
 def init_db():
     """Инициализация базы данных"""
+    check_sqlite_version()
+    is_new_database = not inspect(engine).has_table(User.__tablename__)
     Base.metadata.create_all(engine)
+    if is_new_database:
+        stamp_latest(engine)
+    else:
+        run_migrations(engine)
     
     try:
         with session_scope() as session:
@@ -113,40 +258,47 @@ def init_db():
                     session.add(category)
             
             # Создаем администраторов из .env и дополнительные ID
-            admin_ids = os.getenv('ADMIN_IDS', '').split(',')
-            # Добавляем дополнительные ID администраторов
-            additional_admin_ids = ['231916981', '5817829191', '1009069570']
-            admin_ids.extend(additional_admin_ids)
-            
-            for admin_id in admin_ids:
-                if admin_id.strip():  # Проверяем, что ID не пустой
-                    admin_id = int(admin_id.strip())
-                    admin = session.query(User).filter_by(telegram_id=admin_id).first()
-                    if not admin:
-                        admin = User(telegram_id=admin_id, is_admin=True)
-                        session.add(admin)
-                        logger.info(f"Created admin user: {admin_id}")
-                    else:
-                        admin.is_admin = True
-                        logger.info(f"Updated admin status for user: {admin_id}")
+            for admin_id in sorted(CONFIGURED_ADMIN_IDS):
+                admin = session.query(User).filter_by(telegram_id=admin_id).first()
+                if not admin:
+                    admin = User(telegram_id=admin_id, is_admin=True)
+                    session.add(admin)
+                    logger.info(f"Created admin user: {admin_id}")
+                else:
+                    admin.is_admin = True
+                    logger.info(f"Updated admin status for user: {admin_id}")
             
             session.commit()
+            catalog_cache.invalidate()
+            role_registry.load()
             logger.info("Database initialized successfully")
             
             # Импортируем товары из последнего бэкапа, если он существует
             backup_dir = "backups"
             if os.path.exists(backup_dir):
-                backup_files = [f for f in os.listdir(backup_dir) if f.endswith('.json')]
+                backup_files = [f for f in os.listdir(backup_dir) if f.endswith(BACKUP_EXTENSIONS)]
                 if backup_files:
                     # Берем самый последний бэкап
                     latest_backup = max(backup_files, key=lambda x: os.path.getctime(os.path.join(backup_dir, x)))
                     backup_file = os.path.join(backup_dir, latest_backup)
-                    import_products(backup_file)
-                    logger.info(f"Imported products from backup: {backup_file}")
+                    # Повторно импортируем только изменившийся бэкап
+                    backup_stat = os.stat(backup_file)
+                    fingerprint = f"{backup_file}:{backup_stat.st_size}:{backup_stat.st_mtime_ns}"
+                    if get_setting('last_import') == fingerprint:
+                        logger.info(f"Backup already imported: {backup_file}")
+                    elif import_products(backup_file):
+                        set_setting('last_import', fingerprint)
+                        logger.info(f"Imported products from backup: {backup_file}")
                 else:
                     logger.info("No backup files found")
             else:
                 logger.info("Backup directory does not exist")
+        
+        # Файлы хранилища, оставшиеся без товаров после прерванных загрузок
+        remove_orphan_images()
+        
+        # Загружаем каталог в кэш, чтобы первые запросы не обращались к базе
+        catalog_cache.snapshot()
                 
     except Exception as e:
         logger.error(f"Error in init_db: {e}", exc_info=True)
@@ -158,8 +310,7 @@ def add_user(telegram_id: int, is_admin: bool = False, username: str = None):
     try:
         with session_scope() as session:
             # Проверяем, является ли пользователь администратором
-            admin_ids = os.getenv('ADMIN_IDS', '').split(',')
-            is_admin = str(telegram_id) in admin_ids
+            is_admin = telegram_id in CONFIGURED_ADMIN_IDS
             
             user = session.query(User).filter_by(telegram_id=telegram_id).first()
             if not user:
@@ -174,63 +325,219 @@ def add_user(telegram_id: int, is_admin: bool = False, username: str = None):
                 logger.info(f"Updated existing user: {telegram_id}, admin: {is_admin}, username: {username}")
             
             session.commit()
+            role_registry.set_admin(telegram_id, is_admin)
             return True
     except Exception as e:
         logger.error(f"Error in add_user: {e}", exc_info=True)
         return False
 
+# Строк в одном INSERT: 3 параметра на строку, с запасом до лимита SQLite
+UPSERT_USERS_CHUNK = 500
+
+def get_known_users():
+    """Пары (telegram_id, username) всех пользователей для реестра пользователей"""
+    with engine.connect() as connection:
+        return connection.execute(select(User.telegram_id, User.username)).all()
+
+def upsert_users(rows):
+    """Пакетная запись пользователей: [{'telegram_id', 'username', 'is_admin'}]
+
+    Новые пользователи добавляются, у существующих обновляется is_admin и
+    username (если он передан), как в add_user. Возвращает число строк.
+    """
+    if not rows:
+        return 0
+    with engine.begin() as connection:
+        for start in range(0, len(rows), UPSERT_USERS_CHUNK):
+            stmt = sqlite_insert(User).values(rows[start:start + UPSERT_USERS_CHUNK])
+            connection.execute(stmt.on_conflict_do_update(
+                index_elements=['telegram_id'],
+                set_={
+                    'is_admin': stmt.excluded.is_admin,
+                    'username': func.coalesce(stmt.excluded.username, User.username),
+                }
+            ))
+    for row in rows:
+        role_registry.set_admin(row['telegram_id'], row['is_admin'])
+    return len(rows)
+
 def is_admin(telegram_id):
-    """Проверка, является ли пользователь администратором"""
+    """Проверка, является ли пользователь администратором (без запроса к базе)"""
     try:
-        # Сначала проверяем в базе данных
-        with session_scope() as session:
-            user = session.query(User).filter_by(telegram_id=telegram_id).first()
-            if user:
-                # Если пользователь найден, проверяем его статус
-                is_admin_status = user.is_admin
-                logger.info(f"Checking admin status in DB for user {telegram_id}: {is_admin_status}")
-                return is_admin_status
-            
-        # Если пользователь не найден в базе, проверяем в .env
-        admin_ids = os.getenv('ADMIN_IDS', '').split(',')
-        is_admin_status = str(telegram_id) in admin_ids
-        logger.info(f"Checking admin status in .env for user {telegram_id}: {is_admin_status}")
-        
-        # Если пользователь администратор в .env, добавляем его в базу
-        if is_admin_status:
-            add_user(telegram_id, is_admin=True)
-        
-        return is_admin_status
+        return role_registry.is_admin(telegram_id)
     except Exception as e:
         logger.error(f"Error in is_admin: {e}", exc_info=True)
         return False
 
 # Функции для работы с категориями
 def get_categories():
-    with session_scope() as session:
-        categories = session.query(Category).all()
-        return [cat.name for cat in categories]
+    return catalog_cache.snapshot().category_names
+
+def get_category_list():
+    """Категории с id: [{'id': ..., 'name': ...}]"""
+    return list(catalog_cache.snapshot().categories)
+
+def get_category(category_id):
+    """Категория по id или None"""
+    return catalog_cache.snapshot().categories_by_id.get(category_id)
+
+def get_category_id(name):
+    """id категории по названию или None"""
+    return catalog_cache.snapshot().category_ids_by_name.get(name)
 
 # Функции для работы с продуктами
+def _product_query(session):
+    """Запрос товаров вместе с названием категории одним SELECT"""
+    return session.query(
+        Product.id,
+        Product.name,
+        Product.description,
+        Product.price,
+        Category.name.label('category'),
+        Product.image_path
+    ).outerjoin(Category, Product.category_id == Category.id)
+
+def _product_to_dict(row):
+    return {
+        'id': row.id,
+        'name': row.name,
+        'description': row.description,
+        'price': row.price,
+        'category': row.category,
+        'image_path': row.image_path
+    }
+
 def get_products(category=None):
     """Получение списка товаров"""
+    snapshot = catalog_cache.snapshot()
+    if category:
+        return list(snapshot.products_by_category.get(category, []))
+    return list(snapshot.products)
+
+# Количество товаров на одной странице категории
+PRODUCTS_PER_PAGE = 5
+
+def get_products_page(category, after_id=0, before_id=None, limit=PRODUCTS_PER_PAGE):
+    """Страница товаров категории по ключу (id товара) и общее число товаров
+
+    after_id - следующая страница после товара с этим id,
+    before_id - предыдущая страница перед товаром с этим id.
+    """
+    if catalog_cache.is_warm():
+        snapshot = catalog_cache.snapshot()
+        products = snapshot.products_by_category.get(category, [])
+        product_ids = snapshot.product_ids_by_category.get(category, [])
+        if before_id is not None:
+            end = bisect.bisect_left(product_ids, before_id)
+            start = max(0, end - limit)
+        else:
+            start = bisect.bisect_right(product_ids, after_id)
+            end = start + limit
+        return {
+            'items': products[start:end],
+            'total': len(products),
+            'has_prev': start > 0,
+            'has_next': end < len(products)
+        }
+    return _query_products_page(category, after_id, before_id, limit)
+
+def _query_products_page(category, after_id=0, before_id=None, limit=PRODUCTS_PER_PAGE):
+    """Страница товаров из базы: одна страница и общее число одним запросом"""
     with session_scope() as session:
-        query = session.query(Product)
-        if category:
-            query = query.join(Category).filter(Category.name == category)
-        products = query.all()
-        # Преобразуем объекты SQLAlchemy в словари
-        return [
-            {
-                'id': product.id,
-                'name': product.name,
-                'description': product.description,
-                'price': product.price,
-                'category': product.category.name if product.category else None,
-                'image_path': product.image_path
-            }
-            for product in products
+        total = session.query(func.count(Product.id)) \
+            .filter(Product.category_id == Category.id) \
+            .correlate(Category).scalar_subquery()
+        query = session.query(Product.id, Product.name, Product.price, total.label('total')) \
+            .join(Category, Product.category_id == Category.id) \
+            .filter(Category.name == category)
+        # Берем на одну строку больше, чтобы узнать, есть ли следующая страница
+        if before_id is not None:
+            rows = query.filter(Product.id < before_id).order_by(Product.id.desc()).limit(limit + 1).all()
+            has_more = len(rows) > limit
+            rows = rows[:limit][::-1]
+            has_prev, has_next = has_more, True
+        else:
+            rows = query.filter(Product.id > after_id).order_by(Product.id).limit(limit + 1).all()
+            has_more = len(rows) > limit
+            rows = rows[:limit]
+            has_prev, has_next = after_id > 0, has_more
+        
+        if rows:
+            total_count = rows[0].total
+        else:
+            # Пустая страница: общее число считаем отдельно
+            total_count = session.query(func.count(Product.id)) \
+                .join(Category, Product.category_id == Category.id) \
+                .filter(Category.name == category).scalar()
+        return {
+            'items': [{'id': row.id, 'name': row.name, 'price': row.price} for row in rows],
+            'total': total_count,
+            'has_prev': has_prev,
+            'has_next': has_next
+        }
+
+def _load_catalog():
+    """Загрузка каталога для кэша: категории и товары двумя запросами"""
+    with session_scope() as session:
+        categories = [
+            {'id': category_id, 'name': name}
+            for category_id, name in session.query(Category.id, Category.name).order_by(Category.id).all()
+        ]
+        products = [
+            dict(_product_to_dict(row), category_id=row.category_id)
+            for row in _product_query(session).add_columns(Product.category_id).order_by(Product.id).all()
         ]
+        return categories, products
+
+# Кэш каталога; сбрасывается функциями, которые изменяют товары
+catalog_cache = CatalogCache(_load_catalog)
+
+def get_catalog_metrics():
+    """Метрики кэша каталога"""
+    return catalog_cache.metrics()
+
+# Кэш file_id работает через отдельные соединения, а не через сессию потока:
+# его могут вызывать функции, у которых сессия еще открыта
+def _load_file_ids():
+    """Загрузка сохраненных file_id Telegram"""
+    with engine.connect() as connection:
+        return dict(connection.execute(select(TelegramFile.sha256, TelegramFile.file_id)).all())
+
+def _save_file_id(sha256, file_id):
+    with engine.begin() as connection:
+        connection.execute(
+            sqlite_insert(TelegramFile).values(sha256=sha256, file_id=file_id)
+            .on_conflict_do_update(index_elements=['sha256'], set_={'file_id': file_id})
+        )
+
+def _delete_file_id(sha256):
+    with engine.begin() as connection:
+        connection.execute(delete(TelegramFile).where(TelegramFile.sha256 == sha256))
+
+# Кэш file_id отправленных картинок по хешу содержимого
+media_cache = MediaCache(_load_file_ids, _save_file_id, _delete_file_id)
+
+def get_file_id(path):
+    """file_id ранее загруженного файла или None"""
+    try:
+        return media_cache.get(path)
+    except Exception as e:
+        logger.error(f"Error getting file_id for {path}: {e}")
+        return None
+
+def save_file_id(path, file_id):
+    """Сохранение file_id после загрузки файла в Telegram"""
+    try:
+        media_cache.remember(path, file_id)
+    except Exception as e:
+        logger.error(f"Error saving file_id for {path}: {e}")
+
+def forget_file_id(path):
+    """Удаление file_id, который Telegram отклонил"""
+    try:
+        media_cache.forget(path)
+    except Exception as e:
+        logger.error(f"Error forgetting file_id for {path}: {e}")
 
 def add_product(name, description, price, category_name, image_path):
     """Добавление нового товара"""
@@ -250,6 +557,7 @@ def add_product(name, description, price, category_name, image_path):
             )
             session.add(product)
             session.commit()
+            catalog_cache.invalidate()
             logger.info(f"Product {name} added successfully")
             return True
         except Exception as e:
@@ -259,59 +567,46 @@ def add_product(name, description, price, category_name, image_path):
 
 def get_product_by_id(product_id):
     """Получение информации о товаре по его ID"""
-    with session_scope() as session:
-        product = session.query(Product).filter_by(id=product_id).first()
-        if product:
-            return {
-                'id': product.id,
-                'name': product.name,
-                'description': product.description,
-                'price': product.price,
-                'category': product.category.name,
-                'image_path': product.image_path
-            }
-        return None
+    return catalog_cache.snapshot().products_by_id.get(product_id)
+
+def _cart_line_upsert(user_id, product_id):
+    """INSERT ... ON CONFLICT для строки корзины; возвращает новое количество"""
+    source = select(Cart.id, literal(product_id), literal(1)) \
+        .join(User, Cart.user_id == User.id) \
+        .where(User.telegram_id == user_id) \
+        .where(exists().where(Product.id == product_id))
+    return sqlite_insert(CartItem) \
+        .from_select(['cart_id', 'product_id', 'quantity'], source) \
+        .on_conflict_do_update(
+            index_elements=['cart_id', 'product_id'],
+            set_={'quantity': CartItem.quantity + 1}
+        ).returning(CartItem.quantity)
 
 def add_to_cart_db(user_id, product_id):
-    """Добавление товара в корзину пользователя"""
+    """Добавление товара в корзину пользователя
+
+    Возвращает количество товара в корзине после добавления.
+    """
     with session_scope() as session:
         try:
-            # Получаем пользователя
-            user = session.query(User).filter_by(telegram_id=user_id).first()
-            if not user:
-                user = User(telegram_id=user_id)
-                session.add(user)
-                session.flush()
-            
-            # Получаем или создаем корзину
-            cart = session.query(Cart).filter_by(user_id=user.id).first()
-            if not cart:
-                cart = Cart(user_id=user.id)
-                session.add(cart)
-                session.flush()
-            
-            # Получаем товар
-            product = session.query(Product).filter_by(id=product_id).first()
-            if not product:
-                raise ValueError(f"Товар с ID {product_id} не найден")
-            
-            # Проверяем наличие товара в корзине
-            cart_item = session.query(CartItem).filter_by(
-                cart_id=cart.id,
-                product_id=product_id
-            ).first()
-            
-            if cart_item:
-                cart_item.quantity += 1
-            else:
-                cart_item = CartItem(
-                    cart_id=cart.id,
-                    product_id=product_id,
-                    quantity=1
+            # Обычно пользователь и корзина уже есть: достаточно одного запроса
+            quantity = session.execute(_cart_line_upsert(user_id, product_id)).scalar()
+            if quantity is None:
+                # Создаем пользователя и корзину, если их еще нет
+                session.execute(
+                    sqlite_insert(User).values(telegram_id=user_id)
+                    .on_conflict_do_nothing(index_elements=['telegram_id'])
+                )
+                session.execute(
+                    sqlite_insert(Cart)
+                    .from_select(['user_id'], select(User.id).where(User.telegram_id == user_id))
+                    .on_conflict_do_nothing(index_elements=['user_id'])
                 )
-                session.add(cart_item)
+                quantity = session.execute(_cart_line_upsert(user_id, product_id)).scalar()
             
-            session.commit()
+            if quantity is None:
+                raise ValueError(f"Товар с ID {product_id} не найден")
+            return quantity
         except Exception as e:
             logger.error(f"Error in add_to_cart_db: {e}")
             raise
@@ -319,22 +614,24 @@ def add_to_cart_db(user_id, product_id):
 def get_cart_items(user_id):
     """Получение товаров из корзины пользователя"""
     with session_scope() as session:
-        user = session.query(User).filter_by(telegram_id=user_id).first()
-        if not user:
-            return []
-        
-        cart = session.query(Cart).filter_by(user_id=user.id).first()
-        if not cart:
-            return []
-        
-        items = session.query(CartItem).filter_by(cart_id=cart.id).all()
+        items = session.query(
+            CartItem.id,
+            CartItem.product_id,
+            CartItem.quantity,
+            Product.name,
+            Product.price
+        ).join(Cart, CartItem.cart_id == Cart.id) \
+            .join(User, Cart.user_id == User.id) \
+            .join(Product, CartItem.product_id == Product.id) \
+            .filter(User.telegram_id == user_id) \
+            .order_by(CartItem.id).all()
         return [
             {
                 'id': item.id,
                 'product_id': item.product_id,
                 'quantity': item.quantity,
-                'name': item.product.name,
-                'price': item.product.price
+                'name': item.name,
+                'price': item.price
             }
             for item in items
         ]
@@ -353,139 +650,444 @@ def clear_cart(user_id):
         session.query(CartItem).filter_by(cart_id=cart.id).delete()
         return True
 
-def create_order(user_id):
-    """Создание заказа из корзины"""
+def checkout(user_id):
+    """Оформление заказа из корзины одной транзакцией
+
+    Цены фиксируются на момент оформления, корзина очищается в той же
+    транзакции. Возвращает сводку заказа для уведомления администраторов
+    или None, если корзина пуста.
+    """
     with session_scope() as session:
-        user = session.query(User).filter_by(telegram_id=user_id).first()
-        if not user:
-            return None
-        
-        cart = session.query(Cart).filter_by(user_id=user.id).first()
-        if not cart:
+        # Удаление строк корзины начинает транзакцию записи и сразу фиксирует ее состав
+        cart_ids = select(Cart.id).join(User, Cart.user_id == User.id).where(User.telegram_id == user_id)
+        lines = session.execute(
+            delete(CartItem).where(CartItem.cart_id.in_(cart_ids))
+            .returning(CartItem.id, CartItem.product_id, CartItem.quantity)
+        ).all()
+        if not lines:
             return None
         
-        items = session.query(CartItem).filter_by(cart_id=cart.id).all()
+        products = {
+            row.id: row
+            for row in session.query(Product.id, Product.name, Product.price)
+            .filter(Product.id.in_([line.product_id for line in lines])).all()
+        }
+        user = session.query(User.id, User.username).filter_by(telegram_id=user_id).one()
+        items = [
+            {
+                'product_id': line.product_id,
+                'name': products[line.product_id].name,
+                'quantity': line.quantity,
+                'price': products[line.product_id].price
+            }
+            for line in sorted(lines, key=lambda line: line.id)
+            if line.product_id in products
+        ]
         if not items:
             return None
         
-        order = Order(user_id=user.id)
-        session.add(order)
-        session.flush()
-        
-        for item in items:
-            order_item = OrderItem(
-                order_id=order.id,
-                product_id=item.product_id,
-                quantity=item.quantity,
-                price=item.product.price
-            )
-            session.add(order_item)
+        total = sum(item['price'] * item['quantity'] for item in items)
+        item_count = sum(item['quantity'] for item in items)
+        order_id = session.execute(
+            insert(Order).values(user_id=user.id, total=total, item_count=item_count)
+            .returning(Order.id)
+        ).scalar()
+        # Все позиции заказа одним executemany
+        session.execute(insert(OrderItem), [
+            {
+                'order_id': order_id,
+                'product_id': item['product_id'],
+                'quantity': item['quantity'],
+                'price': item['price']
+            }
+            for item in items
+        ])
         
-        session.query(CartItem).filter_by(cart_id=cart.id).delete()
-        return order.id
+        return {
+            'order_id': order_id,
+            'user_id': user_id,
+            'username': f"@{user.username}" if user.username else "Не указан",
+            'items': [
+                {'name': item['name'], 'quantity': item['quantity'], 'price': item['price']}
+                for item in items
+            ],
+            'total': total,
+            'item_count': item_count
+        }
+
+def create_order(user_id):
+    """Создание заказа из корзины"""
+    summary = checkout(user_id)
+    return summary['order_id'] if summary else None
 
 def get_order_details(order_id):
     """Получение деталей заказа"""
     with session_scope() as session:
-        order = session.query(Order).filter_by(id=order_id).first()
-        if not order:
+        # Заказ, покупатель и позиции одним запросом
+        rows = session.query(
+            Order.id,
+            Order.total,
+            Order.item_count,
+            User.telegram_id,
+            User.username,
+            OrderItem.id.label('item_id'),
+            Product.name,
+            OrderItem.quantity,
+            OrderItem.price
+        ).join(User, Order.user_id == User.id) \
+            .outerjoin(OrderItem, OrderItem.order_id == Order.id) \
+            .outerjoin(Product, OrderItem.product_id == Product.id) \
+            .filter(Order.id == order_id) \
+            .order_by(OrderItem.id).all()
+        if not rows:
             return None
         
-        items = session.query(OrderItem).filter_by(order_id=order_id).all()
+        order = rows[0]
+        items = [row for row in rows if row.item_id is not None]
         return {
             'order_id': order.id,
-            'user_id': order.user.telegram_id,
-            'username': f"@{order.user.username}" if order.user.username else "Не указан",
+            'user_id': order.telegram_id,
+            'username': f"@{order.username}" if order.username else "Не указан",
             'items': [
                 {
-                    'name': item.product.name,
+                    'name': item.name,
                     'quantity': item.quantity,
                     'price': item.price
                 }
                 for item in items
             ],
-            'total': sum(item.price * item.quantity for item in items)
+            'total': order.total if order.total is not None else sum(item.price * item.quantity for item in items),
+            'item_count': order.item_count if order.item_count is not None else sum(item.quantity for item in items)
         }
 
+# Хранилище состояний FSM (fsm_storage.SQLiteStorage) тоже работает через
+# отдельные соединения: его вызывают из пула потоков вне сессий обработчиков
+def get_fsm_keys(updated_after):
+    """Ключи сохраненных состояний FSM, измененных после updated_after"""
+    with engine.connect() as connection:
+        return connection.execute(
+            select(FsmRecord.key).where(FsmRecord.updated_at >= updated_after)
+        ).scalars().all()
+
+def load_fsm_record(key):
+    """Состояние FSM: (state, data в JSON, updated_at) или None"""
+    with engine.connect() as connection:
+        return connection.execute(
+            select(FsmRecord.state, FsmRecord.data, FsmRecord.updated_at).where(FsmRecord.key == key)
+        ).first()
+
+def save_fsm_records(records, expired_before=None):
+    """Пакетная запись состояний FSM: [(key, state, data в JSON, updated_at)]
+
+    Записи без состояния и данных удаляются. Если задан expired_before,
+    в той же транзакции удаляются состояния, не менявшиеся с этого времени.
+    Возвращает число удаленных устаревших состояний.
+    """
+    upserts = [
+        {'key': key, 'state': state, 'data': data, 'updated_at': updated_at}
+        for key, state, data, updated_at in records if state is not None or data is not None
+    ]
+    deletes = [key for key, state, data, _ in records if state is None and data is None]
+    with engine.begin() as connection:
+        if upserts:
+            stmt = sqlite_insert(FsmRecord).values(upserts)
+            connection.execute(stmt.on_conflict_do_update(
+                index_elements=['key'],
+                set_={
+                    'state': stmt.excluded.state,
+                    'data': stmt.excluded.data,
+                    'updated_at': stmt.excluded.updated_at,
+                }
+            ))
+        if deletes:
+            connection.execute(delete(FsmRecord).where(FsmRecord.key.in_(deletes)))
+        if expired_before is None:
+            return 0
+        return connection.execute(delete(FsmRecord).where(FsmRecord.updated_at < expired_before)).rowcount
+
+def _load_admin_ids():
+    """id администраторов из базы для реестра ролей"""
+    with engine.connect() as conn:
+        return conn.execute(select(User.telegram_id).where(User.is_admin == True)).scalars().all()  # noqa: E712
+
+# Администраторы в памяти; обновляются функциями, которые меняют is_admin
+role_registry = RoleRegistry(_load_admin_ids)
+
+def admin_ids_cached():
+    """Загружен ли список администраторов в память"""
+    return role_registry.is_loaded()
+
 def get_admin_ids():
     """Получение списка ID администраторов"""
-    with session_scope() as session:
-        admins = session.query(User).filter_by(is_admin=True).all()
-        return [admin.telegram_id for admin in admins]
+    return role_registry.admin_ids()
 
-def export_products(backup_file):
-    """Экспортирует все товары в JSON-файл"""
+# Форматы резервной копии каталога
+EXPORT_FORMATS = ('json', 'ndjson')
+BACKUP_EXTENSIONS = ('.json', '.ndjson', '.json.gz', '.ndjson.gz')
+
+# umask процесса; читается один раз при импорте, пока нет других потоков
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+def _replacement_mode(path):
+    """Права для файла, который заменит path: как у него, а для нового — как у open()"""
     try:
-        with session_scope() as session:
-            # Получаем все товары с информацией о категориях
-            products = session.query(Product).all()
-            
-            # Преобразуем в список словарей
-            products_data = []
-            for product in products:
-                product_dict = {
-                    'id': product.id,
-                    'name': product.name,
-                    'description': product.description,
-                    'price': float(product.price),
-                    'category': product.category.name,
-                    'image_path': product.image_path
-                }
-                products_data.append(product_dict)
-            
-            # Удаляем старый файл, если он существует
-            if os.path.exists(backup_file):
-                os.remove(backup_file)
-            
-            # Записываем в файл
-            with open(backup_file, 'w', encoding='utf-8') as f:
-                json.dump(products_data, f, ensure_ascii=False, indent=4)
-            
-            logger.info(f"Successfully exported {len(products_data)} products to {backup_file}")
-            return True
-            
+        return os.stat(path).st_mode & 0o7777
+    except FileNotFoundError:
+        return 0o666 & ~_UMASK
+
+def _fsync_directory(directory):
+    """Сброс на диск записи каталога после переименования файла"""
+    if not hasattr(os, 'O_DIRECTORY'):
+        return
+    fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def export_products(backup_file, fmt='json', compress=False):
+    """Экспортирует все товары в файл резервной копии
+
+    Товары читаются из базы порциями и сразу пишутся во временный файл,
+    который после fsync атомарно заменяет backup_file. Поддерживаются
+    JSON с отступами, NDJSON и сжатие gzip. Возвращает rows, bytes
+    и seconds или False при ошибке.
+    """
+    if fmt not in EXPORT_FORMATS:
+        logger.error(f"Unknown export format: {fmt}")
+        return False
+    
+    start = time.perf_counter()
+    directory = os.path.dirname(backup_file) or '.'
+    tmp_path = None
+    rows = 0
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.export_', suffix='.tmp')
+        with os.fdopen(fd, 'wb') as raw:
+            stream = gzip.GzipFile(fileobj=raw, mode='wb') if compress else raw
+            with session_scope() as session:
+                # Товары с категориями одним запросом, порциями по 500 строк
+                products = _product_query(session).order_by(Product.id).yield_per(500)
+                if fmt == 'ndjson':
+                    for product in products:
+                        product_dict = _product_to_dict(product)
+                        product_dict['price'] = float(product.price)
+                        stream.write((json.dumps(product_dict, ensure_ascii=False) + '\n').encode('utf-8'))
+                        rows += 1
+                else:
+                    # Тот же вид, что у json.dump(..., indent=4), но без списка в памяти
+                    for product in products:
+                        product_dict = _product_to_dict(product)
+                        product_dict['price'] = float(product.price)
+                        item = json.dumps(product_dict, ensure_ascii=False, indent=4).replace('\n', '\n    ')
+                        stream.write((',\n    ' if rows else '[\n    ').encode('utf-8') + item.encode('utf-8'))
+                        rows += 1
+                    stream.write(b'\n]' if rows else b'[]')
+            if compress:
+                stream.close()
+            raw.flush()
+            # mkstemp создает файл с правами 0600; оставляем права прежней копии
+            os.fchmod(raw.fileno(), _replacement_mode(backup_file))
+            os.fsync(raw.fileno())
+        
+        os.replace(tmp_path, backup_file)
+        _fsync_directory(directory)
+        
+        stats = {
+            'rows': rows,
+            'bytes': os.path.getsize(backup_file),
+            'seconds': time.perf_counter() - start
+        }
+        logger.info(f"Successfully exported {rows} products to {backup_file} ({stats['bytes']} bytes)")
+        return stats
+    
     except Exception as e:
         logger.error(f"Error exporting products: {e}")
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
         return False
 
-def import_products(backup_file):
-    """Импорт товаров из резервной копии"""
+# Размер пакета для вставки товаров при импорте
+IMPORT_BATCH_SIZE = 1000
+
+def _iter_backup_records(f, chunk_size=64 * 1024):
+    """Потоковое чтение товаров из JSON-массива или NDJSON без загрузки файла целиком"""
+    decoder = json.JSONDecoder()
+    buffer = f.read(chunk_size)
+    pos = len(buffer) - len(buffer.lstrip())
+    
+    if not buffer[pos:pos + 1] == '[':
+        # NDJSON: один товар в строке
+        for line in io.StringIO(buffer + f.readline()):
+            if line.strip():
+                yield json.loads(line)
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+        return
+    
+    pos += 1
+    while True:
+        # Пропускаем пробелы и запятые между элементами массива
+        while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+            pos += 1
+        if pos == len(buffer):
+            buffer, pos = f.read(chunk_size), 0
+            if not buffer:
+                raise ValueError("Unexpected end of backup file")
+            continue
+        if buffer[pos] == ']':
+            return
+        if buffer[pos] != '{':
+            raise ValueError(f"Unexpected character in backup file: {buffer[pos]!r}")
+        try:
+            record, pos = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            # Объект не поместился в буфер: дочитываем следующий блок
+            chunk = f.read(chunk_size)
+            if not chunk:
+                raise
+            buffer, pos = buffer[pos:] + chunk, 0
+            continue
+        yield record
+
+# Сколько путей отсутствующих картинок показать в сводке импорта
+MISSING_IMAGE_EXAMPLES = 5
+
+def _adopt_image_path(image_path, adopted, missing):
+    """Путь картинки из резервной копии в хранилище по хешу
+
+    Старые резервные копии ссылаются на images/product_*.jpg и
+    product_images/; такие файлы переносятся в хранилище так же, как при
+    миграции. adopted — кэш уже перенесенных путей, в missing собираются
+    пути отсутствующих файлов для сводки после импорта.
+    """
+    if not image_path or image_path == DEFAULT_IMAGE or is_stored(image_path):
+        return image_path
+    if image_path not in adopted:
+        adopted[image_path] = adopt_file(image_path) if os.path.isfile(image_path) else None
+    if adopted[image_path] is None:
+        missing.add(image_path)
+        return image_path
+    return adopted[image_path]
+
+def import_products(backup_file, update_existing=False):
+    """Импорт товаров из резервной копии
+
+    Товары читаются потоково и вставляются пакетами в одной транзакции.
+    Существующие товары (то же название в той же категории) пропускаются,
+    а при update_existing=True обновляются. Возвращает счетчики
+    inserted, updated и skipped или False при ошибке.
+    """
+    stats = {'inserted': 0, 'updated': 0, 'skipped': 0}
     try:
-        with open(backup_file, 'r', encoding='utf-8') as f:
-            products_data = json.load(f)
-        
-        with session_scope() as session:
-            for product_data in products_data:
-                # Получаем категорию
-                category = session.query(Category).filter_by(name=product_data['category']).first()
-                if not category:
+        opener = gzip.open if backup_file.endswith('.gz') else open
+        with opener(backup_file, 'rt', encoding='utf-8') as f, session_scope() as session:
+            # Загружаем категории и ключи существующих товаров один раз
+            categories = dict(session.query(Category.name, Category.id).all())
+            existing = {
+                (name, category_id): product_id
+                for product_id, name, category_id in session.query(Product.id, Product.name, Product.category_id)
+            }
+            
+            inserts, updates = [], []
+            adopted, missing = {}, set()
+            for product_data in _iter_backup_records(f):
+                category_id = categories.get(product_data['category'])
+                if category_id is None:
                     logger.warning(f"Category {product_data['category']} not found, skipping product {product_data['name']}")
+                    stats['skipped'] += 1
                     continue
                 
-                # Проверяем, существует ли уже такой товар
-                existing_product = session.query(Product).filter_by(
-                    name=product_data['name'],
-                    category_id=category.id
-                ).first()
+                key = (product_data['name'], category_id)
+                is_new = key not in existing
+                if not is_new and not (update_existing and existing[key] is not None):
+                    stats['skipped'] += 1
+                    continue
                 
-                if not existing_product:
-                    # Создаем новый товар
-                    product = Product(
-                        name=product_data['name'],
-                        description=product_data['description'],
-                        price=product_data['price'],
-                        category_id=category.id,
-                        image_path=product_data['image_path']
-                    )
-                    session.add(product)
+                # Картинки переносятся только для товаров, которые записываются
+                values = {
+                    'name': product_data['name'],
+                    'description': product_data['description'],
+                    'price': product_data['price'],
+                    'category_id': category_id,
+                    'image_path': _adopt_image_path(product_data['image_path'], adopted, missing)
+                }
+                if is_new:
+                    inserts.append(values)
+                    existing[key] = None
+                else:
+                    updates.append(dict(values, id=existing[key]))
+                
+                if len(inserts) >= IMPORT_BATCH_SIZE:
+                    session.execute(insert(Product), inserts)
+                    stats['inserted'] += len(inserts)
+                    inserts = []
+                if len(updates) >= IMPORT_BATCH_SIZE:
+                    session.execute(update(Product), updates)
+                    stats['updated'] += len(updates)
+                    updates = []
+            
+            if inserts:
+                session.execute(insert(Product), inserts)
+                stats['inserted'] += len(inserts)
+            if updates:
+                session.execute(update(Product), updates)
+                stats['updated'] += len(updates)
             
             session.commit()
-            logger.info(f"Imported {len(products_data)} products from {backup_file}")
-            return True
+            catalog_cache.invalidate()
+            if missing:
+                examples = ', '.join(sorted(missing)[:MISSING_IMAGE_EXAMPLES])
+                logger.warning(f"{len(missing)} images from {backup_file} not found, for example: {examples}")
+            logger.info(
+                f"Imported products from {backup_file}: {stats['inserted']} inserted, "
+                f"{stats['updated']} updated, {stats['skipped']} skipped"
+            )
+            return stats
     except Exception as e:
         logger.error(f"Error importing products: {e}")
         return False
 
+def _release_image(image_path):
+    """Удаление изображения, на которое больше не ссылается ни один товар
+
+    Одинаковые фото хранятся одним файлом, поэтому число ссылок на файл
+    определяется по products.image_path.
+    """
+    if not image_path or image_path == DEFAULT_IMAGE or not os.path.exists(image_path):
+        return
+    if not is_stored(image_path):
+        # Файлы старых каталогов остаются: на них ссылаются резервные копии
+        return
+    
+    def is_referenced():
+        with engine.connect() as connection:
+            return connection.execute(select(exists().where(Product.image_path == image_path))).scalar()
+    
+    if release_image(image_path, is_referenced):
+        media_cache.invalidate(image_path)
+    else:
+        logger.info(f"Image {image_path} is still used by other products")
+
+def release_upload(image_path):
+    """Снятие закрепления загруженного фото после записи товара
+
+    Если товар так и не сослался на файл (ошибка или отмена), файл удаляется.
+    """
+    unpin(image_path)
+    _release_image(image_path)
+
+def remove_orphan_images():
+    """Удаление файлов хранилища, на которые не ссылается ни один товар"""
+    with engine.connect() as connection:
+        referenced = set(connection.execute(select(Product.image_path).distinct()).scalars())
+    removed = collect_orphans(referenced)
+    if removed:
+        logger.info(f"Removed {removed} orphan image files")
+    return removed
+
 def delete_product(product_id):
     """Удаление товара из базы данных"""
     with session_scope() as session:
@@ -498,13 +1100,14 @@ def delete_product(product_id):
                 # Удаляем связанные записи в заказах
                 session.query(OrderItem).filter_by(product_id=product_id).delete()
                 
-                # Удаляем изображение товара, если оно существует
-                if product.image_path and os.path.exists(product.image_path):
-                    os.remove(product.image_path)
-                
                 # Удаляем товар из базы данных
+                old_image = product.image_path
                 session.delete(product)
                 session.commit()
+                catalog_cache.invalidate()
+                
+                # Удаляем изображение товара после фиксации транзакции
+                _release_image(old_image)
                 logger.info(f"Product {product_id} deleted successfully")
                 return True
             logger.error(f"Product {product_id} not found")
@@ -537,13 +1140,16 @@ def update_product(product_id, name=None, description=None, price=None, category
                 else:
                     logger.error(f"Category {category_name} not found")
                     return False
-            if image_path is not None:
-                # Удаляем старое изображение, если оно существует
-                if product.image_path and os.path.exists(product.image_path):
-                    os.remove(product.image_path)
+            old_image = None
+            if image_path is not None and image_path != product.image_path:
+                old_image = product.image_path
                 product.image_path = image_path
                 
             session.commit()
+            catalog_cache.invalidate()
+            
+            # Удаляем старое изображение после фиксации транзакции
+            _release_image(old_image)
             logger.info(f"Product {product_id} updated successfully")
             return True
             
@@ -558,8 +1164,10 @@ def update_admin_status(telegram_id: int) -> bool:
         with session_scope() as session:
             user = session.query(User).filter_by(telegram_id=telegram_id).first()
             if user:
-                is_admin = str(telegram_id) in os.getenv('ADMIN_IDS', '').split(',')
+                is_admin = telegram_id in CONFIGURED_ADMIN_IDS
                 user.is_admin = is_admin
+                session.commit()
+                role_registry.set_admin(telegram_id, is_admin)
                 logger.info(f"Updated admin status for user {telegram_id}: {is_admin}")
                 return True
             return False
@@ -571,8 +1179,93 @@ def get_all_users():
     """Получение списка всех пользователей"""
     try:
         with session_scope() as session:
-            users = session.query(User).all()
-            return [user.telegram_id for user in users]
+            users = session.query(User.telegram_id).all()
+            return [telegram_id for telegram_id, in users]
     except Exception as e:
         logger.error(f"Error getting all users: {e}")
-        return [] 
\ No newline at end of file
+        return []
+
+# Колонки рассылки, которые возвращаются обработчикам
+_BROADCAST_FIELDS = (
+    'id', 'admin_chat_id', 'status_message_id', 'content_type', 'text', 'file_id',
+    'status', 'cursor', 'total', 'sent', 'failed'
+)
+
+def _broadcast_to_dict(broadcast):
+    return {field: getattr(broadcast, field) for field in _BROADCAST_FIELDS}
+
+def create_broadcast(admin_chat_id, content_type, text=None, file_id=None):
+    """Создание задания рассылки по всем текущим пользователям"""
+    with session_scope() as session:
+        broadcast = Broadcast(
+            admin_chat_id=admin_chat_id,
+            content_type=content_type,
+            text=text,
+            file_id=file_id,
+            status='running',
+            cursor=0,
+            total=session.query(func.count(User.id)).scalar(),
+            sent=0,
+            failed=0
+        )
+        session.add(broadcast)
+        session.flush()
+        logger.info(f"Broadcast {broadcast.id} created for {broadcast.total} users")
+        return _broadcast_to_dict(broadcast)
+
+def get_active_broadcasts():
+    """Незавершенные рассылки для продолжения после перезапуска"""
+    with session_scope() as session:
+        broadcasts = session.query(Broadcast).filter_by(status='running').order_by(Broadcast.id).all()
+        return [_broadcast_to_dict(broadcast) for broadcast in broadcasts]
+
+def get_broadcast_recipients(after_user_id, limit):
+    """Следующая порция получателей рассылки: [(users.id, telegram_id)]"""
+    with session_scope() as session:
+        return session.query(User.id, User.telegram_id).filter(
+            User.id > after_user_id
+        ).order_by(User.id).limit(limit).all()
+
+def save_broadcast_progress(broadcast_id, cursor, sent, failed, status_message_id=None, done=False):
+    """Сохранение позиции и счетчиков рассылки"""
+    values = {'cursor': cursor, 'sent': sent, 'failed': failed}
+    if status_message_id is not None:
+        values['status_message_id'] = status_message_id
+    if done:
+        values['status'] = 'done'
+        values['finished_at'] = datetime.now()
+    with session_scope() as session:
+        session.execute(update(Broadcast).where(Broadcast.id == broadcast_id).values(**values))
+
+def get_statistics():
+    """Получение статистики магазина"""
+    with session_scope() as session:
+        popular_categories = session.query(
+            Category.name,
+            func.count(Product.id).label('product_count')
+        ).join(Product).group_by(Category.name).order_by(func.count(Product.id).desc()).limit(5).all()
+        return {
+            'total_products': session.query(Product).count(),
+            'total_categories': session.query(Category).count(),
+            'total_users': session.query(User).count(),
+            'total_orders': session.query(Order).count(),
+            'popular_categories': [(name, count) for name, count in popular_categories],
+            'catalog_cache': get_catalog_metrics(),
+            'media_cache': media_cache.metrics()
+        }
+
+def backup_database_file(backup_file):
+    """Копирование базы данных через online backup API SQLite
+
+    В режиме WAL часть данных хранится в файле -wal, поэтому простое
+    копирование shop.db может потерять последние транзакции.
+    """
+    connection = engine.raw_connection()
+    try:
+        target = sqlite3.connect(backup_file)
+        try:
+            connection.driver_connection.backup(target)
+        finally:
+            target.close()
+    finally:
+        connection.close()
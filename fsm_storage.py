@@ -0,0 +1,222 @@
+"""Хранилище состояний FSM в SQLite.
+
+Состояния и данные пошаговых диалогов (добавление и редактирование товара,
+рассылка) хранятся в таблице fsm_states базы магазина и переживают
+перезапуск бота. Перед базой стоит LRU-кэш на FSM_CACHE_SIZE ключей:
+чтение состояния обычно не обращается к базе, а изменения записываются
+пакетом раз в FSM_FLUSH_INTERVAL секунд. При запуске загружается список
+ключей, для которых в базе есть состояние, поэтому для остальных
+пользователей (почти всех) промах кэша тоже не идет в базу.
+
+Состояние, которое не менялось дольше FSM_STATE_TTL секунд, считается
+брошенным: при чтении оно сбрасывается, а из базы такие записи удаляются
+при запуске и не чаще раза в FSM_PURGE_INTERVAL секунд при записи.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage
+
+import database
+from async_db import run_blocking
+
+logger = logging.getLogger(__name__)
+
+# Сколько ключей держать в памяти
+FSM_CACHE_SIZE = int(os.getenv('FSM_CACHE_SIZE', '10000'))
+# Интервал пакетной записи изменений (секунды)
+FSM_FLUSH_INTERVAL = float(os.getenv('FSM_FLUSH_INTERVAL', '0.5'))
+# Через сколько секунд без изменений состояние считается брошенным
+FSM_STATE_TTL = float(os.getenv('FSM_STATE_TTL', str(24 * 60 * 60)))
+# Как часто удалять брошенные состояния из базы (секунды)
+FSM_PURGE_INTERVAL = 60 * 60
+
+
+def storage_key(key):
+    """Строковый ключ записи для StorageKey"""
+    return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or 0}:{key.destiny}"
+
+
+class _Record:
+    __slots__ = ('state', 'data', 'updated_at')
+
+    def __init__(self, state=None, data=None, updated_at=0.0):
+        self.state = state
+        self.data = data or {}
+        self.updated_at = updated_at
+
+    def is_empty(self):
+        return self.state is None and not self.data
+
+
+class SQLiteStorage(BaseStorage):
+    """Хранилище FSM aiogram: SQLite с LRU-кэшем и отложенной записью"""
+
+    def __init__(self, cache_size=FSM_CACHE_SIZE, flush_interval=FSM_FLUSH_INTERVAL, ttl=FSM_STATE_TTL):
+        self.cache_size = cache_size
+        self.flush_interval = flush_interval
+        self.ttl = ttl
+        # Ключ -> _Record в порядке последнего обращения
+        self._cache = OrderedDict()
+        # Измененные записи до записи в базу; вытеснение из кэша их не теряет
+        self._pending = {}
+        # Записи, которые сейчас записываются в базу
+        self._in_flight = {}
+        # Ключи, для которых в базе есть запись; None — еще не загружены
+        self._persisted = None
+        self._task = None
+        self._flushing = None
+        self._last_purge = 0.0
+        self.hits = 0
+        self.loads = 0
+        self.expired = 0
+        self.flushed_records = 0
+        self.flushed_batches = 0
+
+    async def start(self):
+        """Удаление брошенных состояний и загрузка ключей; вызывается из event loop"""
+        cutoff = time.time() - self.ttl
+        purged = await run_blocking(database.save_fsm_records, [], cutoff)
+        self._last_purge = time.time()
+        keys = set(await run_blocking(database.get_fsm_keys, cutoff))
+        # Записи, измененные во время загрузки, попадут в базу при записи
+        keys.update(self._pending)
+        self._persisted = keys
+        logger.info(f"FSM storage loaded: {len(keys)} saved states, {purged} expired removed")
+
+    async def _record(self, key):
+        """Запись для ключа из кэша, очереди записи или базы"""
+        record = self._cache.get(key)
+        if record is not None:
+            self._cache.move_to_end(key)
+            self.hits += 1
+        else:
+            record = self._pending.get(key) or self._in_flight.get(key)
+            if record is None:
+                if self._persisted is not None and key not in self._persisted:
+                    record = _Record()
+                else:
+                    row = await run_blocking(database.load_fsm_record, key)
+                    self.loads += 1
+                    record = _Record(row.state, json.loads(row.data) if row.data else None, row.updated_at) \
+                        if row else _Record()
+                # Пока шла загрузка, запись могла появиться в кэше
+                record = self._cache.setdefault(key, record)
+            else:
+                self._cache[key] = record
+            self._evict()
+
+        if not record.is_empty() and record.updated_at < time.time() - self.ttl:
+            logger.info(f"FSM state {record.state} for {key} expired")
+            self.expired += 1
+            record.state = None
+            record.data = {}
+            self._changed(key, record)
+        return record
+
+    def _evict(self):
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _changed(self, key, record):
+        record.updated_at = time.time()
+        self._pending[key] = record
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush_later())
+
+    async def set_state(self, key, state=None):
+        record = await self._record(storage_key(key))
+        record.state = state.state if isinstance(state, State) else state
+        self._changed(storage_key(key), record)
+
+    async def get_state(self, key):
+        return (await self._record(storage_key(key))).state
+
+    async def set_data(self, key, data):
+        record = await self._record(storage_key(key))
+        record.data = data.copy()
+        self._changed(storage_key(key), record)
+
+    async def get_data(self, key):
+        return (await self._record(storage_key(key))).data.copy()
+
+    async def _flush_later(self):
+        # Изменения за интервал записываются одним пакетом
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            # Отмена задачи при остановке не прерывает начатую запись
+            self._flushing = asyncio.ensure_future(self.flush())
+            await asyncio.shield(self._flushing)
+            if not self._pending:
+                return
+
+    async def flush(self):
+        """Запись измененных состояний в базу"""
+        if not self._pending:
+            return 0
+        pending, self._pending = self._pending, {}
+        self._in_flight = pending
+        # Данные сериализуются в момент записи: в базу попадает последняя версия
+        records = [
+            (key, record.state, json.dumps(record.data, ensure_ascii=False) if record.data else None, record.updated_at)
+            for key, record in pending.items()
+        ]
+        now = time.time()
+        expired_before = None
+        if now - self._last_purge >= FSM_PURGE_INTERVAL:
+            expired_before = now - self.ttl
+        try:
+            purged = await run_blocking(database.save_fsm_records, records, expired_before)
+        except Exception as e:
+            logger.error(f"Error saving {len(records)} FSM states: {e}", exc_info=True)
+            # Возвращаем в очередь, не затирая более новые изменения
+            for key, record in pending.items():
+                self._pending.setdefault(key, record)
+            return 0
+        finally:
+            self._in_flight = {}
+
+        if expired_before is not None:
+            self._last_purge = now
+            if purged:
+                logger.info(f"Removed {purged} expired FSM states")
+        if self._persisted is not None:
+            for key, state, data, _ in records:
+                if state is None and data is None:
+                    self._persisted.discard(key)
+                else:
+                    self._persisted.add(key)
+        self.flushed_records += len(records)
+        self.flushed_batches += 1
+        return len(records)
+
+    async def close(self):
+        """Запись оставшихся изменений при остановке бота"""
+        task = self._task
+        if task is not None and not task.done():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        if self._flushing is not None:
+            await self._flushing
+        await self.flush()
+
+    def metrics(self):
+        """Метрики хранилища FSM"""
+        return {
+            'cached': len(self._cache),
+            'saved': len(self._persisted) if self._persisted is not None else None,
+            'pending': len(self._pending),
+            'hits': self.hits,
+            'loads': self.loads,
+            'expired': self.expired,
+            'flushed_records': self.flushed_records,
+            'flushed_batches': self.flushed_batches,
+        }
@@ -0,0 +1,242 @@
+"""Обработка и хранение фотографий товаров.
+
+Фото скачивается из Telegram сразу в файл, затем в отдельном пуле потоков
+Pillow уменьшает его до IMAGE_MAX_SIZE по большей стороне, пересжимает в
+JPEG без метаданных (EXIF, GPS) и создает миниатюру. Pillow освобождает GIL
+при декодировании и сжатии, поэтому обработка больших фото не задерживает
+event loop и запросы к базе данных.
+
+Файлы хранятся по SHA-256 содержимого: images/<aa>/<sha256>.jpg.
+Одинаковые фото занимают место на диске один раз, а путь к файлу не
+меняется, пока не меняется содержимое. Файл удаляется, когда на него
+не ссылается ни один товар (см. database._release_image).
+
+Сохраненный файл закреплен, пока обработчик не запишет ссылку на него в
+базу и не вызовет unpin(): так удаление того же файла из-за другого
+товара не успевает удалить только что загруженное фото. Сохранение,
+закрепление и удаление файлов выполняются под одной блокировкой.
+"""
+import asyncio
+import functools
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageOps
+
+from media_cache import file_sha256
+
+logger = logging.getLogger(__name__)
+
+# Каталог хранилища изображений
+IMAGE_DIR = 'images'
+# Общая картинка товаров без фото; не удаляется и не переносится
+DEFAULT_IMAGE = os.path.join(IMAGE_DIR, 'default_product.jpg')
+
+# Наибольшая сторона фото (Telegram сам уменьшает фото до 1280)
+IMAGE_MAX_SIZE = int(os.getenv('IMAGE_MAX_SIZE', '1280'))
+THUMBNAIL_SIZE = 320
+JPEG_QUALITY = 85
+
+# Отдельный пул, чтобы обработка фото не занимала потоки базы данных
+_executor = ThreadPoolExecutor(max_workers=int(os.getenv('IMAGE_WORKERS', '2')), thread_name_prefix='image')
+
+
+# Права сохраненных файлов как у open(); mkstemp создает файлы с правами 0600
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+FILE_MODE = 0o666 & ~_UMASK
+
+# Общая блокировка сохранения и удаления файлов хранилища
+_store_lock = threading.Lock()
+# Путь -> число загрузок, ссылки на которые еще не записаны в базу
+_pins = {}
+
+
+def store_path(digest):
+    """Путь файла в хранилище по SHA-256 его содержимого"""
+    return os.path.join(IMAGE_DIR, digest[:2], f"{digest}.jpg")
+
+
+def thumbnail_path(image_path):
+    """Путь миниатюры для изображения"""
+    base, _ = os.path.splitext(image_path)
+    return f"{base}_thumb.jpg"
+
+
+def _write_temp_jpeg(image, directory):
+    """Запись JPEG без метаданных во временный файл"""
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.image_', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            # exif не передается, поэтому метаданные в файл не попадают
+            image.save(f, 'JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+            os.fchmod(f.fileno(), FILE_MODE)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    return tmp_path
+
+
+def store_file(tmp_path):
+    """Перенос готового файла в хранилище по хешу содержимого
+
+    Если такой файл уже есть, временный удаляется. Возвращает путь в
+    хранилище и признак того, что файл уже был.
+    """
+    path = store_path(file_sha256(tmp_path))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with _store_lock:
+        _pins[path] = _pins.get(path, 0) + 1
+        if os.path.exists(path):
+            os.remove(tmp_path)
+            return path, True
+        os.replace(tmp_path, path)
+        return path, False
+
+
+def unpin(path):
+    """Снятие закрепления после записи ссылки на файл в базу (или отказа от него)"""
+    with _store_lock:
+        count = _pins.get(path, 0) - 1
+        if count > 0:
+            _pins[path] = count
+        else:
+            _pins.pop(path, None)
+
+
+def is_stored(path):
+    """Лежит ли файл в хранилище по хешу (images/<aa>/<sha256>.jpg)"""
+    return os.path.dirname(os.path.dirname(path)) == IMAGE_DIR
+
+
+def adopt_file(old_path):
+    """Перенос файла из старого каталога в хранилище; возвращает новый путь
+
+    Файл связывается жесткой ссылкой (или копируется), старый файл остается.
+    """
+    new_path = store_path(file_sha256(old_path))
+    with _store_lock:
+        if not os.path.exists(new_path):
+            os.makedirs(os.path.dirname(new_path), exist_ok=True)
+            try:
+                os.link(old_path, new_path)
+            except OSError:
+                shutil.copy2(old_path, new_path)
+    return new_path
+
+
+def process_image(source_path):
+    """Уменьшение, очистка метаданных, создание миниатюры и сохранение в хранилище
+
+    Возвращает путь, размеры результата и путь миниатюры.
+    """
+    os.makedirs(IMAGE_DIR, exist_ok=True)
+    with Image.open(source_path) as source:
+        # Поворачиваем по тегу ориентации до удаления EXIF
+        image = ImageOps.exif_transpose(source)
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        image.thumbnail((IMAGE_MAX_SIZE, IMAGE_MAX_SIZE), Image.LANCZOS)
+        path, existed = store_file(_write_temp_jpeg(image, IMAGE_DIR))
+
+        try:
+            if not os.path.exists(thumbnail_path(path)):
+                thumbnail = image.copy()
+                thumbnail.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE), Image.LANCZOS)
+                tmp_path = _write_temp_jpeg(thumbnail, os.path.dirname(path))
+                os.replace(tmp_path, thumbnail_path(path))
+        except Exception:
+            unpin(path)
+            raise
+
+    return {
+        'path': path,
+        'thumbnail': thumbnail_path(path),
+        'width': image.width,
+        'height': image.height,
+        'bytes': os.path.getsize(path),
+        'deduplicated': existed,
+    }
+
+
+def remove_image(image_path):
+    """Удаление изображения вместе с миниатюрой"""
+    for path in (image_path, thumbnail_path(image_path)):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def release_image(image_path, is_referenced):
+    """Удаление файла хранилища, если он не закреплен и is_referenced() ложно
+
+    Проверка ссылок и удаление идут под блокировкой сохранения, поэтому
+    загрузка того же фото не может получить путь к удаляемому файлу.
+    Возвращает True, если файл удален.
+    """
+    with _store_lock:
+        if image_path in _pins or is_referenced():
+            return False
+        remove_image(image_path)
+        return True
+
+
+def collect_orphans(referenced):
+    """Удаление файлов хранилища, на которые нет ссылок, и брошенных временных файлов
+
+    Вызывается при запуске, пока загрузок нет. referenced — множество путей
+    из products.image_path. Возвращает число удаленных файлов.
+    """
+    removed = 0
+    if not os.path.isdir(IMAGE_DIR):
+        return removed
+    with _store_lock:
+        for directory, _, names in os.walk(IMAGE_DIR):
+            for name in names:
+                path = os.path.join(directory, name)
+                if name.startswith(('.image_', '.download_')) and name.endswith('.tmp'):
+                    # Остался от прерванной обработки
+                    os.remove(path)
+                    removed += 1
+                    continue
+                if not is_stored(path) or not name.endswith('.jpg'):
+                    continue
+                image_path = path[:-len('_thumb.jpg')] + '.jpg' if name.endswith('_thumb.jpg') else path
+                if image_path in referenced or image_path in _pins:
+                    continue
+                os.remove(path)
+                removed += 1
+    return removed
+
+
+async def run_in_pool(func, *args):
+    """Выполнение функции в пуле обработки изображений"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(func, *args))
+
+
+async def save_photo(bot, photo):
+    """Скачивание фото из Telegram, обработка в пуле потоков и сохранение в хранилище"""
+    os.makedirs(IMAGE_DIR, exist_ok=True)
+    fd, download_path = tempfile.mkstemp(dir=IMAGE_DIR, prefix='.download_', suffix='.tmp')
+    os.close(fd)
+    try:
+        # Файл пишется на диск по частям, без копии в памяти
+        await bot.download(photo, destination=download_path)
+        result = await run_in_pool(process_image, download_path)
+        logger.info(
+            f"Saved product photo {result['path']}: {result['width']}x{result['height']}, "
+            f"{result['bytes']} bytes{' (already stored)' if result['deduplicated'] else ''}"
+        )
+        return result
+    finally:
+        if os.path.exists(download_path):
+            os.remove(download_path)
+
+
+def shutdown():
+    """Остановка пула обработки изображений"""
+    _executor.shutdown(wait=True)
@@ -0,0 +1,97 @@
+"""Кэш file_id загруженных в Telegram файлов.
+
+После первой отправки файла Telegram возвращает file_id, по которому тот же
+файл можно отправлять повторно без загрузки. Идентификаторы хранятся по
+SHA-256 содержимого файла, поэтому одинаковые картинки под разными путями
+используют один file_id, а замененный файл получает новый ключ.
+Хеш файла пересчитывается только при изменении его размера или mtime.
+"""
+import hashlib
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def file_sha256(path, chunk_size=64 * 1024):
+    """SHA-256 содержимого файла"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class MediaCache:
+    """Соответствие хеша файла и его file_id в Telegram"""
+
+    def __init__(self, loader, saver, deleter):
+        # loader() -> {sha256: file_id}, saver(sha256, file_id), deleter(sha256)
+        self._loader = loader
+        self._saver = saver
+        self._deleter = deleter
+        self._lock = threading.Lock()
+        self._file_ids = None
+        # Путь -> (mtime_ns, size, sha256)
+        self._hashes = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _ensure_loaded(self):
+        if self._file_ids is None:
+            with self._lock:
+                if self._file_ids is None:
+                    self._file_ids = self._loader()
+        return self._file_ids
+
+    def file_key(self, path):
+        """Хеш файла с пересчетом только после его изменения"""
+        stat = os.stat(path)
+        cached = self._hashes.get(path)
+        if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+            return cached[2]
+        key = file_sha256(path)
+        self._hashes[path] = (stat.st_mtime_ns, stat.st_size, key)
+        return key
+
+    def get(self, path):
+        """file_id для файла или None, если файл еще не загружался"""
+        file_id = self._ensure_loaded().get(self.file_key(path))
+        if file_id:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return file_id
+
+    def remember(self, path, file_id):
+        """Сохранение file_id после загрузки файла"""
+        key = self.file_key(path)
+        file_ids = self._ensure_loaded()
+        if file_ids.get(key) == file_id:
+            return
+        file_ids[key] = file_id
+        self._saver(key, file_id)
+
+    def forget(self, path):
+        """Удаление file_id, который Telegram больше не принимает"""
+        cached = self._hashes.get(path)
+        key = cached[2] if cached else None
+        if key is None and os.path.exists(path):
+            key = self.file_key(path)
+        if key is not None and self._ensure_loaded().pop(key, None) is not None:
+            self._deleter(key)
+            logger.info(f"Forgot Telegram file_id for {path}")
+
+    def invalidate(self, path):
+        """Сброс кэша для пути, файл по которому заменен или удален"""
+        self.forget(path)
+        self._hashes.pop(path, None)
+
+    def metrics(self):
+        """Метрики кэша"""
+        return {
+            'files': len(self._file_ids or {}),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
@@ -0,0 +1,150 @@
+"""Версионные миграции схемы базы данных.
+
+Номер версии схемы хранится в PRAGMA user_version файла SQLite.
+Новая база создается через create_all сразу в актуальной схеме и получает
+последнюю версию, существующая база обновляется по шагам из MIGRATIONS.
+Каждая миграция идемпотентна, поэтому прерванное обновление можно повторить.
+"""
+import logging
+import os
+
+from sqlalchemy import text
+
+from image_pipeline import DEFAULT_IMAGE, adopt_file, is_stored
+
+logger = logging.getLogger(__name__)
+
+
+def get_schema_version(connection):
+    """Получение текущей версии схемы"""
+    return connection.execute(text("PRAGMA user_version")).scalar()
+
+
+def set_schema_version(connection, version):
+    """Запись версии схемы"""
+    connection.execute(text(f"PRAGMA user_version = {int(version)}"))
+
+
+def _add_secondary_indexes(connection):
+    # Объединяем повторяющиеся строки корзины перед созданием уникального индекса
+    connection.execute(text("""
+        UPDATE cart_items SET quantity = (
+            SELECT SUM(duplicate.quantity) FROM cart_items AS duplicate
+            WHERE duplicate.cart_id = cart_items.cart_id
+              AND duplicate.product_id = cart_items.product_id
+        )
+        WHERE id IN (
+            SELECT MIN(id) FROM cart_items
+            GROUP BY cart_id, product_id HAVING COUNT(*) > 1
+        )
+    """))
+    connection.execute(text("""
+        DELETE FROM cart_items WHERE id NOT IN (
+            SELECT MIN(id) FROM cart_items GROUP BY cart_id, product_id
+        )
+    """))
+    connection.execute(text(
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_cart_items_cart_product ON cart_items (cart_id, product_id)"
+    ))
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_carts_user_id ON carts (user_id)"))
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_products_category_id ON products (category_id)"))
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_order_items_order_id ON order_items (order_id)"))
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_categories_name ON categories (name)"))
+
+
+def _unique_cart_per_user(connection):
+    # Переносим строки из повторных корзин пользователя в самую раннюю
+    connection.execute(text("""
+        INSERT INTO cart_items (cart_id, product_id, quantity)
+        SELECT kept.id, cart_items.product_id, cart_items.quantity
+        FROM cart_items
+        JOIN carts ON carts.id = cart_items.cart_id
+        JOIN (SELECT user_id, MIN(id) AS id FROM carts GROUP BY user_id) AS kept
+          ON kept.user_id = carts.user_id
+        WHERE carts.id != kept.id
+        ON CONFLICT (cart_id, product_id) DO UPDATE SET quantity = quantity + excluded.quantity
+    """))
+    duplicate_carts = """
+        SELECT id FROM carts WHERE user_id IS NOT NULL AND id NOT IN (
+            SELECT MIN(id) FROM carts GROUP BY user_id
+        )
+    """
+    connection.execute(text(f"DELETE FROM cart_items WHERE cart_id IN ({duplicate_carts})"))
+    connection.execute(text(f"DELETE FROM carts WHERE id IN ({duplicate_carts})"))
+    connection.execute(text("DROP INDEX IF EXISTS ix_carts_user_id"))
+    connection.execute(text("CREATE UNIQUE INDEX ix_carts_user_id ON carts (user_id)"))
+
+
+def _add_column(connection, table, column, ddl):
+    """Добавление колонки, если ее еще нет"""
+    columns = [row[1] for row in connection.execute(text(f"PRAGMA table_info({table})"))]
+    if column not in columns:
+        connection.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+
+
+def _order_totals(connection):
+    _add_column(connection, 'orders', 'total', 'FLOAT')
+    _add_column(connection, 'orders', 'item_count', 'INTEGER')
+    # Заполняем итоги для уже оформленных заказов
+    connection.execute(text("""
+        UPDATE orders SET
+            total = (SELECT COALESCE(SUM(price * quantity), 0) FROM order_items WHERE order_id = orders.id),
+            item_count = (SELECT COALESCE(SUM(quantity), 0) FROM order_items WHERE order_id = orders.id)
+        WHERE total IS NULL
+    """))
+
+
+def _content_addressed_images(connection):
+    # Переносим картинки товаров в хранилище images/<aa>/<sha256>.jpg.
+    # Файлы связываются жесткой ссылкой (или копируются), а старые файлы
+    # остаются: на них ссылаются резервные копии (см. database._adopt_image_path)
+    paths = [row[0] for row in connection.execute(text(
+        "SELECT DISTINCT image_path FROM products WHERE image_path IS NOT NULL"
+    ))]
+    for old_path in paths:
+        if old_path == DEFAULT_IMAGE or not os.path.isfile(old_path):
+            continue
+        if is_stored(old_path):
+            continue
+        new_path = adopt_file(old_path)
+        connection.execute(
+            text("UPDATE products SET image_path = :new_path WHERE image_path = :old_path"),
+            {'new_path': new_path, 'old_path': old_path}
+        )
+        logger.info(f"Moved image {old_path} to {new_path}")
+
+
+# Список миграций: (версия, описание, функция)
+MIGRATIONS = [
+    (1, "secondary indexes and unique cart lines", _add_secondary_indexes),
+    (2, "one cart per user", _unique_cart_per_user),
+    (3, "denormalized order totals", _order_totals),
+    (4, "content-addressed image store", _content_addressed_images),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def stamp_latest(engine):
+    """Отметка новой базы как созданной в актуальной схеме"""
+    with engine.begin() as connection:
+        set_schema_version(connection, LATEST_VERSION)
+    logger.info(f"Database schema created at version {LATEST_VERSION}")
+
+
+def run_migrations(engine):
+    """Применение всех миграций новее текущей версии схемы"""
+    with engine.connect() as connection:
+        current_version = get_schema_version(connection)
+
+    for version, description, migration in MIGRATIONS:
+        if version <= current_version:
+            continue
+        logger.info(f"Applying migration {version}: {description}")
+        with engine.begin() as connection:
+            migration(connection)
+            set_schema_version(connection, version)
+        current_version = version
+
+    logger.info(f"Database schema is at version {current_version}")
+    return current_version
@@ -0,0 +1,58 @@
+"""Ограничение частоты запросов к Telegram Bot API.
+
+Telegram допускает около 30 сообщений в секунду от бота и около одного
+сообщения в секунду в один чат; при превышении он отвечает RetryAfter.
+"""
+import asyncio
+import time
+
+
+class TokenBucket:
+    """Асинхронное ведро токенов: rate токенов в секунду, не больше capacity"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self):
+        """Сколько секунд придется ждать токен сейчас (0, если он есть)"""
+        now = time.monotonic()
+        self._refill(now)
+        wait = max(0.0, self._paused_until - now)
+        if self._tokens < 1:
+            wait = max(wait, (1 - self._tokens) / self.rate)
+        return wait
+
+    def try_acquire(self):
+        """Получение токена без ожидания; False, если токена нет"""
+        if self.delay() > 0:
+            return False
+        self._tokens -= 1
+        return True
+
+    async def acquire(self):
+        """Ожидание и получение одного токена; возвращает время ожидания"""
+        waited = 0.0
+        async with self._lock:
+            while True:
+                wait = self.delay()
+                if wait <= 0:
+                    self._tokens -= 1
+                    return waited
+                await asyncio.sleep(wait)
+                waited += wait
+
+    def pause(self, seconds):
+        """Остановка выдачи токенов (например, после RetryAfter)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        # Токены снова копятся только после окончания паузы
+        self._tokens = 0.0
+        self._updated = self._paused_until
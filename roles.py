@@ -0,0 +1,116 @@
+"""Роли пользователей в памяти процесса.
+
+Администраторы — пользователи с users.is_admin. Их id загружаются один раз
+при запуске (init_db) и обновляются функциями, которые меняют is_admin
+(add_user, update_admin_status), поэтому проверка прав на каждом
+обновлении не обращается к базе данных. Переменная ADMIN_IDS тоже
+разбирается один раз, здесь.
+"""
+import logging
+import os
+import threading
+
+from aiogram import BaseMiddleware
+from aiogram.types import CallbackQuery, Message
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+
+def parse_admin_ids(value):
+    """Разбор списка id через запятую; некорректные значения пропускаются"""
+    admin_ids = set()
+    for part in value.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        try:
+            admin_ids.add(int(part))
+        except ValueError:
+            logger.warning(f"Invalid admin id in ADMIN_IDS: {part!r}")
+    return frozenset(admin_ids)
+
+
+# Администраторы из окружения
+ADMIN_IDS = parse_admin_ids(os.getenv('ADMIN_IDS', ''))
+# Дополнительные администраторы помимо ADMIN_IDS
+ADDITIONAL_ADMIN_IDS = frozenset({231916981, 5817829191, 1009069570})
+# С этим списком сверяется статус при инициализации базы и при входе пользователя
+CONFIGURED_ADMIN_IDS = ADMIN_IDS | ADDITIONAL_ADMIN_IDS
+
+DENIED_TEXT = "❌ У вас нет доступа к этой команде"
+
+
+class RoleRegistry:
+    """Множество id администраторов в памяти
+
+    Множество неизменяемое и заменяется целиком, поэтому проверка
+    is_admin() не берет блокировку.
+    """
+
+    def __init__(self, loader):
+        # loader() возвращает id администраторов из базы данных
+        self._loader = loader
+        self._lock = threading.Lock()
+        self._admins = None
+
+    def load(self):
+        """Загрузка администраторов из базы данных"""
+        admins = frozenset(self._loader())
+        with self._lock:
+            self._admins = admins
+        logger.info(f"Role registry loaded: {len(admins)} admins")
+
+    def is_loaded(self):
+        return self._admins is not None
+
+    def _current(self):
+        admins = self._admins
+        if admins is None:
+            with self._lock:
+                if self._admins is None:
+                    self._admins = frozenset(self._loader())
+                admins = self._admins
+        return admins
+
+    def is_admin(self, telegram_id):
+        """Является ли пользователь администратором"""
+        return telegram_id in self._current()
+
+    def admin_ids(self):
+        """Список id администраторов"""
+        return list(self._current())
+
+    def set_admin(self, telegram_id, is_admin):
+        """Обновление после изменения users.is_admin в базе данных"""
+        with self._lock:
+            if self._admins is None:
+                return
+            if is_admin:
+                self._admins = self._admins | {telegram_id}
+            else:
+                self._admins = self._admins - {telegram_id}
+
+
+class AdminMiddleware(BaseMiddleware):
+    """Пропускает к обработчикам роутера только администраторов
+
+    Подключается как внутренний middleware, поэтому срабатывает только для
+    обновлений, которые прошли фильтры одного из обработчиков роутера.
+    """
+
+    def __init__(self, registry, denied_text=DENIED_TEXT):
+        self.registry = registry
+        self.denied_text = denied_text
+
+    async def __call__(self, handler, event, data):
+        user = data.get('event_from_user')
+        if user is not None and self.registry.is_admin(user.id):
+            return await handler(event, data)
+
+        logger.warning(f"Admin access denied for user {user.id if user else None}")
+        if isinstance(event, (Message, CallbackQuery)):
+            await event.answer(self.denied_text)
+        return None
@@ -0,0 +1,178 @@
+"""Единая очередь исходящих запросов к Telegram Bot API.
+
+SendScheduler подключается к сессии бота как middleware, поэтому через него
+проходят все отправки: ответы обработчиков, уведомления администраторам и
+рассылки. Для каждого чата действует свое ведро токенов (около 1 сообщения
+в секунду), для бота в целом — общее (около 30 в секунду). Общие токены
+выдаются по приоритету: ответы пользователям раньше массовых отправок,
+поэтому рассылка не задерживает работу магазина.
+При RetryAfter и сетевых ошибках запрос повторяется с ожиданием.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from aiogram import methods
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Общий лимит сообщений в секунду для бота
+SEND_RATE = float(os.getenv('SEND_RATE', '30'))
+# Лимит сообщений в секунду в один чат и допустимый всплеск
+CHAT_SEND_RATE = float(os.getenv('CHAT_SEND_RATE', '1'))
+CHAT_SEND_BURST = 3
+# Сколько ведер чатов держать в памяти
+MAX_CHAT_BUCKETS = 10000
+# Попыток отправки и начальная задержка между ними (секунды)
+SEND_ATTEMPTS = 3
+SEND_BACKOFF = 0.5
+
+# Приоритеты отправки: меньше — раньше
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+
+send_priority = ContextVar('send_priority', default=PRIORITY_INTERACTIVE)
+
+# Методы, на которые действуют лимиты Telegram на отправку сообщений
+RATE_LIMITED_METHODS = (
+    methods.SendMessage, methods.SendPhoto, methods.SendVideo, methods.SendDocument,
+    methods.SendMediaGroup, methods.CopyMessage, methods.ForwardMessage,
+    methods.EditMessageText, methods.EditMessageCaption, methods.EditMessageMedia,
+    methods.EditMessageReplyMarkup,
+)
+
+
+@contextmanager
+def bulk_sends():
+    """Отправки внутри блока получают низкий приоритет"""
+    token = send_priority.set(PRIORITY_BULK)
+    try:
+        yield
+    finally:
+        send_priority.reset(token)
+
+
+class SendScheduler(BaseRequestMiddleware):
+    """Планировщик исходящих сообщений с лимитами и приоритетами"""
+
+    def __init__(self, rate=SEND_RATE, chat_rate=CHAT_SEND_RATE, chat_burst=CHAT_SEND_BURST,
+                 attempts=SEND_ATTEMPTS, backoff=SEND_BACKOFF):
+        self.global_bucket = TokenBucket(rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.attempts = attempts
+        self.backoff = backoff
+        self._chat_buckets = OrderedDict()
+        # Очередь ожидающих общий токен: (приоритет, номер, future)
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._dispatcher = None
+        self._chat_waiting = 0
+        self.sent = 0
+        self.retries = 0
+        self.failed = 0
+        self._waits = {PRIORITY_INTERACTIVE: [0, 0.0, 0.0], PRIORITY_BULK: [0, 0.0, 0.0]}
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+            if len(self._chat_buckets) > MAX_CHAT_BUCKETS:
+                self._chat_buckets.popitem(last=False)
+        else:
+            self._chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    async def _dispatch(self):
+        """Выдача общих токенов ожидающим в порядке приоритета"""
+        while self._waiters:
+            wait = self.global_bucket.delay()
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done() and self.global_bucket.try_acquire():
+                future.set_result(None)
+
+    async def _acquire_global(self, priority):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), future))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        await future
+
+    async def _acquire(self, chat_id, priority):
+        start = time.monotonic()
+        if chat_id is not None:
+            self._chat_waiting += 1
+            try:
+                await self._chat_bucket(chat_id).acquire()
+            finally:
+                self._chat_waiting -= 1
+        await self._acquire_global(priority)
+        waited = time.monotonic() - start
+        stats = self._waits[priority]
+        stats[0] += 1
+        stats[1] += waited
+        stats[2] = max(stats[2], waited)
+
+    async def __call__(self, make_request, bot, method):
+        if not isinstance(method, RATE_LIMITED_METHODS):
+            return await make_request(bot, method)
+
+        chat_id = getattr(method, 'chat_id', None)
+        priority = send_priority.get()
+        attempt = 0
+        while True:
+            await self._acquire(chat_id, priority)
+            try:
+                response = await make_request(bot, method)
+                self.sent += 1
+                return response
+            except TelegramRetryAfter as e:
+                attempt += 1
+                if attempt >= self.attempts:
+                    self.failed += 1
+                    raise
+                # Лимит превышен: приостанавливаем все отправки
+                logger.warning(f"Flood limit on {type(method).__name__} to {chat_id}, retry after {e.retry_after}s")
+                self.retries += 1
+                self.global_bucket.pause(e.retry_after)
+            except (TelegramNetworkError, TelegramServerError) as e:
+                attempt += 1
+                if attempt >= self.attempts:
+                    self.failed += 1
+                    raise
+                delay = self.backoff * 2 ** (attempt - 1)
+                logger.warning(f"Error sending {type(method).__name__} to {chat_id}: {e}, retry in {delay}s")
+                self.retries += 1
+                await asyncio.sleep(delay)
+
+    def metrics(self):
+        """Метрики очереди: глубина, ожидание и счетчики отправок"""
+        waits = {}
+        for priority, name in ((PRIORITY_INTERACTIVE, 'interactive'), (PRIORITY_BULK, 'bulk')):
+            count, total, maximum = self._waits[priority]
+            waits[name] = {
+                'count': count,
+                'avg_wait': total / count if count else 0.0,
+                'max_wait': maximum,
+            }
+        return {
+            'queued': sum(1 for _, _, future in self._waiters if not future.done()),
+            'chat_waiting': self._chat_waiting,
+            'sent': self.sent,
+            'retries': self.retries,
+            'failed': self.failed,
+            'waits': waits,
+        }
@@ -0,0 +1,108 @@
+"""Общие настройки тестов.
+
+Тесты работают во временном каталоге с отдельной базой данных: shop.db,
+картинки и резервные копии репозитория не изменяются. Переменные окружения
+задаются до импорта модулей бота, потому что они читаются при импорте.
+"""
+import datetime
+import itertools
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_tmp_dir = tempfile.mkdtemp(prefix='shop_tests_')
+os.chdir(_tmp_dir)
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(_tmp_dir, 'test.db')}"
+os.environ.setdefault('BOT_TOKEN', '123456:TEST-TOKEN-TEST-TOKEN-TEST-TOKEN-123')
+
+import pytest  # noqa: E402
+from aiogram import methods, types  # noqa: E402
+from aiogram.client.session.base import BaseSession  # noqa: E402
+
+_ids = itertools.count(1000)
+
+
+def _message(chat_id, **kwargs):
+    return types.Message(
+        message_id=next(_ids), date=datetime.datetime.now(),
+        chat=types.Chat(id=chat_id, type='private'), **kwargs
+    )
+
+
+class FakeSession(BaseSession):
+    """Сессия бота без сети: запоминает запросы и отвечает как Telegram
+
+    errors — {имя метода: текст ошибки TelegramBadRequest}.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+        self.errors = {}
+
+    async def close(self):
+        pass
+
+    async def stream_content(self, *args, **kwargs):
+        yield b''
+
+    async def make_request(self, bot, method, timeout=None):
+        from aiogram.exceptions import TelegramBadRequest
+
+        self.calls.append(method)
+        error = self.errors.get(type(method).__name__)
+        if error:
+            raise TelegramBadRequest(method, error)
+        chat_id = getattr(method, 'chat_id', None) or 1
+        if isinstance(method, (methods.SendPhoto, methods.EditMessageMedia)):
+            return _message(chat_id, photo=[types.PhotoSize(file_id='photo', file_unique_id='u', width=1, height=1)])
+        if isinstance(method, (methods.SendMessage, methods.EditMessageText)):
+            return _message(chat_id, text=method.text)
+        return True
+
+    def names(self):
+        return [type(call).__name__ for call in self.calls]
+
+
+@pytest.fixture(scope='session', autouse=True)
+def database_ready():
+    """Схема и начальные данные временной базы"""
+    import database
+
+    database.init_db()
+    return database
+
+
+@pytest.fixture
+def bot_module():
+    """Модуль bot с сессией без сети"""
+    import bot
+
+    session = FakeSession()
+    original = bot.bot.session
+    bot.bot.session = session
+    try:
+        yield bot
+    finally:
+        bot.bot.session = original
+
+
+def callback_update(bot_module, data, user_id=42, with_photo=False):
+    """Нажатие inline-кнопки под сообщением бота"""
+    message = {
+        'message_id': next(_ids), 'date': int(datetime.datetime.now().timestamp()),
+        'chat': {'id': user_id, 'type': 'private'},
+    }
+    if with_photo:
+        message['photo'] = [{'file_id': 'logo', 'file_unique_id': 'logo', 'width': 10, 'height': 10}]
+        message['caption'] = 'caption'
+    else:
+        message['text'] = 'text'
+    callback = {
+        'id': str(next(_ids)), 'chat_instance': 'chat', 'data': data, 'message': message,
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'User'},
+    }
+    return types.Update(update_id=next(_ids), callback_query=callback)
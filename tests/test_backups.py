@@ -0,0 +1,43 @@
+import json
+import logging
+
+import database
+
+
+def _write_backup(path, records):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(records, f, ensure_ascii=False)
+
+
+def test_import_summarizes_missing_images_and_skips_adopting_existing(tmp_path, caplog, monkeypatch):
+    category = database.get_category_list()[0]['name']
+    records = [
+        {'name': f'Импорт {i}', 'description': 'd', 'price': 1, 'category': category,
+         'image_path': f'product_images/missing_{i}.jpg'}
+        for i in range(20)
+    ]
+    backup = str(tmp_path / 'backup.json')
+    _write_backup(backup, records)
+
+    with caplog.at_level(logging.WARNING, logger='database'):
+        assert database.import_products(backup)['inserted'] == 20
+    warnings = [r for r in caplog.records if 'not found' in r.getMessage()]
+    assert len(warnings) == 1 and '20 images' in warnings[0].getMessage()
+
+    # Повторный импорт пропускает товары, не трогая их картинки
+    adopted = []
+    monkeypatch.setattr(database, '_adopt_image_path', lambda *args: adopted.append(args) or args[0])
+    caplog.clear()
+    with caplog.at_level(logging.WARNING, logger='database'):
+        assert database.import_products(backup)['skipped'] == 20
+    assert adopted == []
+    assert not [r for r in caplog.records if 'not found' in r.getMessage()]
+
+
+def test_export_into_missing_directory_returns_false(tmp_path, caplog):
+    backup = tmp_path / 'missing' / 'backup.json'
+
+    with caplog.at_level(logging.ERROR, logger='database'):
+        assert database.export_products(str(backup)) is False
+    assert 'Error exporting products' in caplog.text
+    assert not (tmp_path / 'missing').exists()
@@ -0,0 +1,33 @@
+import asyncio
+
+from PIL import Image
+
+import database
+from callback_router import pack
+from conftest import callback_update
+
+
+def _add_product(name, description, image_path):
+    category = database.get_category_list()[0]['name']
+    assert database.add_product(name, description, 100, category, image_path)
+    return max(product['id'] for product in database.get_products(category) if product['name'] == name)
+
+
+def test_long_description_is_shown_as_text(bot_module):
+    Image.new('RGB', (32, 32), 'red').save('long_description.jpg')
+    description = 'Очень подробное описание. ' * 60
+    assert len(description) > 1024
+    product_id = _add_product('Длинное описание', description, 'long_description.jpg')
+
+    session = bot_module.bot.session
+    # Так Telegram отвечает на подпись длиннее 1024 символов
+    session.errors['EditMessageMedia'] = 'Bad Request: message caption is too long'
+    session.errors['SendPhoto'] = 'Bad Request: message caption is too long'
+    update = callback_update(bot_module, pack('product', product_id), with_photo=True)
+    asyncio.run(bot_module.dp.feed_update(bot_module.bot, update))
+
+    assert 'EditMessageMedia' not in session.names()
+    assert 'SendPhoto' not in session.names()
+    sent = [call for call in session.calls if type(call).__name__ == 'SendMessage']
+    assert len(sent) == 1 and description in sent[0].text
+    assert 'DeleteMessage' in session.names()
@@ -0,0 +1,11 @@
+import pytest
+
+import database
+
+
+def test_init_db_rejects_sqlite_without_returning(monkeypatch):
+    monkeypatch.setattr(database.sqlite3, 'sqlite_version_info', (3, 31, 1))
+    monkeypatch.setattr(database.sqlite3, 'sqlite_version', '3.31.1')
+
+    with pytest.raises(RuntimeError, match='SQLite 3.35.0 or newer is required, found 3.31.1'):
+        database.init_db()
@@ -0,0 +1,20 @@
+import pytest
+
+import benchmark
+from benchmark import QUERY_BUDGETS
+
+
+@pytest.fixture(scope='module')
+def query_counts():
+    return benchmark.measure_queries()
+
+
+def test_every_budget_is_measured(query_counts):
+    assert set(query_counts) == set(QUERY_BUDGETS)
+
+
+@pytest.mark.parametrize('title', sorted(QUERY_BUDGETS))
+def test_query_budget(query_counts, title):
+    assert query_counts[title] <= QUERY_BUDGETS[title], (
+        f"{title} ran {query_counts[title]} SQL statements, budget is {QUERY_BUDGETS[title]}"
+    )
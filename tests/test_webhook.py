@@ -0,0 +1,30 @@
+import asyncio
+import os
+import signal
+
+import webhook
+
+
+def test_sigterm_stops_webhook_server(bot_module, monkeypatch):
+    monkeypatch.setattr(webhook, 'WEBHOOK_URL', '')
+    monkeypatch.setattr(webhook, 'WEBHOOK_HOST', '127.0.0.1')
+    monkeypatch.setattr(webhook, 'WEBHOOK_PORT', 0)
+    shutdowns = []
+
+    async def on_shutdown():
+        shutdowns.append(True)
+
+    async def main():
+        bot_module.dp.shutdown.register(on_shutdown)
+        try:
+            loop = asyncio.get_running_loop()
+            loop.call_later(0.2, os.kill, os.getpid(), signal.SIGTERM)
+            # Без обработчика SIGTERM процесс завершился бы, не вернувшись отсюда
+            await asyncio.wait_for(webhook.run_webhook(bot_module.dp, bot_module.bot), timeout=5)
+        finally:
+            bot_module.dp.shutdown.handlers.pop()
+
+    asyncio.run(main())
+    # Сервер остановлен через runner.cleanup(), который вызывает остановку Dispatcher
+    assert shutdowns == [True]
+    assert signal.getsignal(signal.SIGTERM) == signal.SIG_DFL
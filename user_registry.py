@@ -0,0 +1,139 @@
+"""Регистрация пользователей с отложенной записью в базу данных.
+
+/start вызывается при каждом входе в бота, и раньше каждый вызов
+записывал пользователя в базу. UserRegistry держит в памяти id известных
+пользователей и хеши их username. Повторный /start без изменений ничего
+не пишет; новые и изменившиеся пользователи ставятся в очередь, и раз в
+USER_FLUSH_INTERVAL секунд очередь записывается одним пакетным upsert.
+Статус администратора обновляется в реестре ролей сразу, не дожидаясь
+записи. Если запись не удалась, пользователи возвращаются в очередь.
+"""
+import asyncio
+import logging
+import os
+
+import database
+from async_db import run_blocking
+from roles import CONFIGURED_ADMIN_IDS
+
+logger = logging.getLogger(__name__)
+
+# Интервал записи очереди пользователей в базу (секунды)
+USER_FLUSH_INTERVAL = float(os.getenv('USER_FLUSH_INTERVAL', '0.3'))
+
+
+def _username_hash(username):
+    return hash(username) if username else None
+
+
+class UserRegistry:
+    """Известные пользователи в памяти и очередь их записи в базу"""
+
+    def __init__(self, flush_interval=USER_FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        # telegram_id -> хеш username (None, если username не известен)
+        self._known = {}
+        # telegram_id -> строка для upsert_users
+        self._pending = {}
+        self._task = None
+        self._flushing = None
+        self.skipped = 0
+        self.flushed_rows = 0
+        self.flushed_batches = 0
+        self.failed_batches = 0
+
+    async def start(self):
+        """Загрузка известных пользователей; вызывается из event loop"""
+        users = await run_blocking(database.get_known_users)
+        for telegram_id, username in users:
+            # Пользователи, зарегистрированные во время загрузки, уже новее
+            self._known.setdefault(telegram_id, _username_hash(username))
+        logger.info(f"User registry loaded: {len(users)} users")
+
+    def _is_current(self, telegram_id, username, is_admin):
+        if telegram_id not in self._known:
+            return False
+        if username and self._known[telegram_id] != _username_hash(username):
+            return False
+        return database.role_registry.is_admin(telegram_id) == is_admin
+
+    def register(self, telegram_id, username=None):
+        """Регистрация входа пользователя
+
+        Возвращает True, если пользователь новый или изменился и поставлен
+        в очередь записи.
+        """
+        is_admin = telegram_id in CONFIGURED_ADMIN_IDS
+        if self._is_current(telegram_id, username, is_admin):
+            self.skipped += 1
+            return False
+
+        if username or telegram_id not in self._known:
+            self._known[telegram_id] = _username_hash(username)
+        database.role_registry.set_admin(telegram_id, is_admin)
+        pending = self._pending.get(telegram_id)
+        if pending is not None and not username:
+            # Не теряем username из более раннего входа, который еще не записан
+            username = pending['username']
+        self._pending[telegram_id] = {'telegram_id': telegram_id, 'username': username, 'is_admin': is_admin}
+        self._schedule()
+        return True
+
+    def _schedule(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        # Собираем входы за интервал в один пакет; входы во время записи
+        # попадают в следующий пакет
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            # Отмена задачи при остановке не прерывает начатую запись
+            self._flushing = asyncio.ensure_future(self.flush())
+            await asyncio.shield(self._flushing)
+            if not self._pending:
+                return
+
+    async def flush(self):
+        """Запись очереди пользователей в базу"""
+        if not self._pending:
+            return 0
+        rows = list(self._pending.values())
+        self._pending = {}
+        try:
+            count = await run_blocking(database.upsert_users, rows)
+        except Exception as e:
+            self.failed_batches += 1
+            logger.error(f"Error flushing {len(rows)} users: {e}", exc_info=True)
+            # Возвращаем в очередь, не затирая более новые входы
+            for row in rows:
+                self._pending.setdefault(row['telegram_id'], row)
+            return 0
+        self.flushed_rows += count
+        self.flushed_batches += 1
+        logger.debug(f"Flushed {count} users")
+        return count
+
+    async def close(self):
+        """Запись оставшейся очереди при остановке бота"""
+        task = self._task
+        if task is not None and not task.done():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        if self._flushing is not None:
+            await self._flushing
+        await self.flush()
+
+    def metrics(self):
+        """Метрики реестра пользователей"""
+        return {
+            'known': len(self._known),
+            'pending': len(self._pending),
+            'skipped': self.skipped,
+            'flushed_rows': self.flushed_rows,
+            'flushed_batches': self.flushed_batches,
+            'failed_batches': self.failed_batches,
+        }
@@ -0,0 +1,124 @@
+"""Получение обновлений через webhook.
+
+Режим включается переменной RUN_MODE=webhook. Обновления принимает
+HTTP-сервер aiohttp и передает в тот же Dispatcher, что и long polling.
+Запросы без правильного секретного токена отклоняются, а одновременно
+обрабатывается не больше WEBHOOK_CONCURRENCY обновлений.
+Если WEBHOOK_URL не задан, сервер только слушает порт, не регистрируя
+webhook в Telegram: так его можно проверить, отправив сохраненные
+обновления POST-запросом на локальный адрес.
+"""
+import asyncio
+import logging
+import os
+import re
+import signal
+
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+logger = logging.getLogger(__name__)
+
+# Публичный адрес бота, например https://example.com
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+# Секрет для заголовка X-Telegram-Bot-Api-Secret-Token; обязателен в режиме webhook.
+# Он должен быть одинаковым у всех экземпляров бота и не меняться при перезапуске
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+# Сколько обновлений обрабатывать одновременно
+WEBHOOK_CONCURRENCY = int(os.getenv('WEBHOOK_CONCURRENCY', '50'))
+# Пропускать обновления, накопившиеся, пока бот был выключен
+DROP_PENDING_UPDATES = os.getenv('DROP_PENDING_UPDATES', '').lower() in ('1', 'true', 'yes')
+
+
+def check_config():
+    """Проверка настроек webhook при запуске; завершает процесс с понятной ошибкой"""
+    if not WEBHOOK_SECRET:
+        raise SystemExit("WEBHOOK_SECRET must be set when RUN_MODE=webhook")
+    # Ограничения Telegram для secret_token
+    if not re.fullmatch(r'[A-Za-z0-9_-]{1,256}', WEBHOOK_SECRET):
+        raise SystemExit("WEBHOOK_SECRET must be 1-256 characters: A-Z, a-z, 0-9, _ and -")
+
+
+class LimitedRequestHandler(SimpleRequestHandler):
+    """Обработчик webhook с ограничением числа одновременно обрабатываемых обновлений
+
+    Telegram получает ответ сразу, а обновление обрабатывается в фоне.
+    """
+
+    def __init__(self, dispatcher, bot, concurrency=WEBHOOK_CONCURRENCY, **kwargs):
+        super().__init__(dispatcher, bot, handle_in_background=True, **kwargs)
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    async def _background_feed_update(self, bot, update):
+        async with self._semaphore:
+            await super()._background_feed_update(bot, update)
+
+
+def create_app(dp, bot, secret_token=WEBHOOK_SECRET, concurrency=WEBHOOK_CONCURRENCY):
+    """Приложение aiohttp, передающее обновления в dp"""
+    app = web.Application()
+    handler = LimitedRequestHandler(dp, bot, concurrency=concurrency, secret_token=secret_token)
+    handler.register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    return app
+
+
+def _stop_on_signals(stop):
+    """Установка stop по SIGTERM и SIGINT; возвращает сигналы, для которых это удалось"""
+    loop = asyncio.get_running_loop()
+    handled = []
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            # Windows или не главный поток: остается обработка по умолчанию
+            continue
+        handled.append(sig)
+    return handled
+
+
+async def run_webhook(dp, bot, stop=None):
+    """Запуск HTTP-сервера и регистрация webhook в Telegram
+
+    Сервер работает, пока не установлено событие stop. По умолчанию оно
+    устанавливается по SIGTERM и SIGINT, поэтому при остановке контейнера
+    функция возвращает управление и main() записывает очереди в базу.
+    """
+    if stop is None:
+        stop = asyncio.Event()
+    app = create_app(dp, bot)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    try:
+        await site.start()
+    except Exception:
+        await runner.cleanup()
+        raise
+    logger.info(f"Webhook server listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+    handled = _stop_on_signals(stop)
+    try:
+        if WEBHOOK_URL:
+            await bot.set_webhook(
+                WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+                allowed_updates=dp.resolve_used_update_types(),
+                drop_pending_updates=DROP_PENDING_UPDATES,
+                max_connections=min(WEBHOOK_CONCURRENCY, 100)
+            )
+            logger.info(f"Webhook set to {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+        else:
+            logger.warning("WEBHOOK_URL is not set, webhook is not registered in Telegram")
+        # Работаем до сигнала остановки
+        await stop.wait()
+        logger.info("Stop signal received, shutting down webhook server")
+    finally:
+        loop = asyncio.get_running_loop()
+        for sig in handled:
+            loop.remove_signal_handler(sig)
+        # Закрываем соединения и вызываем обработчики остановки Dispatcher
+        await runner.cleanup()